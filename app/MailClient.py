@@ -2,14 +2,422 @@
 pluggable mail client.
 '''
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+import asyncio
+import base64
 import imaplib, email
+import email.message
+import email.utils
+import itertools
+import email.parser
+import mmap
+import os
+import re
+import select
+import ssl
+import threading
+import time
+from datetime import date
 from flask import current_app
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+from prometheus_client import Counter, Gauge
+
+from app import registry
+
+
+CONNECTION_AGE = Gauge('janitor_imap_connection_age_seconds',
+                       'seconds since the shared imap connection was opened',
+                       labelnames=['account',
+                                   ],
+              multiprocess_mode='liveall',
+              registry=registry
+                       )
+
+RECONNECTS = Counter('janitor_imap_reconnects_total',
+              'number of times a dead shared imap connection was replaced',
+              labelnames=['account',
+                          ],
+              registry=registry
+              )
+
+THROTTLED = Counter('janitor_imap_fetch_refused_total',
+              'number of FETCH commands the server throttled or refused',
+              labelnames=['account',
+                          ],
+              registry=registry
+              )
+
+FETCH_CHUNK_SIZE = Gauge('janitor_imap_fetch_chunk_size',
+                         'messages per FETCH the last time the account fetched',
+                         labelnames=['account',
+                                     ],
+              multiprocess_mode='liveall',
+              registry=registry
+                         )
+
+
+FETCH_TOKENS = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))'
+    rb'|(?P<quoted>"(?:[^"\\]|\\.)*")'
+    rb'|(?P<literal>\{\d+\}$)'
+    rb'|(?P<atom>[^\s()"\[\]]+(?:\[[^\]]*\](?:<[\d.]+>)?)?))'
+)
+
+IDLE_NEW_MAIL = re.compile(rb'\* \d+ (EXISTS|RECENT)', re.IGNORECASE)
+
+UNTAGGED_FETCH = re.compile(rb'\* (\d+) FETCH ', re.IGNORECASE)
+
+LITERAL = re.compile(rb'\{(\d+)\}\r?\n$')
+
+# the response code gmail slows clients down with
+THROTTLED_CODE = b'[THROTTLED]'
+
+UID_RANGE = re.compile(r'UID (\d+):\*', re.IGNORECASE)
+
+SEARCH_DATE = re.compile(r'\b(SINCE|BEFORE) (\d{1,2})-([a-z]{3})-(\d{4})\b', re.IGNORECASE)
+
+# the delivery date of an mbox "From " line, e.g. Tue Jun  1 10:00:00 2021
+FROM_LINE_DATE = re.compile(rb' ([A-Z][a-z]{2}) +(\d{1,2}) \d\d:\d\d(?::\d\d)? (?:\S+ )?(\d{4})\b')
+
+
+def sequence_set(msg_ids):
+    '''
+    collapse a list of message ids into an imap sequence set,
+    e.g. [1, 5, 9, 10, 11] becomes b'1,5,9:11'
+    '''
+    ids = sorted({int(msg_id) for msg_id in msg_ids})
+    ranges = []
+    for msg_id in ids:
+        if ranges and ranges[-1][1] == msg_id - 1:
+            ranges[-1][1] = msg_id
+        else:
+            ranges.append([msg_id, msg_id])
+
+    parts = []
+    for start, end in ranges:
+        if start == end:
+            parts.append(str(start))
+        else:
+            parts.append(f'{start}:{end}')
+    return ','.join(parts).encode()
+
+
+def _fetch_tokens(data):
+    '''
+    turn the raw response list from imaplib into a flat stream of tokens.
+    literals are handed back as-is since imaplib has already read them.
+    '''
+    for entry in data:
+        if isinstance(entry, tuple):
+            text, literal = entry
+        else:
+            text, literal = entry, None
+
+        for match in FETCH_TOKENS.finditer(text or b''):
+            if match.group('open'):
+                yield '('
+            elif match.group('close'):
+                yield ')'
+            elif match.group('quoted'):
+                value = match.group('quoted')[1:-1]
+                yield re.sub(rb'\\(.)', rb'\1', value)
+            elif match.group('atom'):
+                atom = match.group('atom')
+                yield None if atom.upper() == b'NIL' else atom
+
+        if literal is not None:
+            yield literal
+
+
+def _fetch_list(tokens):
+    '''
+    read tokens up to the closing paren of the current list
+    '''
+    items = []
+    for token in tokens:
+        if token == '(':
+            items.append(_fetch_list(tokens))
+        elif token == ')':
+            return items
+        else:
+            items.append(token)
+    return items
+
+
+def parse_fetch_response(data):
+    '''
+    parse the data returned by a FETCH command into (msg_id, items)
+    pairs, where items maps each returned data item name (RFC822, UID,
+    BODY[...]) to its value. nested lists are returned as python lists.
+    '''
+    tokens = _fetch_tokens(data)
+    for token in tokens:
+        if token in ('(', ')') or token is None:
+            continue
+        msg_id = token
+        for token in tokens:
+            if token == '(':
+                break
+        values = _fetch_list(tokens)
+        items = {}
+        for key, value in zip(values[::2], values[1::2]):
+            items[key.decode().upper()] = value
+        yield msg_id, items
+
+
+def body_sections(structure, prefix=''):
+    '''
+    walk a parsed BODYSTRUCTURE and yield (section, content type) for
+    every leaf part, e.g. ('1.2', 'text/calendar')
+    '''
+    if structure and isinstance(structure[0], list):
+        # the child parts come first, followed by the multipart subtype
+        for i, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            yield from body_sections(child, f'{prefix}{i}.')
+    elif structure and len(structure) > 1:
+        ctype = b'/'.join(structure[:2]).decode().lower()
+        yield prefix.rstrip('.') or '1', ctype
+
+
+def find_sections(structure, content_types):
+    '''
+    return the sections of a multipart message holding the given content
+    types, or None if the whole message needs to be fetched.
+    '''
+    if not content_types or not structure or not isinstance(structure[0], list):
+        return None
+
+    sections = [section for section, ctype in body_sections(structure)
+                if ctype in content_types]
+
+    return sections or None
+
+
+def build_message(items, sections):
+    '''
+    put a message back together from its header and the body sections
+    that were fetched. the parts are attached directly to the top level
+    multipart so providers can walk them as usual.
+    '''
+    msg = email.message_from_bytes(items.get('BODY[HEADER]') or b'')
+    parts = []
+    for section in sections:
+        mime = items.get(f'BODY[{section}.MIME]') or b'\r\n'
+        body = items.get(f'BODY[{section}]') or b''
+        parts.append(email.message_from_bytes(mime + body))
+    msg.set_payload(parts)
+    return msg
+
+
+# providers only ever read these, other parts can be dropped when too big
+KEEP_TYPES = ('text/', 'multipart/', 'message/')
+
+# how much of a message is handed to the parser at a time
+PARSE_CHUNK_SIZE = 64 * 1024
+
+
+class MessageStream:
+    '''
+    parses a message fed to it a chunk at a time with BytesFeedParser so
+    the raw message is never needed whole. the body of a part that isn't
+    text, like a pdf or a spreadsheet of circuits, is dropped as soon as
+    it grows past max_part_size and an X-Janitor-Dropped header with its
+    size is left in its place, so it never makes it into the parsed tree.
+    '''
+    def __init__(self, max_part_size=None):
+        self.max_part_size = max_part_size
+        self.parser = email.parser.BytesFeedParser()
+        self.dropped = 0
+        self._header_parser = email.parser.BytesHeaderParser()
+        self._rest = b''
+        self._boundaries = []
+        # the header lines of the current part until its body starts
+        self._headers = []
+        # the headers and body of a part that may still be dropped
+        self._held = None
+        self._body = []
+        self._size = 0
+
+    def feed(self, data):
+        lines = (self._rest + bytes(data)).split(b'\n')
+        self._rest = lines.pop()
+        for line in lines:
+            self._line(line + b'\n')
+
+    def close(self):
+        if self._rest:
+            self._line(self._rest)
+            self._rest = b''
+        if self._headers:
+            self.parser.feed(b''.join(self._headers))
+            self._headers = None
+        self._end_part()
+        return self.parser.close()
+
+    def _boundary(self, line):
+        '''
+        'part' or 'close' if line is a boundary of an enclosing multipart
+        '''
+        text = line.rstrip(b'\r\n \t')
+        for i in range(len(self._boundaries) - 1, -1, -1):
+            boundary = self._boundaries[i]
+            if text == b'--' + boundary:
+                del self._boundaries[i + 1:]
+                return 'part'
+            if text == b'--' + boundary + b'--':
+                del self._boundaries[i:]
+                return 'close'
+        return None
+
+    def _start_body(self):
+        headers = self._headers
+        self._headers = None
+        part = self._header_parser.parsebytes(b''.join(headers))
+        ctype = part.get_content_type()
+        boundary = part.get_boundary()
+        if ctype.startswith('multipart/') and boundary:
+            self._boundaries.append(boundary.encode())
+
+        if self.max_part_size is None or ctype.startswith(KEEP_TYPES):
+            self.parser.feed(b''.join(headers))
+        else:
+            self._held = headers
+            self._body = []
+            self._size = 0
+
+    def _end_part(self):
+        if self._held is None:
+            return
+        headers, self._held = self._held, None
+        if self._size > self.max_part_size:
+            self.dropped += 1
+            # the header goes right before the blank line ending the headers
+            headers = headers[:-1] + [f'X-Janitor-Dropped: {self._size}\r\n'.encode(), headers[-1]]
+        self.parser.feed(b''.join(headers))
+        for line in self._body:
+            self.parser.feed(line)
+        self._body = []
+
+    def _line(self, line):
+        if self._headers is not None:
+            self._headers.append(line)
+            if not line.strip(b'\r\n'):
+                self._start_body()
+            return
+
+        if line.startswith(b'--') and self._boundaries:
+            marker = self._boundary(line)
+            if marker:
+                self._end_part()
+                self.parser.feed(line)
+                if marker == 'part':
+                    self._headers = []
+                return
+
+        if self._held is None:
+            self.parser.feed(line)
+            return
+
+        self._size += len(line)
+        if self._size <= self.max_part_size:
+            self._body.append(line)
+        elif self._body:
+            self._body = []
+
+
+def parse_message(data, max_part_size=None):
+    '''
+    parse a message from bytes or an iterable of byte chunks with a
+    MessageStream, dropping attachments bigger than max_part_size
+    '''
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data)
+        data = (view[i:i + PARSE_CHUNK_SIZE] for i in range(0, len(view), PARSE_CHUNK_SIZE))
+    stream = MessageStream(max_part_size)
+    for chunk in data:
+        stream.feed(chunk)
+    return stream.close()
+
+
+class FetchTuner:
+    '''
+    picks the number of messages per FETCH and the number of FETCHes in
+    flight from how the server has been answering. a batch that comes
+    back in under half of target seconds doubles the chunk size, up to
+    max_chunk_size, and a slower one shrinks it in proportion, so a fast
+    server is asked for more per round trip and a slow one only for what
+    it answers in time. a throttled or refused FETCH halves both and is
+    retried after a backoff that doubles each time in a row it happens.
+    every query keeps its own chunk size since headers and whole
+    messages differ in size by orders of magnitude.
+    '''
+    target = 2.0
+    max_backoff = 60
+    retries = 5
+
+    def __init__(self, max_chunk_size=500, max_window=1):
+        self.max_chunk_size = max_chunk_size
+        self.max_window = max_window
+        self.window = max_window
+        self.sizes = {}
+        self.backoff = 0
+        self.failures = 0
+        # bytes per second, a moving average
+        self.rate = None
+
+    def chunk_size(self, query, default):
+        if query not in self.sizes:
+            self.sizes[query] = max(1, min(int(default), self.max_chunk_size))
+        return self.sizes[query]
+
+    def batch_size(self, default):
+        '''
+        the most messages a batch of FETCHes is asking for
+        '''
+        return max(self.sizes.values(), default=int(default)) * self.window
+
+    def succeeded(self, query, messages, nbytes, elapsed):
+        self.failures = 0
+        self.backoff = 0
+        if elapsed > 0:
+            rate = nbytes / elapsed
+            self.rate = rate if self.rate is None else self.rate * 0.8 + rate * 0.2
+
+        size = self.sizes[query]
+        if elapsed > self.target:
+            size = max(1, int(size * self.target / elapsed))
+        elif elapsed < self.target / 2 and messages >= size:
+            # a short last chunk says nothing about a bigger one
+            size = min(self.max_chunk_size, size * 2)
+        self.sizes[query] = size
+        self.window = min(self.max_window, self.window + 1)
+
+    def refused(self, query):
+        '''
+        back off after a throttled or refused FETCH. returns False once
+        it has been refused more than retries times in a row.
+        '''
+        self.failures += 1
+        self.sizes[query] = max(1, self.sizes[query] // 2)
+        self.window = max(1, self.window // 2)
+        self.backoff = min(self.max_backoff, self.backoff * 2 or 1)
+        return self.failures <= self.retries
 
 
 class MailClient(metaclass=ABCMeta):
     '''
     all mail clients require the below methods
     '''
+    # clients that can only find new messages one way override MAIL_SYNC_MODE
+    sync_mode = None
+    # attachments bigger than this are dropped while parsing, None keeps them
+    max_part_size = None
+
     def __init__(self, server, email, passwd, port=993):
         self.server = server
         self.email = email
@@ -39,12 +447,57 @@ class MailClient(metaclass=ABCMeta):
         '''
         pass
 
+    @abstractmethod
+    def select():
+        '''
+        selects the mailbox that messages are processed from and returns
+        its uidvalidity.
+        '''
+        pass
+
+    @abstractmethod
+    def search():
+        '''
+        this is sent imap search criteria and should return a list of
+        matching message ids (uids if the client is in uid mode).
+        '''
+        pass
+
+    @abstractmethod
+    def fetch():
+        '''
+        this is sent a list of message ids and should yield an
+        (id, email.message.Message) pair for each of them, retrieving
+        them from the server in batches where possible.
+        '''
+        pass
+
+    @abstractmethod
+    def fetch_headers():
+        '''
+        like fetch, but only the given header fields are retrieved
+        and the message should not be marked as read. yields an
+        (id, headers, structure) tuple where structure is the parsed
+        BODYSTRUCTURE of the message, or None if it isn't available.
+        '''
+        pass
+
+    @abstractmethod
+    def fetch_parts():
+        '''
+        this is sent a dict of message ids to the body sections that
+        should be retrieved (None for the whole message) and should
+        yield (id, email.message.Message) pairs in the order given.
+        '''
+        pass
+
     @abstractmethod
     def mark_processed():
         '''
         this is sent a message id that should be marked as read
         so that it's not attempted to be processed on future connections.
         it should also be moved into the "processed" folder.
+        the change may be buffered until flush is called.
         '''
         pass
 
@@ -54,14 +507,32 @@ class MailClient(metaclass=ABCMeta):
         this is sent a message id that should be marked as unread
         so that it's attempted to be processed on future connections.
         it should also be moved to the "failures" folder.
+        the change may be buffered until flush is called.
+        '''
+        pass
+
+    @abstractmethod
+    def flush():
+        '''
+        apply any buffered mark_processed and mark_failed changes,
+        ideally with a handful of commands covering every message.
         '''
         pass
 
 
 class Gmail(MailClient):
+    imap_class = imaplib.IMAP4_SSL
+
     def __init__(self, server, email, passwd, port=993):
         super().__init__(server, email, passwd, port)
         self.session = None
+        # when set, message ids are uids rather than sequence numbers
+        self.uid = False
+        self.bytes_fetched = 0
+        self.tuner = FetchTuner()
+        self._idle_buffer = b''
+        self._processed = []
+        self._failed = []
 
 
     def __enter__(self):
@@ -98,7 +569,7 @@ class Gmail(MailClient):
         if not self.session:
             current_app.logger.debug(f'opening session for {self.email}')
 
-            self.session = imaplib.IMAP4_SSL(self.server)
+            self.session = self.imap_class(self.server, self.port)
             self.session.login(self.email, self.passwd)
 
             current_app.logger.debug(f'session for {self.email} open')
@@ -107,36 +578,305 @@ class Gmail(MailClient):
 
     def close_session(self):
         if self.session:
+            self.flush()
             current_app.logger.debug(f'closing session for {self.email}')
             if self.session.state == 'SELECTED':
                 self.session.close()
             if self.session.state == 'AUTH':
                 self.session.logout()
+            self.session = None
 
 
-    def mark_processed(self, msg_id):
+    def _idle_readline(self, timeout):
         '''
-        gmail uses labels instead of folders so instead of moving
-        we just add the label
+        read a line straight off the socket, returning None if nothing
+        arrives within timeout seconds. imaplib's own readline can't be
+        used here since its file object is unusable after a timeout.
+        '''
+        sock = self.session.sock
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self._idle_buffer:
+            # ssl sockets may already hold decrypted data select can't see
+            if not getattr(sock, 'pending', lambda: 0)():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                ready, _, _ = select.select([sock], [], [], remaining)
+                if not ready:
+                    return None
+            data = sock.recv(8192)
+            if not data:
+                raise imaplib.IMAP4.abort('connection closed during IDLE')
+            self._idle_buffer += data
+
+        line, self._idle_buffer = self._idle_buffer.split(b'\n', 1)
+        return line + b'\n'
+
+    def idle(self, timeout=29 * 60):
+        '''
+        IDLE on the selected mailbox until the server reports new mail or
+        timeout seconds pass. servers drop IDLE after 30 minutes so the
+        timeout should stay below that. returns True if mail arrived.
+        '''
+        if not self.session:
+            self.open_session()
+
+        session = self.session
+        tag = session._new_tag()
+        session.tagged_commands.pop(tag, None)
+        session.send(tag + b' IDLE\r\n')
+        self._idle_buffer = b''
+
+        line = self._idle_readline(30)
+        if not line or not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f'IDLE was not accepted: {line}')
+
+        current_app.logger.debug(f'idling on {self.email} for up to {timeout}s')
+
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        while not new_mail:
+            line = self._idle_readline(deadline - time.monotonic())
+            if line is None:
+                break
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(f'server closed the connection: {line}')
+            if IDLE_NEW_MAIL.match(line):
+                new_mail = True
+
+        session.send(b'DONE\r\n')
+        while True:
+            line = self._idle_readline(30)
+            if line is None:
+                raise imaplib.IMAP4.abort('no response to IDLE DONE')
+            if line.startswith(tag + b' '):
+                if not line[len(tag):].strip().upper().startswith(b'OK'):
+                    raise imaplib.IMAP4.error(f'IDLE failed: {line}')
+                break
+            if IDLE_NEW_MAIL.match(line):
+                new_mail = True
+
+        return new_mail
+
+    def _command(self, name, *args):
+        '''
+        run a command against either uids or sequence numbers
+        '''
+        if self.uid:
+            return self.session.uid(name, *args)
+        return getattr(self.session, name.lower())(*args)
+
+    def select(self, mailbox):
+        if not self.session:
+            self.open_session()
+
+        typ, data = self.session.select(mailbox)
+        if typ != 'OK':
+            raise Exception(f'unable to select {mailbox}: {data}')
+
+        typ, uidvalidity = self.session.response('UIDVALIDITY')
+        if not uidvalidity or uidvalidity[0] is None:
+            return None
+        return int(uidvalidity[0])
+
+    def search(self, criteria):
+        if not self.session:
+            self.open_session()
+
+        if self.uid:
+            typ, messages = self.session.uid('SEARCH', criteria)
+        else:
+            typ, messages = self.session.search(None, criteria)
+        if typ != 'OK':
+            raise Exception(f'error searching for {criteria}: {messages}')
+
+        return messages[0].split()
+
+    def _fetch_chunks(self, chunks, query):
+        '''
+        yield the (typ, data, text) response to the FETCH of each chunk,
+        text being that of the tagged response
+        '''
+        for chunk in chunks:
+            yield self._fetch_tagged(sequence_set(chunk), query)
+
+    def _fetch_tagged(self, *args):
+        '''
+        a FETCH that keeps the text of its tagged response, which
+        imaplib's fetch() throws away. gmail says [THROTTLED] there,
+        on OK responses too.
+        '''
+        session = self.session
+        if self.uid:
+            typ, text = session._simple_command('UID', 'FETCH', *args)
+        else:
+            typ, text = session._simple_command('FETCH', *args)
+        typ, data = session._untagged_response(typ, text, 'FETCH')
+        return typ, data, text
+
+    def _fetch_items(self, msg_ids, query, chunk_size):
+        '''
+        run a FETCH for query a chunk of messages at a time using a
+        sequence set per chunk instead of a round trip per message.
+        chunk_size is where the chunk size starts, after that it and the
+        number of chunks fetched at once are up to the client's tuner.
+        responses are parsed and handed back as each batch arrives.
         '''
         if not self.session:
             self.open_session()
 
-        self.session.store(msg_id, '+X-GM-LABELS', 'processed')
-        self.session.store(msg_id, '+FLAGS', '\\Seen')
+        msg_ids = list(msg_ids)
+        tuner = self.tuner
+        pos = 0
+        while pos < len(msg_ids):
+            size = tuner.chunk_size(query, chunk_size)
+            end = min(len(msg_ids), pos + size * tuner.window)
+            chunks = [msg_ids[i:i + size] for i in range(pos, end, size)]
+
+            start = time.monotonic()
+            responses = list(self._fetch_chunks(chunks, query))
+            elapsed = time.monotonic() - start
 
-        # if message was previously a failure, remove the tag
-        self.session.store(msg_id, '-X-GM-LABELS', 'failures')
+            fetched = []
+            refused = None
+            throttled = False
+            for chunk, (typ, data, text) in zip(chunks, responses):
+                if typ != 'OK':
+                    refused = (chunk, typ, data)
+                    break
+                fetched.append((chunk, data))
+                # the data came back, but the server wants us to slow down
+                throttled = throttled or any(
+                    THROTTLED_CODE in line.upper() for line in text if isinstance(line, bytes))
+
+            nbytes = sum(len(v) for _, data in fetched for d in data
+                         if isinstance(d, tuple) for v in d)
+            self.bytes_fetched += nbytes
+            if refused:
+                chunk, typ, data = refused
+                THROTTLED.labels(account=self.email).inc()
+                # BAD means the command itself is wrong, retrying won't help
+                if typ == 'BAD' or not tuner.refused(query):
+                    raise Exception(f'error fetching messages {chunk}: {data}')
+                current_app.logger.warning(f'FETCH of {len(chunk)} messages refused: {data}, '
+                                           f'retrying in {tuner.backoff}s with {tuner.sizes[query]} per FETCH')
+            elif throttled:
+                THROTTLED.labels(account=self.email).inc()
+                tuner.refused(query)
+                current_app.logger.warning(f'FETCH throttled, waiting {tuner.backoff}s '
+                                           f'and going on with {tuner.sizes[query]} per FETCH')
+            else:
+                tuner.succeeded(query, end - pos, nbytes, elapsed)
+            FETCH_CHUNK_SIZE.labels(account=self.email).set(tuner.sizes[query])
+
+            current_app.logger.debug(f'fetched {query} for {sum(len(c) for c, _ in fetched)} '
+                                     f'messages in {elapsed:.2f}s')
+
+            for chunk, data in fetched:
+                pos += len(chunk)
+                for msg_id, items in parse_fetch_response(data):
+                    if self.uid:
+                        msg_id = items.get('UID')
+                        if msg_id is None:
+                            # an unsolicited flag update, not our data
+                            continue
+                    yield msg_id, items
+
+            if refused or throttled:
+                time.sleep(tuner.backoff)
+
+    def fetch(self, msg_ids, chunk_size=50):
+        for msg_id, items in self._fetch_items(msg_ids, '(BODY.PEEK[])', chunk_size):
+            if items.get('BODY[]') is None:
+                continue
+            yield msg_id, parse_message(items['BODY[]'], self.max_part_size)
+
+    def fetch_headers(self, msg_ids, fields, chunk_size=50, structure=True):
+        query = f'BODY.PEEK[HEADER.FIELDS ({" ".join(fields).upper()})]'
+        query = f'(BODYSTRUCTURE {query})' if structure else f'({query})'
+        for msg_id, items in self._fetch_items(msg_ids, query, chunk_size):
+            headers = [v for k, v in items.items() if k.startswith('BODY[HEADER')]
+            if not headers:
+                continue
+            headers = email.message_from_bytes(headers[0] or b'')
+            yield msg_id, headers, items.get('BODYSTRUCTURE')
+
+    def fetch_parts(self, parts, chunk_size=50):
+        '''
+        messages that need the same sections are fetched together with
+        BODY.PEEK[<section>] so that attachments a provider doesn't look
+        at are never downloaded.
+        '''
+        msg_ids = list(parts)
+        i = 0
+        while i < len(msg_ids):
+            step = self.tuner.batch_size(chunk_size)
+            chunk = msg_ids[i:i + step]
+            i += step
+            groups = {}
+            for msg_id in chunk:
+                sections = parts[msg_id]
+                groups.setdefault(tuple(sections) if sections else None, []).append(msg_id)
+
+            messages = {}
+            for sections, ids in groups.items():
+                if not sections:
+                    messages.update(self.fetch(ids, chunk_size))
+                    continue
+                query = ' '.join(['BODY.PEEK[HEADER]'] + [
+                    f'BODY.PEEK[{section}.MIME] BODY.PEEK[{section}]'
+                    for section in sections])
+                for msg_id, items in self._fetch_items(ids, f'({query})', chunk_size):
+                    if items.get('BODY[HEADER]') is None:
+                        continue
+                    messages[msg_id] = build_message(items, sections)
+
+            for msg_id in chunk:
+                if msg_id in messages:
+                    yield msg_id, messages[msg_id]
+
+    def mark_processed(self, msg_id):
+        '''
+        gmail uses labels instead of folders so instead of moving
+        we just add the label. this is buffered until flush.
+        '''
+        self._processed.append(msg_id)
 
 
     def mark_failed(self, msg_id):
         '''
         gmail uses labels instead of folders so instead of moving
-        we just add the label
+        we just add the label. this is buffered until flush.
         '''
+        self._failed.append(msg_id)
+
+
+    def flush(self):
+        '''
+        apply the buffered labels with one STORE per change over the
+        whole set of messages rather than a STORE per message.
+        '''
+        if not (self._processed or self._failed):
+            return
+
         if not self.session:
             self.open_session()
-        self.session.store(msg_id, '+X-GM-LABELS', 'failures')
+
+        if self._processed:
+            processed = sequence_set(self._processed)
+            self._command('STORE', processed, '+X-GM-LABELS', 'processed')
+            self._command('STORE', processed, '+FLAGS.SILENT', '\\Seen')
+
+            # if message was previously a failure, remove the tag
+            self._command('STORE', processed, '-X-GM-LABELS', 'failures')
+
+        if self._failed:
+            self._command('STORE', sequence_set(self._failed), '+X-GM-LABELS', 'failures')
+
+        current_app.logger.debug(f'marked {len(self._processed)} processed and {len(self._failed)} failed')
+
+        self._processed = []
+        self._failed = []
 
 
     def __repr__(self):
@@ -145,3 +885,1017 @@ class Gmail(MailClient):
         port = f'port: {self.port}>'
         rep = server + email + port
         return rep
+
+
+def _quote(arg):
+    return b'"' + arg.encode().replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def fetch_data(untagged):
+    '''
+    turn untagged FETCH responses into the data imaplib would have
+    returned for them so parse_fetch_response can read them
+    '''
+    data = []
+    for response in untagged:
+        parts = list(response) if isinstance(response, list) else [response]
+        first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        match = UNTAGGED_FETCH.match(first)
+        if not match:
+            continue
+        first = match.group(1) + b' ' + first[match.end():]
+        if isinstance(parts[0], tuple):
+            parts[0] = (first, parts[0][1])
+        else:
+            parts[0] = first
+        data.extend(parts)
+    return data
+
+
+class AsyncIMAP:
+    '''
+    a small asyncio imap connection that pipelines commands: each one is
+    written as soon as it is issued rather than after the previous one
+    completes, and a single reader task hands responses back to them.
+    untagged responses belong to the oldest command still waiting, which
+    is how servers answer pipelined FETCHes.
+    '''
+    def __init__(self, host, port, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.reader = None
+        self.writer = None
+        self.closed = True
+        self._tags = itertools.count(1)
+        self._pending = {}
+        self._task = None
+
+    async def connect(self, timeout=30):
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context, limit=2 ** 20),
+            timeout)
+        greeting = await self.reader.readline()
+        if not greeting.startswith(b'* OK'):
+            raise imaplib.IMAP4.error(f'unexpected greeting: {greeting}')
+        self.closed = False
+        self._task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_response(self):
+        '''
+        read one response with any literals in it, as imaplib would
+        return it: a line, or (text, literal) tuples and the line's end
+        '''
+        line = await self.reader.readline()
+        parts = []
+        while True:
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed by the server')
+            match = LITERAL.search(line)
+            if not match:
+                break
+            literal = await self.reader.readexactly(int(match.group(1)))
+            parts.append((line.rstrip(b'\r\n'), literal))
+            line = await self.reader.readline()
+
+        line = line.rstrip(b'\r\n')
+        if parts:
+            return parts + [line]
+        return line
+
+    async def _read_loop(self):
+        try:
+            while True:
+                response = await self._read_response()
+                first = response[0][0] if isinstance(response, list) else response
+                if first.startswith(b'* '):
+                    if self._pending:
+                        self._pending[next(iter(self._pending))][1].append(response)
+                    continue
+                if first.startswith(b'+'):
+                    continue
+
+                tag, _, text = first.partition(b' ')
+                future, untagged = self._pending.pop(tag, (None, None))
+                if future and not future.done():
+                    status = text.split(b' ', 1)[0].decode().upper()
+                    future.set_result((status, untagged, text))
+        except Exception as e:
+            self.closed = True
+            error = e if isinstance(e, imaplib.IMAP4.abort) else imaplib.IMAP4.abort(str(e))
+            for future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def command(self, *args):
+        '''
+        send a command without waiting for earlier ones to complete.
+        returns its status, the untagged responses sent for it and the
+        text of its tagged response.
+        '''
+        if self.closed:
+            raise imaplib.IMAP4.abort('connection is closed')
+        tag = f'J{next(self._tags)}'.encode()
+        future = asyncio.get_event_loop().create_future()
+        self._pending[tag] = (future, [])
+        args = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+        self.writer.write(b' '.join([tag] + args) + b'\r\n')
+        await self.writer.drain()
+        return await future
+
+    async def login(self, user, password):
+        status, _, text = await self.command(b'LOGIN', _quote(user), _quote(password))
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f'LOGIN failed: {text}')
+
+    async def close(self):
+        if not self.closed:
+            try:
+                await asyncio.wait_for(self.command(b'LOGOUT'), 5)
+            except (imaplib.IMAP4.error, OSError, asyncio.TimeoutError):
+                pass
+        self.closed = True
+        if self._task:
+            self._task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class AsyncGmail(Gmail):
+    '''
+    Gmail with its FETCHes moved onto a pool of asyncio connections.
+    the FETCHes for a run's chunks are pipelined, up to pipeline of them
+    in flight on each of the connections at once, so a run waits on the
+    server's round trip time once per window instead of once per chunk.
+    everything else still goes through the imaplib session, and the
+    scheduler jobs call it synchronously exactly like Gmail.
+    '''
+    def __init__(self, server, email, passwd, port=993, connections=2, pipeline=4):
+        super().__init__(server, email, passwd, port)
+        self.connections = connections
+        self.pipeline = pipeline
+        self.tuner = FetchTuner(max_window=connections * pipeline)
+        self._loop = None
+        self._thread = None
+        self._conns = []
+        self._mailbox = None
+        self._selected = None
+
+    def _run(self, coro):
+        '''
+        the sync shim: run a coroutine on the client's event loop, which
+        lives in its own thread so that its connections outlast a call
+        and it can be used from any scheduler or worker thread.
+        '''
+        if not self._loop:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever,
+                                            name=f'imap-{self.email}', daemon=True)
+            self._thread.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _connect(self):
+        '''
+        replace dead fetch connections and select the current mailbox
+        on all of them, read only, since they only ever FETCH
+        '''
+        alive = [conn for conn in self._conns if not conn.closed]
+        if len(alive) != len(self._conns):
+            self._selected = None
+
+        new = [AsyncIMAP(self.server, self.port,
+                         issubclass(self.imap_class, imaplib.IMAP4_SSL))
+               for _ in range(self.connections - len(alive))]
+        if new:
+            await asyncio.gather(*(conn.connect() for conn in new))
+            await asyncio.gather(*(conn.login(self.email, self.passwd) for conn in new))
+            self._selected = None
+        self._conns = alive + new
+
+        if self._selected != self._mailbox:
+            for status, _, text in await asyncio.gather(*(
+                    conn.command(b'EXAMINE', _quote(self._mailbox)) for conn in self._conns)):
+                if status != 'OK':
+                    raise Exception(f'unable to select {self._mailbox}: {text}')
+            self._selected = self._mailbox
+
+    async def _fetch_window(self, chunks, query):
+        await self._connect()
+        command = [b'UID', b'FETCH'] if self.uid else [b'FETCH']
+        responses = await asyncio.gather(*(
+            self._conns[i % len(self._conns)].command(*command, sequence_set(chunk), query)
+            for i, chunk in enumerate(chunks)))
+        return [(status, fetch_data(untagged) if status == 'OK' else [text], [text])
+                for status, untagged, text in responses]
+
+    def select(self, mailbox):
+        uidvalidity = super().select(mailbox)
+        self._mailbox = mailbox
+        return uidvalidity
+
+    def _fetch_chunks(self, chunks, query):
+        '''
+        sequence numbers are shared by every connection as long as
+        nothing is expunged in between, and nothing here expunges.
+        '''
+        window = self.connections * self.pipeline
+        for i in range(0, len(chunks), window):
+            yield from self._run(self._fetch_window(chunks[i:i + window], query))
+
+    async def _close(self):
+        await asyncio.gather(*(conn.close() for conn in self._conns))
+        self._conns = []
+        self._selected = None
+
+    def close_session(self):
+        super().close_session()
+        if self._loop:
+            self._run(self._close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+    def __repr__(self):
+        return f'<AsyncGmail server: {self.server}, user: {self.email}, port: {self.port}, connections: {self.connections}>'
+
+
+IMAP_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+               'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def gmail_query(criteria):
+    '''
+    turn the imap search criteria the jobs use, ALL, UNSEEN, SEEN, SINCE
+    and BEFORE, into a gmail search
+    '''
+    criteria = criteria if isinstance(criteria, str) else criteria.decode()
+    tokens = iter(criteria.split())
+    terms = []
+    for token in tokens:
+        key = token.upper()
+        if key == 'UNSEEN':
+            terms.append('is:unread')
+        elif key == 'SEEN':
+            terms.append('is:read')
+        elif key in ('SINCE', 'BEFORE'):
+            day, month, year = next(tokens).split('-')
+            month = IMAP_MONTHS.index(month.upper()) + 1
+            terms.append(f'{"after" if key == "SINCE" else "before"}:{year}/{month}/{day}')
+        elif key != 'ALL':
+            raise ValueError(f'unsupported search criteria for the gmail api: {criteria}')
+    return ' '.join(terms)
+
+
+class GmailAPI(MailClient):
+    '''
+    Gmail over its REST API, authorized with an OAuth token instead of an
+    app password. messages are fetched with batch requests of up to 100
+    messages.get calls per round trip, labels are changed with
+    messages.batchModify, and the history sync mode asks
+    users.history.list what was added to the mailbox since the last run
+    instead of searching it. message ids are gmail's message ids.
+    '''
+    sync_mode = 'history'
+    # the most calls gmail accepts in one batch request
+    batch_limit = 100
+    scopes = ['https://www.googleapis.com/auth/gmail.modify']
+
+    def __init__(self, email, token_file, api_root='https://gmail.googleapis.com/'):
+        super().__init__('gmail-api', email, None, None)
+        self.token_file = token_file
+        self.api_root = api_root if api_root.endswith('/') else api_root + '/'
+        self.session = None
+        self.uid = False
+        self.bytes_fetched = 0
+        self.tuner = FetchTuner(max_chunk_size=self.batch_limit)
+        self._labels = None
+        self._label = None
+        self._processed = []
+        self._failed = []
+
+    def __enter__(self):
+        self.open_session()
+        return self
+
+    def __exit__(self, ex_type, ex_value, traceback):
+        self.close_session()
+
+    def open_session(self):
+        if not self.session:
+            credentials = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+            self.session = build('gmail', 'v1', credentials=credentials,
+                                 client_options={'api_endpoint': self.api_root},
+                                 static_discovery=True, cache_discovery=False)
+        return self.session
+
+    def close_session(self):
+        if self.session:
+            self.flush()
+            self.session = None
+
+    @property
+    def _messages(self):
+        if not self.session:
+            self.open_session()
+        return self.session.users().messages()
+
+    def label_id(self, name, create=False):
+        '''
+        the id of the label called name. system labels like INBOX are
+        their own id.
+        '''
+        if self._labels is None:
+            if not self.session:
+                self.open_session()
+            labels = self.session.users().labels().list(userId='me').execute(num_retries=3)
+            self._labels = {label['name']: label['id'] for label in labels.get('labels', [])}
+        if name not in self._labels and create:
+            label = self.session.users().labels().create(
+                userId='me', body={'name': name}).execute(num_retries=3)
+            self._labels[name] = label['id']
+        return self._labels.get(name)
+
+    def verify_mailboxes(self):
+        for name in ('processed', 'failures'):
+            self.label_id(name, create=True)
+
+    def select(self, mailbox):
+        '''
+        mailboxes are labels. there is no uidvalidity, so None is returned
+        '''
+        self._label = self.label_id(mailbox)
+        if self._label is None:
+            raise Exception(f'unable to select {mailbox}: no such label')
+        return None
+
+    def search(self, criteria):
+        '''
+        the ids of the messages in the selected label matching criteria,
+        oldest first
+        '''
+        query = gmail_query(criteria)
+        msg_ids = []
+        token = None
+        while True:
+            response = self._messages.list(userId='me', labelIds=[self._label], q=query,
+                                            maxResults=500, pageToken=token).execute(num_retries=3)
+            msg_ids.extend(message['id'] for message in response.get('messages', []))
+            token = response.get('nextPageToken')
+            if not token:
+                break
+        # gmail lists the newest first
+        return msg_ids[::-1]
+
+    def history_id(self):
+        '''
+        the mailbox's current history id, where a history sync starts
+        '''
+        if not self.session:
+            self.open_session()
+        return int(self.session.users().getProfile(userId='me').execute(num_retries=3)['historyId'])
+
+    def history(self, start):
+        '''
+        the ids of the messages added to the selected label after history
+        id start, oldest first, and the newest history id. returns None
+        for the ids when start is too old for gmail to still have it.
+        '''
+        if not self.session:
+            self.open_session()
+        msg_ids = {}
+        history_id = start
+        token = None
+        while True:
+            try:
+                response = self.session.users().history().list(
+                    userId='me', startHistoryId=start, labelId=self._label,
+                    historyTypes=['messageAdded'], maxResults=500,
+                    pageToken=token).execute(num_retries=3)
+            except HttpError as e:
+                if e.resp.status == 404:
+                    return None, None
+                raise
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg_ids.setdefault(added['message']['id'])
+            history_id = max(history_id, int(response.get('historyId', history_id)))
+            token = response.get('nextPageToken')
+            if not token:
+                break
+        return list(msg_ids), history_id
+
+    def _get_messages(self, msg_ids, chunk_size, **params):
+        '''
+        yield (id, message resource) for msg_ids with a batch request per
+        chunk. sized by the tuner like imap FETCHes: calls that are rate
+        limited are retried after a backoff with smaller batches, and
+        messages that are gone are skipped.
+        '''
+        msg_ids = list(msg_ids)
+        query = params['format']
+        pos = 0
+        while pos < len(msg_ids):
+            size = min(self.tuner.chunk_size(query, chunk_size), self.batch_limit)
+            chunk = msg_ids[pos:pos + size]
+            responses = {}
+
+            def callback(request_id, response, exception):
+                responses[request_id] = exception or response
+
+            batch = BatchHttpRequest(callback=callback,
+                                     batch_uri=f'{self.api_root}batch/gmail/v1')
+            for msg_id in chunk:
+                batch.add(self._messages.get(userId='me', id=msg_id, **params),
+                          request_id=msg_id)
+            start = time.monotonic()
+            batch.execute()
+            elapsed = time.monotonic() - start
+
+            fetched = []
+            refused = None
+            for msg_id in chunk:
+                response = responses.get(msg_id)
+                if isinstance(response, HttpError):
+                    if response.resp.status in (403, 429) or response.resp.status >= 500:
+                        refused = response
+                        break
+                    current_app.logger.info(f'unable to get message {msg_id}: {response}')
+                    response = None
+                fetched.append((msg_id, response))
+
+            nbytes = sum(len(response.get('raw', '')) + sum(
+                len(header['name']) + len(header['value'])
+                for header in response.get('payload', {}).get('headers', []))
+                for _, response in fetched if response)
+            self.bytes_fetched += nbytes
+            if refused:
+                THROTTLED.labels(account=self.email).inc()
+                if not self.tuner.refused(query):
+                    raise refused
+                current_app.logger.warning(f'batch of {len(chunk)} messages refused: {refused}, '
+                                           f'retrying in {self.tuner.backoff}s')
+            else:
+                self.tuner.succeeded(query, len(chunk), nbytes, elapsed)
+            FETCH_CHUNK_SIZE.labels(account=self.email).set(self.tuner.sizes[query])
+
+            pos += len(fetched)
+            for msg_id, response in fetched:
+                if response:
+                    yield msg_id, response
+
+            if refused:
+                time.sleep(self.tuner.backoff)
+
+    def fetch(self, msg_ids, chunk_size=50):
+        for msg_id, message in self._get_messages(msg_ids, chunk_size, format='raw'):
+            raw = message['raw']
+            data = base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+            yield msg_id, parse_message(data, self.max_part_size)
+
+    def fetch_headers(self, msg_ids, fields, chunk_size=50, structure=True):
+        '''
+        the api has no BODYSTRUCTURE, structure is always None
+        '''
+        for msg_id, message in self._get_messages(msg_ids, chunk_size, format='metadata',
+                                                  metadataHeaders=list(fields)):
+            headers = email.message.Message()
+            for header in message.get('payload', {}).get('headers', []):
+                headers[header['name']] = header['value']
+            yield msg_id, headers, None
+
+    def fetch_parts(self, parts, chunk_size=50):
+        '''
+        the raw message is a single call either way, so it's always
+        fetched whole
+        '''
+        return self.fetch(list(parts), chunk_size)
+
+    def mark_processed(self, msg_id):
+        '''
+        label processed and mark read, buffered until flush
+        '''
+        self._processed.append(msg_id)
+
+    def mark_failed(self, msg_id):
+        '''
+        label failures, buffered until flush
+        '''
+        self._failed.append(msg_id)
+
+    def _modify(self, msg_ids, add=(), remove=()):
+        # batchModify takes up to 1000 ids
+        for i in range(0, len(msg_ids), 1000):
+            self._messages.batchModify(userId='me', body={
+                'ids': msg_ids[i:i + 1000],
+                'addLabelIds': list(add),
+                'removeLabelIds': list(remove),
+            }).execute(num_retries=3)
+
+    def flush(self):
+        '''
+        apply the buffered labels with a batchModify per change
+        '''
+        if not (self._processed or self._failed):
+            return
+
+        if self._processed:
+            self._modify(self._processed, add=[self.label_id('processed', create=True)],
+                         remove=['UNREAD', self.label_id('failures', create=True)])
+        if self._failed:
+            self._modify(self._failed, add=[self.label_id('failures', create=True)])
+
+        current_app.logger.debug(f'marked {len(self._processed)} processed and {len(self._failed)} failed')
+
+        self._processed = []
+        self._failed = []
+
+    def __repr__(self):
+        return f'<GmailAPI user: {self.email}, api: {self.api_root}>'
+
+
+class LocalMail(MailClient):
+    '''
+    mail that is already on disk, e.g. an archive of provider notices
+    being backfilled. there is nothing to connect to so messages are read
+    as fast as they can be parsed. sections and chunk sizes are ignored,
+    reading a whole message locally costs nothing.
+    '''
+    def __init__(self, path):
+        path = os.path.abspath(path)
+        super().__init__('local', path, None, None)
+        self.path = path
+        self.session = None
+        self.uid = False
+        self.bytes_fetched = 0
+        self._headers = email.parser.BytesHeaderParser()
+
+    def __enter__(self):
+        self.open_session()
+        return self
+
+    def __exit__(self, ex_type, ex_value, traceback):
+        self.close_session()
+
+    def verify_mailboxes(self):
+        # processed and failed messages aren't moved anywhere
+        pass
+
+    def open_session(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f'{self.path} does not exist')
+        self.session = self.path
+        return self.session
+
+    def close_session(self):
+        if self.session:
+            self.flush()
+            self.session = None
+
+    @abstractmethod
+    def _message_chunks(self, msg_id):
+        '''
+        yield the raw message PARSE_CHUNK_SIZE bytes at a time
+        '''
+        pass
+
+    @abstractmethod
+    def _header_bytes(self, msg_id):
+        '''
+        the raw header block of the message
+        '''
+        pass
+
+    def _counted(self, chunks):
+        for chunk in chunks:
+            self.bytes_fetched += len(chunk)
+            yield chunk
+
+    def fetch(self, msg_ids, chunk_size=50):
+        for msg_id in msg_ids:
+            chunks = self._counted(self._message_chunks(msg_id))
+            yield msg_id, parse_message(chunks, self.max_part_size)
+
+    def fetch_headers(self, msg_ids, fields, chunk_size=50, structure=True):
+        for msg_id in msg_ids:
+            yield msg_id, self._headers.parsebytes(self._header_bytes(msg_id)), None
+
+    def fetch_parts(self, parts, chunk_size=50):
+        return self.fetch(list(parts), chunk_size)
+
+    def mark_processed(self, msg_id):
+        pass
+
+    def mark_failed(self, msg_id):
+        pass
+
+    def flush(self):
+        pass
+
+    def __repr__(self):
+        return f'<{type(self).__name__} path: {self.path}>'
+
+
+class Mbox(LocalMail):
+    '''
+    an mbox file, or a directory of them named after their mailbox. the
+    file is memory mapped and a message's uid is the offset of its
+    "From " line plus one, so the last processed uid stored by the uid
+    sync mode is where the next run resumes, without rescanning what
+    came before it. the file itself is never rewritten.
+    '''
+    sync_mode = 'uid'
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._file = None
+        self._map = None
+
+    def _unmap(self):
+        if self._map:
+            self._map.close()
+        if self._file:
+            self._file.close()
+        self._file = None
+        self._map = None
+
+    def close_session(self):
+        super().close_session()
+        self._unmap()
+
+    def select(self, mailbox):
+        if not self.session:
+            self.open_session()
+        self._unmap()
+
+        path = self.path
+        if os.path.isdir(path):
+            path = os.path.join(path, mailbox)
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        # an empty file can't be mapped
+        if stat.st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return stat.st_ino
+
+    def _starts(self, offset=0):
+        '''
+        the offsets of the messages starting at or after offset
+        '''
+        mm = self._map
+        if not mm or offset >= len(mm):
+            return
+        if mm[offset:offset + 5] == b'From ' and (offset == 0 or mm[offset - 1] == 0x0a):
+            yield offset
+        position = mm.find(b'\nFrom ', offset)
+        while position != -1:
+            yield position + 1
+            position = mm.find(b'\nFrom ', position + 1)
+
+    def _received(self, start):
+        '''
+        the day the message at start was delivered, from its "From " line
+        or else its Date header. None if neither can be read.
+        '''
+        mm = self._map
+        match = FROM_LINE_DATE.search(mm[start:mm.find(b'\n', start)])
+        if match and match.group(1).decode().upper() in IMAP_MONTHS:
+            month, day, year = match.groups()
+            try:
+                return date(int(year), IMAP_MONTHS.index(month.decode().upper()) + 1, int(day))
+            except ValueError:
+                pass
+        try:
+            headers = self._headers.parsebytes(self._header_bytes(start + 1))
+            return email.utils.parsedate_to_datetime(headers['Date']).date()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def search(self, criteria):
+        '''
+        "UID n:*" finds the messages at or after offset n - 1, and SINCE
+        and BEFORE go by the day a message was delivered like imap's
+        internal date. mbox has no reliable flags so anything else
+        matches every message.
+        '''
+        criteria = criteria if isinstance(criteria, str) else criteria.decode()
+        match = UID_RANGE.search(criteria)
+        offset = int(match.group(1)) - 1 if match else 0
+        starts = self._starts(max(offset, 0))
+
+        dates = {}
+        for key, day, month, year in SEARCH_DATE.findall(criteria):
+            if month.upper() not in IMAP_MONTHS:
+                raise ValueError(f'bad date in {criteria}')
+            dates[key.upper()] = date(int(year), IMAP_MONTHS.index(month.upper()) + 1, int(day))
+        if not dates:
+            return [start + 1 for start in starts]
+
+        uids = []
+        for start in starts:
+            received = self._received(start)
+            # a message of unknown date is kept rather than lost
+            if received and 'SINCE' in dates and received < dates['SINCE']:
+                continue
+            if received and 'BEFORE' in dates and received >= dates['BEFORE']:
+                continue
+            uids.append(start + 1)
+        return uids
+
+    def _bounds(self, msg_id):
+        mm = self._map
+        start = int(msg_id) - 1
+        if not mm or start < 0 or start >= len(mm) or mm[start:start + 5] != b'From ':
+            raise KeyError(f'no message at uid {msg_id}')
+        # the From_ line isn't part of the message
+        body = mm.find(b'\n', start) + 1 or len(mm)
+        end = mm.find(b'\nFrom ', body - 1)
+        end = len(mm) if end == -1 else end + 1
+        return body, end
+
+    def _message_chunks(self, msg_id):
+        body, end = self._bounds(msg_id)
+        for i in range(body, end, PARSE_CHUNK_SIZE):
+            yield self._map[i:min(i + PARSE_CHUNK_SIZE, end)]
+
+    def _header_bytes(self, msg_id):
+        body, end = self._bounds(msg_id)
+        headers = [self._map.find(blank, body - 1, end) for blank in (b'\n\n', b'\n\r\n')]
+        headers = [position for position in headers if position != -1]
+        return self._map[body:min(headers) + 1 if headers else end]
+
+
+class Maildir(LocalMail):
+    '''
+    a Maildir, with other mailboxes in Maildir++ ".name" folders. there
+    are no uids so messages are found by the unseen sync mode; processed
+    messages get the S (seen) flag and failed ones the F (flagged) flag,
+    the same way a mail client marks them.
+    '''
+    sync_mode = 'unseen'
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._root = None
+        self._keys = []
+        self._processed = []
+        self._failed = []
+
+    def select(self, mailbox):
+        if not self.session:
+            self.open_session()
+
+        root = self.path if mailbox.upper() == 'INBOX' else os.path.join(self.path, f'.{mailbox}')
+        keys = []
+        for subdir in ('new', 'cur'):
+            keys.extend((subdir, name) for name in os.listdir(os.path.join(root, subdir))
+                        if not name.startswith('.'))
+        # names start with the delivery time so this is arrival order
+        keys.sort(key=lambda key: key[1])
+        self._root = root
+        self._keys = keys
+        return os.stat(root).st_ino
+
+    @staticmethod
+    def _flags(name):
+        return name.split(':2,', 1)[1] if ':2,' in name else ''
+
+    def search(self, criteria):
+        '''
+        message ids are positions in the selected mailbox like imap
+        sequence numbers. UNSEEN and ALL are understood.
+        '''
+        criteria = criteria if isinstance(criteria, str) else criteria.decode()
+        if 'UID' in criteria.upper():
+            raise ValueError('maildir messages have no uids, use the unseen sync mode')
+        unseen = 'UNSEEN' in criteria.upper()
+        return [i for i, (subdir, name) in enumerate(self._keys, 1)
+                if not unseen or subdir == 'new' or 'S' not in self._flags(name)]
+
+    def _path(self, msg_id):
+        subdir, name = self._keys[int(msg_id) - 1]
+        return os.path.join(self._root, subdir, name)
+
+    def _message_chunks(self, msg_id):
+        with open(self._path(msg_id), 'rb') as f:
+            yield from iter(lambda: f.read(PARSE_CHUNK_SIZE), b'')
+
+    def _header_bytes(self, msg_id):
+        lines = []
+        with open(self._path(msg_id), 'rb') as f:
+            for line in f:
+                if line in (b'\n', b'\r\n'):
+                    break
+                lines.append(line)
+        return b''.join(lines)
+
+    def mark_processed(self, msg_id):
+        self._processed.append(msg_id)
+
+    def mark_failed(self, msg_id):
+        self._failed.append(msg_id)
+
+    def _set_flags(self, msg_id, add='', remove=''):
+        subdir, name = self._keys[int(msg_id) - 1]
+        base = name.split(':2,', 1)[0]
+        flags = ''.join(sorted((set(self._flags(name)) | set(add)) - set(remove)))
+        renamed = f'{base}:2,{flags}'
+        os.rename(self._path(msg_id), os.path.join(self._root, 'cur', renamed))
+        self._keys[int(msg_id) - 1] = ('cur', renamed)
+
+    def flush(self):
+        '''
+        rename the buffered messages into cur with their new flags
+        '''
+        for msg_id in self._processed:
+            self._set_flags(msg_id, add='S', remove='F')
+        for msg_id in self._failed:
+            self._set_flags(msg_id, add='F')
+
+        self._processed = []
+        self._failed = []
+
+
+def local_client(path):
+    '''
+    the client for mail on disk: a Maildir if path has a cur folder,
+    otherwise an mbox file or a directory of them
+    '''
+    if os.path.isdir(os.path.join(path, 'cur')):
+        return Maildir(path)
+    return Mbox(path)
+
+
+class IdleListener(threading.Thread):
+    '''
+    keeps a dedicated connection IDLEing on a mailbox and calls callback
+    whenever new mail arrives. IDLE is restarted every timeout seconds and
+    the connection is re-established with a backoff if it drops.
+    '''
+    def __init__(self, app, client, mailbox, callback, timeout=29 * 60,
+                 max_backoff=300):
+        super().__init__(name=f'idle-{client.email}-{mailbox}', daemon=True)
+        self.app = app
+        self.client = client
+        self.mailbox = mailbox
+        self.callback = callback
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.reconnects = 0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _notify(self):
+        current_app.logger.info(f'new mail in {self.mailbox}, processing')
+        try:
+            self.callback()
+        except Exception:
+            # a processing failure shouldn't tear down the connection
+            current_app.logger.exception(f'processing after IDLE on {self.mailbox} failed')
+
+    def _drop_session(self):
+        try:
+            self.client.session.shutdown()
+        except Exception:
+            pass
+        self.client.session = None
+
+    def run(self):
+        backoff = 1
+        with self.app.app_context():
+            while not self._stop_event.is_set():
+                try:
+                    if not self.client.session:
+                        self.client.open_session()
+                        self.client.select(self.mailbox)
+                    if self.client.idle(self.timeout):
+                        self._notify()
+                    backoff = 1
+                except Exception as e:
+                    # select raises a plain Exception, and a thread that
+                    # dies here stops listening for good
+                    current_app.logger.warning(f'IDLE on {self.mailbox} failed: {e}, reconnecting in {backoff}s')
+                    self._drop_session()
+                    self.reconnects += 1
+                    self._stop_event.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+
+            if self.client.session:
+                self._drop_session()
+
+
+class ConnectionManager:
+    '''
+    keeps one logged in client per account open for the life of the
+    process so that every run doesn't pay for a TLS handshake and LOGIN.
+    a client is checked with NOOP before it is handed out and replaced
+    if the connection has died.
+    '''
+    def __init__(self, keepalive=300):
+        self.keepalive = keepalive
+        self.clients = {}
+        self.opened = {}
+        self.used = {}
+        self.reconnects = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def _lock_for(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _account(self, key):
+        return '/'.join(str(part) for part in key)
+
+    def _healthy(self, client):
+        try:
+            return client.session.noop()[0] == 'OK'
+        except (imaplib.IMAP4.error, OSError):
+            return False
+
+    def _discard(self, key):
+        client = self.clients.get(key)
+        if client and client.session:
+            try:
+                client.session.shutdown()
+            except Exception:
+                pass
+            client.session = None
+
+    def _checkout(self, key, factory):
+        client = self.clients.get(key)
+        if client and client.session:
+            if self._healthy(client):
+                return client
+
+            current_app.logger.warning(f'connection for {self._account(key)} is dead, reconnecting')
+
+            self._discard(key)
+            self.reconnects[key] = self.reconnects.get(key, 0) + 1
+            RECONNECTS.labels(account=self._account(key)).inc()
+
+        if not client:
+            client = factory()
+            self.clients[key] = client
+
+        client.open_session()
+        self.opened[key] = time.monotonic()
+        return client
+
+    @contextmanager
+    def connection(self, key, factory):
+        '''
+        hand out the client for key, creating it with factory the first
+        time. the client is reserved until the with block exits.
+        '''
+        with self._lock_for(key):
+            client = self._checkout(key, factory)
+            try:
+                yield client
+            except (imaplib.IMAP4.abort, OSError):
+                self._discard(key)
+                raise
+            finally:
+                self.used[key] = time.monotonic()
+                CONNECTION_AGE.labels(account=self._account(key)).set(self.age(key))
+
+    def age(self, key):
+        client = self.clients.get(key)
+        if not (client and client.session):
+            return 0
+        return time.monotonic() - self.opened[key]
+
+    def keepalive_all(self):
+        '''
+        NOOP every connection that hasn't been used for keepalive seconds
+        so the server doesn't drop it between runs. busy connections are
+        skipped, they are obviously alive.
+        '''
+        now = time.monotonic()
+        for key in list(self.clients):
+            lock = self._lock_for(key)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                client = self.clients[key]
+                if not client.session:
+                    continue
+                if now - self.used.get(key, 0) >= self.keepalive:
+                    if self._healthy(client):
+                        self.used[key] = now
+                    else:
+                        current_app.logger.info(f'connection for {self._account(key)} died while idle')
+                        self._discard(key)
+                CONNECTION_AGE.labels(account=self._account(key)).set(self.age(key))
+            finally:
+                lock.release()
+
+    def close_all(self):
+        for key in list(self.clients):
+            with self._lock_for(key):
+                self.clients[key].close_session()
@@ -0,0 +1,99 @@
+'''
+the decoded parts of an email, shared by the providers' parse methods,
+the duplicate check and the failure ledger so that each message is
+walked and decoded once, whichever provider it was routed to.
+'''
+from app.Router import header_text
+
+
+class MessageView:
+    '''
+    an email with its parts decoded on first use. the parts are decoded
+    by their Content-Transfer-Encoding and charset, and the first part of
+    each content type is the one text, html and calendar use.
+    '''
+
+    def __init__(self, email):
+        self.email = email
+        self._values = {}
+
+    @classmethod
+    def of(cls, email):
+        '''
+        the view of email, which may already be one
+        '''
+        return email if isinstance(email, cls) else cls(email)
+
+    def _cached(self, name, read):
+        '''
+        what read returns, worked out the first time name is asked for
+        '''
+        if name not in self._values:
+            self._values[name] = read()
+        return self._values[name]
+
+    @property
+    def payloads(self):
+        '''
+        (part, bytes) for every part that isn't multipart, in order
+        '''
+        return self._cached('payloads', lambda: [
+            (part, part.get_payload(decode=True) or b'')
+            for part in self.email.walk() if not part.is_multipart()])
+
+    @property
+    def texts(self):
+        '''
+        (content type, text) for every text part, in order
+        '''
+        return self._cached('texts', lambda: [
+            (part.get_content_type(), decode(part, payload))
+            for part, payload in self.payloads
+            if part.get_content_type().startswith('text/')])
+
+    def payload(self, content_type):
+        '''
+        the bytes of the first part of content_type, or None
+        '''
+        for part, payload in self.payloads:
+            if part.get_content_type() == content_type:
+                return payload
+        return None
+
+    def decoded(self, content_type):
+        '''
+        the text of the first part of content_type, or None
+        '''
+        for part_type, text in self.texts:
+            if part_type == content_type:
+                return text
+        return None
+
+    @property
+    def subject(self):
+        '''
+        the decoded subject with its folding and extra spaces collapsed
+        '''
+        return self._cached('subject', lambda: ' '.join(
+            header_text(self.email['Subject'] or '').split()))
+
+    @property
+    def text(self):
+        return self.decoded('text/plain')
+
+    @property
+    def html(self):
+        return self.decoded('text/html')
+
+    @property
+    def calendar(self):
+        return self.payload('text/calendar')
+
+
+def decode(part, payload):
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        # a charset python doesn't know
+        return payload.decode('utf-8', 'replace')
@@ -4,22 +4,23 @@ all available providers
 from abc import ABCMeta, abstractmethod, abstractproperty
 import requests
 import json
-import icalendar
-import base64
+import io
 from flask import current_app
-import pandas as pd
-import bs4
+import lxml.html
+from lxml import etree
 import re
 import datetime
 import pytz
 import dateutil.parser as parser
 import time
 from prometheus_client import Counter, Gauge
-import quopri
 
 from app.models import Maintenance, Circuit, MaintCircuit, MaintUpdate
 from app.models import Provider as Pro # don't conflict with the class below
 from app import db, registry
+from app import maintnote
+from app.MessageView import MessageView
+from app.Router import SubjectRules
 
 from app.jobs.started import FUNCS as started_funcs
 from app.jobs.ended import FUNCS as ended_funcs
@@ -60,6 +61,10 @@ class Provider(metaclass=ABCMeta):
     this is a provider that DOES NOT implement the MAINTNOTE standard and
     needs to have a custom class defined to parse their messages
     '''
+    # the content types process() looks at. the mail client only downloads
+    # these parts of a message, None means the whole message is needed.
+    content_types = None
+
     def __init__(self):
         self.name = 'Provider'
 
@@ -68,29 +73,49 @@ class Provider(metaclass=ABCMeta):
         '''
         this is how you know that a maintenance email is from this provider.
         For instance, a sender is maints@example.com.
-        they should all end with UNSEEN so the mail client only looks at
-        unseen messages. A full list of search critera is here:
-        https://gist.github.com/martinrusev/6121028
+        it is written as imap search criteria, but messages are routed
+        locally by app.Router, which understands the FROM, TO, CC, BCC,
+        SUBJECT and HEADER keys. UNSEEN is accepted and ignored since
+        the run itself decides which messages are new.
         '''
         pass
 
 
+    def parse(self, email):
+        '''
+        the cpu heavy half of processing: turn the email into the plain
+        data apply needs. it may run in another process (see PARSE_WORKERS)
+        on a provider whose __init__ never ran, so it must not touch the db,
+        the app or self beyond helpers like clean_line, and whatever it
+        returns must be picklable. email is an email or its MessageView,
+        MessageView.of gives the decoded parts either way.
+        '''
+        return None
+
     @abstractmethod
-    def process(self, email):
+    def apply(self, email, parsed):
         '''
-        this method is sent an email object that is able to be parsed and
-        processed. It should return True if the message was processed correctly
-        and False if it wasn't. "process" means correctly inserting or updating
-        the maintenance in the db.
+        this method is sent an email object, or its MessageView, and what
+        parse returned for it. It should return True if the message was
+        processed correctly and False if it wasn't. "process" means correctly
+        inserting or updating the maintenance in the db.
         '''
         pass
 
+    def process(self, email):
+        '''
+        parse and apply an email in one go
+        '''
+        return self.apply(email, self.parse(email))
+
 
 class StandardProvider(Provider):
     '''
     this class of provider follows the MAINTNOTE standard as defined
     here: https://github.com/jda/maintnote-std/blob/master/standard.md
     '''
+    content_types = ('text/calendar',)
+
     def __init__(self):
         super().__init__()
 
@@ -106,7 +131,7 @@ class StandardProvider(Provider):
     
     def add_circuit(self, cid):
         '''
-        add a circuit to the db if it doesn't already exist
+        add a circuit to the session if it doesn't already exist
         '''
         current_app.logger.info(f'adding {self.name} circuit {cid} to db')
 
@@ -115,37 +140,43 @@ class StandardProvider(Provider):
         provider = Pro.query.filter_by(name=self.name,
                                    type=self.type).first()
         circuit.provider_id = provider.id
-        self.add_and_commit(circuit)
+        db.session.add(circuit)
 
-        current_app.logger.info(f'{cid} added successfully to db')
+        return circuit
 
 
-    def add_new_maint(self, email, cal):
+    def add_new_maint(self, email, cal, maints):
         '''
-        add a new maintenance to the db
+        add a new maintenance to the session. the VEVENTs of one calendar
+        that share a maintenance id are windows of the same maintenance,
+        so after the first one only the circuit rows for its date are added.
         email: email.email object
-        cal: icalendar object
+        cal: the VEVENT's properties, see app.maintnote
+        maints: the maintenances added from this calendar by id
         '''
-        maint = Maintenance()
-        maint.provider_maintenance_id = cal['X-MAINTNOTE-MAINTENANCE-ID'] \
-                                        .strip()
-
-        current_app.logger.info(f'adding {maint.provider_maintenance_id} to db')
-
-        maint.start = cal['DTSTART'].dt.time()
-        maint.end = cal['DTEND'].dt.time()
-        maint.timezone = cal['DTSTART'].dt.tzname()
-        # not all ics attachments have descriptions
-        if cal.get('DESCRIPTION'):
-            maint.reason = cal['DESCRIPTION'].strip()
-        received = email['Received'].splitlines()[-1].strip()
-        maint.received_dt = parser.parse(received)
-
-        self.add_and_commit(maint)
-
-        current_app.logger.info(f'added {maint.provider_maintenance_id} successfully')
-
-        NEW_PARENT_MAINT.labels(provider=self.name).inc()
+        maint_id = cal['X-MAINTNOTE-MAINTENANCE-ID'].strip()
+        maint = maints.get(maint_id)
+
+        if maint is None:
+            current_app.logger.info(f'adding {maint_id} to db')
+
+            maint = Maintenance()
+            maint.provider_maintenance_id = maint_id
+            maint.start = cal['DTSTART'].time()
+            maint.end = cal['DTEND'].time()
+            maint.timezone = cal['DTSTART'].tzname()
+            # not all ics attachments have descriptions
+            if cal.get('DESCRIPTION'):
+                maint.reason = cal['DESCRIPTION'].strip()
+            received = email['Received'].splitlines()[-1].strip()
+            maint.received_dt = parser.parse(received)
+
+            db.session.add(maint)
+            maints[maint_id] = maint
+
+            NEW_PARENT_MAINT.labels(provider=self.name).inc()
+        else:
+            current_app.logger.info(f'adding a window on {cal["DTSTART"].date()} to {maint_id}')
 
         cids = []
 
@@ -159,60 +190,57 @@ class StandardProvider(Provider):
             cids.append(cal['X-MAINTNOTE-OBJECT-ID'])
 
         for cid in cids:
-            if not Circuit.query.filter_by(provider_cid=cid).first():
-                self.add_circuit(cid)
-
             circuit_row = Circuit.query.filter_by(provider_cid=cid).first()
-            maint_row = Maintenance.query.filter_by(
-                provider_maintenance_id=maint.provider_maintenance_id,
-                rescheduled=0).first()
-            mc = MaintCircuit(impact=cal['X-MAINTNOTE-IMPACT'].strip(),
-                 date=cal['DTSTART'].dt.date())
-            circuit_row.maintenances.append(mc)
-            mc.maint_id = maint_row.id
-            db.session.commit()
+            if not circuit_row:
+                circuit_row = self.add_circuit(cid)
+
+            MaintCircuit(impact=cal['X-MAINTNOTE-IMPACT'].strip(),
+                         date=cal['DTSTART'].date(),
+                         maintenance=maint, circuit=circuit_row)
             NEW_CID_MAINT.labels(cid=cid).inc()
 
         return True
 
 
+    def get_maintenance(self, cal):
+        return Maintenance.query.filter_by(
+            provider_maintenance_id=cal['X-MAINTNOTE-MAINTENANCE-ID'],
+            rescheduled=0).first()
+
+
     def add_cancelled_maint(self, email, cal):
         '''
         add a maintenance cancellation to the maintenance row
         email: email.email object
-        cal: icalendar object
+        cal: the VEVENT's properties, see app.maintnote
         '''
 
         current_app.logger.info(f'cancelling maintenance from email {email["Subject"]}')
 
-        maint = Maintenance.query.filter_by(
-            provider_maintenance_id=cal['X-MAINTNOTE-MAINTENANCE-ID'],
-            rescheduled=0).first()
+        maint = self.get_maintenance(cal)
 
         if not maint:
             return False
 
         maint.cancelled = 1
 
-        self.add_and_commit(maint)
-
-        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} cancelled successfully')
+        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} cancelled')
 
         return True
 
-    def add_start_maint(self, email, cal):
+    def add_start_maint(self, email, cal, hooks):
         '''
         change the maintenance started column from 0 to 1.
         not all providers send an email when a maintenance starts.
         email: email.email object
-        cal: icalendar object
+        cal: the VEVENT's properties, see app.maintnote
+        hooks: the functions and in progress change to apply once the
+               calendar is committed
         '''
 
         current_app.logger.info(f'attempting to mark start maintenance')
 
-        maint = Maintenance.query.filter_by(
-            provider_maintenance_id=cal['X-MAINTNOTE-MAINTENANCE-ID'],
-            rescheduled=0).first()
+        maint = self.get_maintenance(cal)
 
         if not maint:
             return False
@@ -222,44 +250,34 @@ class StandardProvider(Provider):
 
         maint.started = 1
 
-        self.add_and_commit(maint)
-
-        IN_PROGRESS.labels(provider=self.name).inc()
+        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} started')
 
-        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} started successfully')
-
-        for func in started_funcs:
-            func(email=email, maintenance=maint)
+        hooks.append((started_funcs, maint, 1))
 
         return True
 
 
-    def add_end_maint(self, email, cal):
+    def add_end_maint(self, email, cal, hooks):
         '''
         change the maintenance ended column from 0 to 1
         email: email.email object
-        cal: icalendar object
+        cal: the VEVENT's properties, see app.maintnote
+        hooks: the functions and in progress change to apply once the
+               calendar is committed
         '''
 
         current_app.logger.info(f'attempting to mark end maintenance')
 
-        maint = Maintenance.query.filter_by(
-            provider_maintenance_id=cal['X-MAINTNOTE-MAINTENANCE-ID'],
-            rescheduled=0).first()
-        
+        maint = self.get_maintenance(cal)
+
         if not maint:
             return False
 
         maint.ended = 1
 
-        IN_PROGRESS.labels(provider=self.name).dec()
-
-        self.add_and_commit(maint)
+        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} ended')
 
-        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} ended successfully')
-
-        for func in ended_funcs:
-            func(email=email, maintenance=maint)
+        hooks.append((ended_funcs, maint, -1))
 
         return True
 
@@ -268,9 +286,7 @@ class StandardProvider(Provider):
 
         current_app.logger.info(f'attempting to update maintenance')
 
-        maint = Maintenance.query.filter_by(
-            provider_maintenance_id=cal['X-MAINTNOTE-MAINTENANCE-ID'],
-            rescheduled=0).first()
+        maint = self.get_maintenance(cal)
 
         if not maint:
             return False
@@ -278,69 +294,89 @@ class StandardProvider(Provider):
         u = MaintUpdate(maintenance_id=maint.id, comment=cal['DESCRIPTION'],
             updated=datetime.datetime.now())
 
-        self.add_and_commit(u)
+        db.session.add(u)
 
-        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} updated successfully')
+        current_app.logger.info(f'maintenance {maint.provider_maintenance_id} updated')
 
         return True
 
     
-    def process(self, email):
+    def parse(self, email):
+        '''
+        the properties of every VEVENT of the email's calendar
+        '''
+        calendar = MessageView.of(email).calendar
+        if not calendar:
+            return None
 
-        current_app.logger.info(f'attempting to process email {email["Subject"]}')
+        return maintnote.events(calendar) or None
 
-        msg = None
-        info = None
+    def apply_event(self, email, info, maints, hooks):
+        '''
+        apply one VEVENT, see apply
+        '''
         result = False
-        for part in email.walk():
-            if part.get_content_type().startswith('multipart'):
-                for subpart in part.get_payload():
-                    if subpart.get_content_type() == 'text/calendar':
-                        try:
-                            # some payloads are base64 encoded...
-                            msg = base64.b64decode(subpart.get_payload())
-                            msg = icalendar.Calendar.from_ical(msg)
-                        except ValueError:
-                            # ... and some aren't
-                            msg = subpart.get_payload()
-                            msg = icalendar.Calendar.from_ical(msg)
-                        break
-        
-        if not msg:
-            return False
-
-        for event in msg.subcomponents:
-            if event.name == 'VEVENT':
-                info = event
-
-        if not info:
-            return False
 
         if not info.get('X-MAINTNOTE-STATUS'):
             if info.get('SUMMARY'):
                 if 'completed' in info.get('SUMMARY'):
-                    result = self.add_end_maint(email, info)
+                    result = self.add_end_maint(email, info, hooks)
             else:
                 return False
 
 
         elif info['X-MAINTNOTE-STATUS'].lower() in ['confirmed', 'tentative']:
-            result = self.add_new_maint(email, info)
+            result = self.add_new_maint(email, info, maints)
 
         elif info['X-MAINTNOTE-STATUS'].lower() == 'cancelled':
             result = self.add_cancelled_maint(email, info)
 
         elif info['X-MAINTNOTE-STATUS'].lower() == 'in-process':
-            result = self.add_start_maint(email, info)
+            result = self.add_start_maint(email, info, hooks)
 
         elif info['X-MAINTNOTE-STATUS'].lower() == 'completed':
-            result = self.add_end_maint(email, info)
+            result = self.add_end_maint(email, info, hooks)
 
         elif info['SEQUENCE'] > 0:
             result = self.update(email, info)
 
+        return result
+
+    def apply(self, email, events):
+        '''
+        apply every VEVENT of the calendar and commit them together, so a
+        notice with several windows is one transaction. if any event can't
+        be applied nothing is committed and the result is False, so a retry
+        of the message starts from scratch. the in progress gauge and the
+        started and ended functions are only run after the commit, once
+        for each maintenance even when several of its windows end.
+        '''
+        email = MessageView.of(email).email
+
+        current_app.logger.info(f'attempting to process email {email["Subject"]}')
+
+        if not events:
+            return False
+
+        maints = {}
+        hooks = []
+        results = [self.apply_event(email, info, maints, hooks) for info in events]
+        result = all(results)
+
+        if not result:
+            db.session.rollback()
+            current_app.logger.info(f'{results.count(False)} of {len(events)} events could not be applied, nothing was changed')
+            return False
+
+        db.session.commit()
+
+        unique = {(id(funcs), maint.id): (funcs, maint, step) for funcs, maint, step in hooks}
+        for funcs, maint, step in unique.values():
+            IN_PROGRESS.labels(provider=self.name).inc(step)
+            for func in funcs:
+                func(email=email, maintenance=maint)
 
-        current_app.logger.info(f'process result: {result}')
+        current_app.logger.info(f'process result: {result} for {len(events)} events')
 
         return result
 
@@ -395,10 +431,56 @@ class EUNetworks(StandardProvider):
         return b'(SUBJECT "eunetworks" UNSEEN)'
 
 
+HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def html_tree(payload):
+    '''
+    the lxml tree of an html body. providers that only read a few elements
+    take them from this with xpath instead of building a BeautifulSoup of
+    the whole body. a body with nothing in it is an empty html element.
+    '''
+    try:
+        # as bytes, lxml refuses strings with an encoding declaration
+        return lxml.html.document_fromstring(payload.encode('utf-8', 'replace'),
+                                             parser=HTML_PARSER)
+    except etree.ParserError:
+        return lxml.html.Element('html')
+
+
+def table_rows(table):
+    '''
+    the rows of an lxml html table as tuples of cell text, read the way
+    pandas.read_html reads them: header rows, those in the thead and the
+    leading rows made only of th cells, are left out, whitespace is
+    collapsed, and empty or missing cells are None.
+    '''
+    body = table.xpath('tr | tbody/tr | tfoot/tr')
+    while body and all(cell.tag == 'th' for cell in body[0].xpath('td | th')):
+        body.pop(0)
+
+    cells = [[' '.join(cell.text_content().split()) or None
+              for cell in tr.xpath('td | th')] for tr in body]
+    width = max((len(row) for row in cells), default=0)
+    return [tuple(row) + (None,) * (width - len(row)) for row in cells if row]
+
+
 class Zayo(Provider):
     '''
     zayo seems to use salesforce and mostly uses templates 
     '''
+    content_types = ('text/html',)
+
+    subject_rules = SubjectRules('zayo', [
+        ('new', r'^\*\*\*.*(?i:maintenance notification)', 'add_new_maint'),
+        ('reschedule', r'^(?i:reschedule notification)', 'add_reschedule_maint'),
+        ('start', r'^(?i:start maintenance notification)', 'add_start_maint'),
+        ('end', r'^(?i:completed maintenance notification|end of window)', 'add_end_maint'),
+        ('cancelled', r'^(?i:cancelled notification)', 'add_cancelled_maint'),
+        ('extension', r'^(?=.*TTN-).*(?i:exten)', 'update'),
+        ('update', r'^(?=.*TTN-).*(?i:maintenance notification)', 'update'),
+    ])
+
     def __init__(self):
         super().__init__()
         self.name = 'zayo'
@@ -422,14 +504,25 @@ class Zayo(Provider):
 
 
     def format_circuit_table(self, table):
-        ptable = pd.read_html(str(table))
+        '''
+        the circuit table's rows as tuples. columns:
+        ['Circuit Id', 'Expected Impact',
+        'A Location CLLI', 'Z Location CLLI',
+        'Legacy Circuit Id']
+        a table with merged cells is left to pandas, which is only
+        imported for it since it is slow to import and large in memory.
+        '''
+        if table.xpath('.//table'):
+            raise ParsingError('the circuit table has a table inside it')
+
+        if not table.xpath('.//*[@colspan or @rowspan]'):
+            return table_rows(table)
+
+        import pandas as pd
+        ptable = pd.read_html(io.StringIO(etree.tostring(table, encoding='unicode')))
         assert len(ptable) == 1
-        ptable = ptable[0]
-        # columns:
-        # ['Circuit Id', 'Expected Impact',
-        # 'A Location CLLI', 'Z Location CLLI',
-        # 'Legacy Circuit Id']
-        return ptable
+        return [tuple(None if pd.isna(value) else value for value in row)
+                for row in ptable[0].values.tolist()]
 
 
     def add_and_commit(self, row):
@@ -438,16 +531,15 @@ class Zayo(Provider):
 
 
     
-    def get_maintenance(self, soup):
+    def get_maintenance(self, notice):
         '''
         for pulling the id out and returning the maintenance row
         '''
         maint_id = None
-        for line in soup.find_all('b'):
-            if type(line) == bs4.element.Tag:
-                if line.text.lower().strip().startswith('maintenance ticket'):
-                    maint_id = self.clean_line(line.next_sibling)
-                    break
+        for text, sibling in notice['fields']:
+            if text.lower().strip().startswith('maintenance ticket'):
+                maint_id = self.clean_line(sibling)
+                break
 
         if maint_id:
             maint_id = Maintenance.query.filter_by(
@@ -456,11 +548,11 @@ class Zayo(Provider):
         return maint_id
 
 
-    def add_start_maint(self, soup, email):
+    def add_start_maint(self, notice, email):
 
         current_app.logger.info(f'attempting to mark start maintenance')
 
-        maint = self.get_maintenance(soup)
+        maint = self.get_maintenance(notice)
 
         if not maint:
             return False
@@ -483,11 +575,11 @@ class Zayo(Provider):
         return True
 
     
-    def add_end_maint(self, soup, email):
+    def add_end_maint(self, notice, email):
 
         current_app.logger.info(f'attempting to mark end maintenance')
 
-        maint = self.get_maintenance(soup)
+        maint = self.get_maintenance(notice)
 
         if not maint:
             return False
@@ -512,11 +604,11 @@ class Zayo(Provider):
         return True
 
 
-    def add_cancelled_maint(self, soup, email):
+    def add_cancelled_maint(self, notice, email):
 
         current_app.logger.info(f'attempting to mark cancelled maintenance')
 
-        maint = self.get_maintenance(soup)
+        maint = self.get_maintenance(notice)
 
         if not maint:
             return False
@@ -530,7 +622,7 @@ class Zayo(Provider):
         return True
 
 
-    def add_reschedule_maint(self, soup, email):
+    def add_reschedule_maint(self, notice, email):
         '''
         zayo sends reschedule emails so we're able to identified_by
         a new maintenance that references an old one
@@ -538,10 +630,10 @@ class Zayo(Provider):
 
         current_app.logger.info(f'attempting to mark maintenance rescheduled')
         
-        old_maint = self.get_maintenance(soup)
+        old_maint = self.get_maintenance(notice)
 
         if not old_maint:
-            self.add_new_maint(soup, email)
+            self.add_new_maint(notice, email)
             return True
 
         old_maint.rescheduled = 1
@@ -551,7 +643,7 @@ class Zayo(Provider):
 
         time.sleep(5)
 
-        self.add_new_maint(soup, email)
+        self.add_new_maint(notice, email)
 
         new_maint = Maintenance.query.filter_by(
             provider_maintenance_id=old_maint.provider_maintenance_id,
@@ -566,68 +658,67 @@ class Zayo(Provider):
 
         return True
 
-    def add_new_maint(self, soup, email):
+    def add_new_maint(self, notice, email):
         '''
-        zayo bolds the relevant fields so we use bs4 to search for those
-        and then get the next sibling
+        zayo bolds the relevant fields so parse keeps the text of those
+        tags and of their next siblings
         '''
 
         current_app.logger.info(f'attempting to add new maint from email {email["Subject"]}')
         
-        table = soup.find('table')
-        if not table:
-            subject = email['Subject']
+        if not notice['has_table']:
             return False
+        if notice['circuits'] is None:
+            raise ParsingError(f'unable to parse the zayo circuit table: {email["Subject"]}')
         maint = Maintenance()
 
         dates = []
 
-        for line in soup.find_all('b'):
-            if type(line) == bs4.element.Tag:
-                if line.text.lower().strip().endswith('activity date:'):
-                    dt = parser.parse(self.clean_line(line.next_sibling))
-                    t = datetime.date(dt.year, dt.month, dt.day)
-                    dates.append(t)
-                if line.text.lower().strip().startswith('maintenance ticket'):
-                    maint.provider_maintenance_id = self.clean_line(
-                                                      line.next_sibling)
-                # elif 'urgency' in line.text.lower():
-                #    row_insert['urgency'] = self.clean_line(line.next_sibling)
-
-                elif 'location of maintenance' in line.text.lower():
-                    maint.location = self.clean_line(
-                                             line.next_sibling)
-
-                elif 'maintenance window' in line.text.lower():
-                    window = line.next_sibling.strip().split('-')
-                    window = [time.strip() for time in window]
-                    start = window.pop(0)
-                    start = parser.parse(start)
-                    maint.start = datetime.time(start.hour, start.minute)
-                    window = window[0].split()
-                    end = window.pop(0)
-                    end = parser.parse(end)
-                    maint.end = datetime.time(end.hour, end.minute)
-
-                    if len(window) == 1:
-                        if current_app.config['TZ_PREFIX']:
-                            # zayo will send timezones such as "Eastern"
-                            # instead of "US/Eastern" so the tzinfo
-                            # may not be able to be parsed without a prefix
-                            tz = window.pop()
-                            pfx = current_app.config['TZ_PREFIX']
-                            if tz != 'GMT':
-                                maint.timezone = pfx + tz
-                            else:
-                                maint.timezone = tz
+        for text, sibling in notice['fields']:
+            if text.lower().strip().endswith('activity date:'):
+                dt = parser.parse(self.clean_line(sibling))
+                t = datetime.date(dt.year, dt.month, dt.day)
+                dates.append(t)
+            if text.lower().strip().startswith('maintenance ticket'):
+                maint.provider_maintenance_id = self.clean_line(
+                                                  sibling)
+            # elif 'urgency' in text.lower():
+            #    row_insert['urgency'] = self.clean_line(sibling)
+
+            elif 'location of maintenance' in text.lower():
+                maint.location = self.clean_line(
+                                         sibling)
+
+            elif 'maintenance window' in text.lower():
+                window = sibling.strip().split('-')
+                window = [time.strip() for time in window]
+                start = window.pop(0)
+                start = parser.parse(start)
+                maint.start = datetime.time(start.hour, start.minute)
+                window = window[0].split()
+                end = window.pop(0)
+                end = parser.parse(end)
+                maint.end = datetime.time(end.hour, end.minute)
+
+                if len(window) == 1:
+                    if current_app.config['TZ_PREFIX']:
+                        # zayo will send timezones such as "Eastern"
+                        # instead of "US/Eastern" so the tzinfo
+                        # may not be able to be parsed without a prefix
+                        tz = window.pop()
+                        pfx = current_app.config['TZ_PREFIX']
+                        if tz != 'GMT':
+                            maint.timezone = pfx + tz
                         else:
-                            maint.timezone = window.pop()
+                            maint.timezone = tz
                     else:
-                        # failsafe
-                        maint.timezone = ' '.join(window)
+                        maint.timezone = window.pop()
+                else:
+                    # failsafe
+                    maint.timezone = ' '.join(window)
 
-                elif 'reason for maintenance' in line.text.lower():
-                    maint.reason = self.clean_line(line.next_sibling)
+            elif 'reason for maintenance' in text.lower():
+                maint.reason = self.clean_line(sibling)
 
         received = email['Received'].splitlines()[-1].strip()
         maint.received_dt = parser.parse(received)
@@ -638,22 +729,15 @@ class Zayo(Provider):
 
         NEW_PARENT_MAINT.labels(provider=self.name).inc()
 
-        cid_table = self.format_circuit_table(table)
-        for row in cid_table.values:
+        for row in notice['circuits']:
             if not Circuit.query.filter_by(provider_cid=row[0]).first():
 
                 current_app.logger.info(f'adding circuit {row[0]}')
 
                 circuit = Circuit()
                 circuit.provider_cid = row[0]
-                if str(row[2]) == 'nan':
-                    circuit.a_side = None
-                else:
-                    circuit.a_side = row[2]
-                if str(row[3]) == 'nan':
-                    circuit.z_side = None
-                else:
-                    circuit.z_side = row[3]
+                circuit.a_side = row[2]
+                circuit.z_side = row[3]
                 this = Pro.query.filter_by(name=self.name,
                                            type=self.type).first()
                 circuit.provider_id = this.id
@@ -680,7 +764,7 @@ class Zayo(Provider):
         return True
 
 
-    def update(self, soup, email):
+    def update(self, notice, email):
         current_app.logger.info(f'attempting to update a zayo ticket')
         match = re.search('TTN-\d+', email['Subject'])
         if not match:
@@ -697,7 +781,7 @@ class Zayo(Provider):
             assert len(maint) == 1, 'More than one maint returned!'
             maint = maint[0]
 
-            u = MaintUpdate(maintenance_id=maint.id, comment=self.clean_line(soup.text),
+            u = MaintUpdate(maintenance_id=maint.id, comment=self.clean_line(notice['text']),
             updated=datetime.datetime.now())
 
             self.add_and_commit(u)
@@ -709,54 +793,85 @@ class Zayo(Provider):
 
         return False
 
-    def process(self, email):
+    def parse(self, email):
+        '''
+        zayo bolds the relevant fields, so the text of every bold tag and
+        of whatever follows it is kept along with the circuit table rows.
+        only those are read out of the lxml tree, the whole text is kept
+        for updates.
+        '''
+        html = MessageView.of(email).html
+        if html is None:
+            return None
+
+        tree = html_tree(html)
+
+        fields = []
+        for line in tree.iter('b'):
+            # the text after the tag, or the next tag if there is none
+            sibling = line.tail
+            if sibling is None and line.getnext() is not None:
+                sibling = etree.tostring(line.getnext(), encoding='unicode', with_tail=False)
+            fields.append((line.text_content(), sibling))
+
+        table = next(tree.iter('table'), None)
+        circuits = None
+        if table is not None:
+            try:
+                circuits = self.format_circuit_table(table)
+            except Exception:
+                # only a new maintenance needs the table, it fails there
+                pass
+
+        return {'fields': fields, 'has_table': table is not None,
+                'circuits': circuits, 'text': tree.text_content()}
+
+    def apply(self, email, notice):
+        view = MessageView.of(email)
+        email = view.email
 
         current_app.logger.info(f'attempting to process email {email["Subject"]}')
 
-        msg = None
         result = False
 
-        for part in email.walk():
-            if part.get_content_type() == 'text/html':
-                msg = part
-                break
-
-        if not msg:
+        if not notice:
             return False
 
-        soup = bs4.BeautifulSoup(msg.get_payload(), features="lxml")
-
-        if (email['Subject'].startswith('***') and
-            'maintenance notification' in self.clean_line(email['Subject'].lower())):
-            result = self.add_new_maint(soup, email)
-
-        elif email['Subject'].lower().startswith('reschedule notification'):
-            result = self.add_reschedule_maint(soup, email)
-
-        elif email['Subject'].lower().startswith('start maintenance notification'):
-            result = self.add_start_maint(soup, email)
-
-        elif email['Subject'].lower().startswith('completed maintenance notification') or \
-        email['Subject'].lower().startswith('end of window'):
-            result = self.add_end_maint(soup, email)
-
-        elif email['Subject'].lower().startswith('cancelled notification'):
-            result = self.add_cancelled_maint(soup, email)
-
-        elif 'TTN-' in email['Subject'] and 'exten' in email['Subject'].lower():
-            result = self.update(soup, email)
-        elif 'TTN-' in email['Subject'] and 'maintenance notification' in email['Subject'].lower():
-            result = self.update(soup, email)
+        rule = self.subject_rules.match(view.subject)
+        if rule:
+            result = getattr(self, rule.action)(notice, email)
 
         current_app.logger.info(f'result: {result}')
 
         return result
 
 
+# each field is its own compiled search: a literal prefix lets re skip
+# straight to it, which beats one scan with an alternation of all of them
+GTT_MAINT_ID = re.compile(r'#\((\d+)')
+GTT_FIELDS = {
+    field.lower(): re.compile(field + r': ([^\r\n]*)[\r\n]')
+    for field in ('Start', 'End', 'Location', 'Reason', 'Impact')
+}
+GTT_SERVICE = re.compile(r'GTT Service = (.+);')
+# searched with a newline in front of the text so that every line,
+# including the first, starts after a literal newline
+GTT_A_SIDE = re.compile(r'\n(?i:site address[^\n]*?|location )= ([^\r\n]*)')
+
+
 class GTT(Provider):
     '''
     GTT
     '''
+    content_types = ('text/html',)
+
+    subject_rules = SubjectRules('gtt', [
+        ('announcement', '(?i:work announcement)', 'add_new_maint'),
+        ('conclusion', '(?i:work conclusion)', 'add_end_maint'),
+        ('cancellation', '(?i:work cancellation)', 'add_cancelled_maint'),
+        ('ticket', '(?i:gtt tt#)', 'update'),
+    ])
+
     def __init__(self):
         super().__init__()
         self.name = 'gtt'
@@ -775,7 +890,7 @@ class GTT(Provider):
         db.session.commit()
 
     def get_maint_id(self, email):
-        maint_re = re.search(r'#\((\d+)', email['Subject'])
+        maint_re = GTT_MAINT_ID.search(email['Subject'])
         if not maint_re:
             return False
 
@@ -784,61 +899,55 @@ class GTT(Provider):
         return maint_id
 
 
-    def add_new_maint(self, soup, email):
+    def get_fields(self, text):
+        '''
+        every field of a notice: the first value of each of GTT_FIELDS, or
+        None, and the circuit ids and a sides in the order they appear.
+        sometimes maint emails contain the same cid several times.
+        '''
+        fields = {}
+        for field, pattern in GTT_FIELDS.items():
+            match = pattern.search(text)
+            fields[field] = match.group(1) if match else None
+        fields['cids'] = list(dict.fromkeys(GTT_SERVICE.findall(text)))
+        fields['a_sides'] = list(dict.fromkeys(GTT_A_SIDE.findall('\n' + text)))
+        return fields
+
+    def add_new_maint(self, text, email):
         maint_id = self.get_maint_id(email)
         if not maint_id:
             return False
 
+        fields = self.get_fields(text)
+        if any(fields[field] is None for field in GTT_FIELDS):
+            raise ParsingError(
+                'Unable to parse the maintenance notification from GTT: {}'.format(
+                    text
+                )
+            )
+
         maint = Maintenance()
         maint.provider_maintenance_id = maint_id
         received = email['Received'].splitlines()[-1].strip()
         maint.received_dt = parser.parse(received)
-        start_re = re.search(r'Start: (.*)(\r|\n)', soup.text)
-        end_re = re.search(r'End: (.*)(\r|\n)', soup.text)
-        location_re = re.search(r'Location: (.*)(\r|\n)', soup.text)
-        reason_re = re.search(r'Reason: (.*)(\r|\n)', soup.text)
-        impact_re = re.search(r'Impact: (.*)(\r|\n)', soup.text)
-        impact = impact_re.groups()[0]
-        start_dt = parser.parse(start_re.groups()[0])
-        end_dt = parser.parse(end_re.groups()[0])
+        impact = fields['impact']
+        start_dt = parser.parse(fields['start'])
+        end_dt = parser.parse(fields['end'])
         maint.start = start_dt.time()
         maint.end = end_dt.time()
         maint.timezone = start_dt.tzname()
-        maint.location = location_re.groups()[0]
-        maint.reason = reason_re.groups()[0]
-        if not all((start_re, end_re, location_re, reason_re, impact_re)):
-            raise ParsingError(
-                'Unable to parse the maintenance notification from GTT: {}'.format(
-                    soup.text
-                )
-            )
+        maint.location = fields['location']
+        maint.reason = fields['reason']
 
         self.add_and_commit(maint)
 
         NEW_PARENT_MAINT.labels(provider=self.name).inc()
 
-        # sometimes maint emails contain the same cid several times
-        cids = set()
-        a_side = set()
-
-        for line in soup.text.splitlines():
-            if 'gtt service' in line.lower():
-                cid = re.search(r'GTT Service = (.+);', line)
-                if cid:
-                    cids.add(cid.groups()[0])
-            elif line.lower().startswith('site address'):
-                loc = re.search(r'= (.*)', line)
-                if loc:
-                    a_side.add(loc.groups()[0])
-            # there is sometimes two location lines with
-            # = ostensibly being the circuit location
-            elif line.lower().startswith('location ='):
-                loc = re.search(r'= (.*)', line)
-                if loc:
-                    a_side.add(loc.groups()[0])
-
-        if len(cids) == len(a_side):
-            for cid, a_side in zip(cids, a_side):
+        cids = fields['cids']
+        a_sides = fields['a_sides']
+
+        if len(cids) == len(a_sides):
+            for cid, a_side in zip(cids, a_sides):
                 if not Circuit.query.filter_by(provider_cid=cid).first():
                     circuit = Circuit()
                     circuit.provider_cid = cid
@@ -862,7 +971,7 @@ class GTT(Provider):
 
 
 
-    def add_end_maint(self, soup, email):
+    def add_end_maint(self, text, email):
         maint_id = self.get_maint_id(email)
         if not maint_id:
             return False
@@ -881,7 +990,7 @@ class GTT(Provider):
 
         return True
 
-    def add_cancelled_maint(self, soup, email):
+    def add_cancelled_maint(self, text, email):
         maint_id = self.get_maint_id(email)
         if not maint_id:
             return False
@@ -898,7 +1007,7 @@ class GTT(Provider):
         return True
 
 
-    def update(self, soup, email):
+    def update(self, text, email):
         maint_id = self.get_maint_id(email)
         if not maint_id:
             return False
@@ -909,13 +1018,13 @@ class GTT(Provider):
         if not maint:
             return False
 
-        update_text = soup.text
+        update_text = text
 
         if not update_text:
             for payload in email.get_payload():
                 update_text = payload.get_payload() 
 
-        u = MaintUpdate(maintenance_id=maint.id, comment=soup.text,
+        u = MaintUpdate(maintenance_id=maint.id, comment=text,
             updated=datetime.datetime.now())
 
         self.add_and_commit(u)
@@ -924,37 +1033,27 @@ class GTT(Provider):
         return True
 
 
-    def process(self, email):
-        msg = None
-        result = False
-        for part in email.walk():
-            if part.get_content_type() == 'text/html':
-                msg = part.get_payload()
-                
-                if 'GTT' in msg:
-                    # this does not need to be decoded
-                    break
-                else:
-                    # this needs to be decoded
-                    msg = base64.b64decode(msg).decode()
-                    break
-
-        if not msg:
-            return False
+    def parse(self, email):
+        '''
+        the text of the html part
+        '''
+        html = MessageView.of(email).html
+        if not html:
+            return None
 
-        soup = bs4.BeautifulSoup(quopri.decodestring(msg), features="lxml")
+        return html_tree(html).text_content()
 
-        if 'work announcement' in email['Subject'].lower():
-            result = self.add_new_maint(soup, email)
+    def apply(self, email, text):
+        view = MessageView.of(email)
+        email = view.email
+        result = False
 
-        elif 'work conclusion' in email['Subject'].lower():
-            result = self.add_end_maint(soup, email)
-            
-        elif 'work cancellation' in email['Subject'].lower():
-            result = self.add_cancelled_maint(soup, email)
+        if not text:
+            return False
 
-        elif 'gtt tt#' in email['Subject'].lower():
-            result = self.update(soup, email)
+        rule = self.subject_rules.match(view.subject)
+        if rule:
+            result = getattr(self, rule.action)(text, email)
 
         return result
 
@@ -969,10 +1068,35 @@ class Hibernia(GTT):
         return b'(FROM "changemanagement@gtt.net" UNSEEN)'
 
 
+TELIA_MAINT_ID = re.compile(r'PWIC\S+')
+# searched in the notice after it is lowercased, once
+TELIA_FIELDS = {
+    'maint_id': re.compile(r'pw reference number: (\S+)'),
+    'start': re.compile(r'start date and time: (.+)'),
+    'end': re.compile(r'end date and time: (.+)'),
+    'reason': re.compile(r'action and reason: (.+)'),
+    'location': re.compile(r'location of work: (.+)'),
+}
+TELIA_CIDS = re.compile(r'service id: (.*)\r')
+TELIA_IMPACTS = re.compile(r'impact: (.*)\r')
+
+
 class Telia(Provider):
     '''
     Telia
     '''
+    content_types = ('text/plain',)
+
+    # reminders have no action, they are marked as processed
+    subject_rules = SubjectRules('telia', [
+        ('new', '^(?i:planned work|urgent!)', 'add_new_maint'),
+        ('cancelled', '^(?i:cancellation of)', 'add_cancelled_maint'),
+        ('reminder', '^(?i:reminder for planned)', None),
+        ('start', '(?i:is about to start)', 'add_start_maint'),
+        ('end', 'has been completed', 'add_end_maint'),
+        ('rescheduled', '^(?i:update for)', 'add_rescheduled_maint'),
+    ])
+
     def __init__(self):
         super().__init__()
         self.name = 'telia'
@@ -990,60 +1114,63 @@ class Telia(Provider):
         '''
         for pulling the id out and returning the maintenance row
         '''
-        maint_id = re.search('.*(PWIC\S+).*', msg)
-
-        if maint_id and maint_id.groups():
-            maint_id = Maintenance.query.filter_by(
-            provider_maintenance_id=maint_id.groups()[0], rescheduled=0).first()
-        elif maint_id and not maint_id_groups():
-            raise Exception(f'maint_id: {maint_id} but no groups')
-        elif not maint_id:
+        maint_id = TELIA_MAINT_ID.search(msg)
+        if not maint_id:
             raise Exception(f'no maint id. msg: {msg}')
 
-        return maint_id
+        return Maintenance.query.filter_by(
+            provider_maintenance_id=maint_id.group(), rescheduled=0).first()
+
+    def get_fields(self, msg):
+        '''
+        every field of a notice from a single lowercased copy of it. a
+        field that isn't there is None, cids and impacts are lists.
+        '''
+        text = msg.lower()
+        fields = {}
+        for field, pattern in TELIA_FIELDS.items():
+            match = pattern.search(text)
+            fields[field] = match.group(1) if match else None
+        fields['cids'] = TELIA_CIDS.findall(text)
+        fields['impacts'] = TELIA_IMPACTS.findall(text)
+        return fields
 
     def add_and_commit(self, row):
         db.session.add(row)
         db.session.commit()
 
     def add_new_maint(self, msg, email):
+        fields = self.get_fields(msg)
+        if not all(fields.values()):
+            raise ParsingError(
+                'Unable to parse the maintenance notification from Telia: {}'.format(
+                    msg
+                )
+            )
+
         maint = Maintenance()
-        provider_id = re.search('(?<=pw reference number: )\S+', msg.lower())
-        maint.provider_maintenance_id = provider_id.group()
-        start_time = re.search('(?<=start date and time: ).+', msg.lower())
-        end_time = re.search('(?<=end date and time: ).+', msg.lower())
+        maint.provider_maintenance_id = fields['maint_id']
         start_dt = datetime.datetime.strptime(
-            start_time.group().rstrip(), '%Y-%b-%d %H:%M %Z'
+            fields['start'].rstrip(), '%Y-%b-%d %H:%M %Z'
         )
         start_dt = start_dt.replace(tzinfo=pytz.utc)
         end_dt = datetime.datetime.strptime(
-            end_time.group().rstrip(), '%Y-%b-%d %H:%M %Z'
+            fields['end'].rstrip(), '%Y-%b-%d %H:%M %Z'
         )
         end_dt = end_dt.replace(tzinfo=pytz.utc)
         maint.start = start_dt.time()
         maint.end = end_dt.time()
         maint.timezone = start_dt.tzname()
-        reason = re.search('(?<=action and reason: ).+', msg.lower())
-        maint.reason = reason.group()
+        maint.reason = fields['reason']
         received = email['Received'].splitlines()[-1].strip()
         maint.received_dt = parser.parse(received)
-        location = re.search('(?<=location of work: ).+', msg.lower())
-        maint.location = location.group().rstrip()
-        cids = re.findall('service id: (.*)\r', msg.lower())
-        impact = re.findall('impact: (.*)\r', msg.lower())
-
-        if not all((provider_id, start_time, end_time, reason, location, cids, impact)):
-            raise ParsingError(
-                'Unable to parse the maintenance notification from Telia: {}'.format(
-                    msg
-                )
-            )
+        maint.location = fields['location'].rstrip()
 
         self.add_and_commit(maint)
 
         NEW_PARENT_MAINT.labels(provider=self.name).inc()
 
-        all_circuits = list(zip(cids, impact))
+        all_circuits = list(zip(fields['cids'], fields['impacts']))
 
         for cid, impact in all_circuits:
             if not Circuit.query.filter_by(provider_cid=cid).first():
@@ -1119,7 +1246,7 @@ class Telia(Provider):
         old_maint = self.get_maintenance(msg)
 
         if not old_maint:
-            self.add_new_maint(soup, email)
+            self.add_new_maint(msg, email)
             return True
 
         old_maint.rescheduled = 1
@@ -1140,48 +1267,27 @@ class Telia(Provider):
         return True
 
 
-    def process(self, email):
-        msg = None
+    def parse(self, email):
+        '''
+        the decoded text/plain part
+        '''
+        return MessageView.of(email).text
+
+    def apply(self, email, msg):
+        view = MessageView.of(email)
+        email = view.email
         result = False
-        b64 = False
-
-        for part in email.walk():
-            if part.get_content_type() == 'text/plain':
-                msg = part.get_payload()
-                if 'telia' in msg.lower():
-                    # this does not need to be decoded
-                    break
-                else:
-                    # this needs to be decoded
-                    msg = base64.b64decode(msg).decode()
-                    break
 
         if not msg:
             return False
 
-
-        if email['Subject'].lower().startswith(
-            'planned work'
-        ) or email['Subject'].lower().startswith('urgent!'):
-            result = self.add_new_maint(msg, email)
-
-        elif email['Subject'].lower().startswith('cancellation of'):
-            result = self.add_cancelled_maint(msg, email)
-
-        elif email['Subject'].lower().startswith('reminder for planned'):
+        rule = self.subject_rules.match(view.subject)
+        if rule and rule.action:
+            result = getattr(self, rule.action)(msg, email)
+        elif rule:
             # we don't care about reminders, mark as processed
             result = True
 
-        elif 'is about to start' in email['Subject'].lower():
-            result = self.add_start_maint(msg, email)
-
-        elif 'has been completed' in email['Subject']:
-            result = self.add_end_maint(msg, email)
-
-        elif email['Subject'].lower().startswith('update for'):
-            result = self.add_rescheduled_maint(msg, email)
-
-
         return result
 
 
@@ -1189,6 +1295,16 @@ class Telstra(Provider):
     '''
     Telstra
     '''
+    content_types = ('text/html',)
+
+    # every notice says maintenance, a new one only that
+    subject_rules = SubjectRules('telstra', [
+        ('reminder', '(?i:(?=.*maintenance).*reminder)', 'add_start_maint'),
+        ('completed', '(?i:(?=.*maintenance).*completed successfully)', 'add_end_maint'),
+        ('cancelled', '(?i:(?=.*maintenance).*(?:did not proceed|reschedule))', 'add_cancelled_maint'),
+        ('maintenance', '(?i:maintenance)', None),
+    ])
+
     def __init__(self):
         super().__init__()
         self.name = 'telstra'
@@ -1213,7 +1329,7 @@ class Telstra(Provider):
         return line.replace('\r', '').replace('=', '').replace('\n', '')
 
 
-    def get_maintenance(self, soup, email):
+    def get_maintenance(self, notice, email):
         '''
         for pulling the id out and returning the maintenance row
         '''
@@ -1230,8 +1346,8 @@ class Telstra(Provider):
         db.session.commit()
 
 
-    def add_start_maint(self, soup, email):
-        maint = self.get_maintenance(soup, email)
+    def add_start_maint(self, notice, email):
+        maint = self.get_maintenance(notice, email)
 
         if not maint:
             return False
@@ -1252,8 +1368,8 @@ class Telstra(Provider):
         return True
 
 
-    def add_end_maint(self, soup, email):
-        maint = self.get_maintenance(soup, email)
+    def add_end_maint(self, notice, email):
+        maint = self.get_maintenance(notice, email)
 
         if not maint:
             return False
@@ -1272,8 +1388,8 @@ class Telstra(Provider):
         return True
 
 
-    def add_cancelled_maint(self, soup, email):
-        maint = self.get_maintenance(soup, email)
+    def add_cancelled_maint(self, notice, email):
+        maint = self.get_maintenance(notice, email)
 
         if not maint:
             return False
@@ -1292,7 +1408,7 @@ class Telstra(Provider):
         return maint
 
 
-    def add_new_maint(self, soup, email):
+    def add_new_maint(self, notice, email):
         '''
         create a new telstra maintenance
         '''
@@ -1304,28 +1420,9 @@ class Telstra(Provider):
         received = email['Received'].splitlines()[-1].strip()
         maint.received_dt = parser.parse(received)
 
-        headers = soup.findAll('th')
-        impact = None
-        cid = None
-        date = None
-
-        for column in headers:
-            if 'expected impact' in self.clean_line(column.text.lower()):
-                impact = self.clean_line(column.next_sibling.next_sibling.text)
-
-            elif 'service(s) impacted' in self.clean_line(column.text.lower()):
-                try:
-                   tmp = self.clean_line(column.next_sibling.next_sibling.text)
-                except:
-                    tmp = self.clean_line(column.next_sibling.text)
-                if '<' in tmp and '>' in tmp:
-                    cid_soup = bs4.BeautifulSoup(tmp)
-                    cid = cid_soup.text
-                else:
-                    cid = tmp
-            
-            elif 'maintenance window' in self.clean_line(column.text.lower()):
-                date = self.clean_line(column.next_sibling.next_sibling.text)
+        impact = notice['impact']
+        cid = notice['cid']
+        date = notice['date']
 
         if not all((impact, cid, date)):
             raise ParsingError(f'unable to parse telstra impact: {impact}, cid: {cid}, date: {date} subject: {email["Subject"]}')
@@ -1353,18 +1450,8 @@ class Telstra(Provider):
         tz = tzmatch.search(timestart).groups()[0]
         maint.timezone = tz
 
-        # grab maintenance details. This is not pretty
-        details = []
-        for i in soup.find_all('tr'):
-            if 'maintenance details' in i.text.lower():
-                det = i
-                details = det.findNextSiblings('tr')
-                break
-
-        for line in details:
-            if 'service(s) impacted' in line.text.lower():
-                break
-            maint.reason += clean_line(line.text)
+        for line in notice['details']:
+            maint.reason += line
             maint.reason += ' '
 
 
@@ -1403,40 +1490,72 @@ class Telstra(Provider):
 
 
 
-    def process(self, email):
-        msg = None
-        result = False
+    def parse(self, email):
+        '''
+        the impact, circuit, window and details of the notice. only a new
+        maintenance needs them so a field that can't be found is None.
+        '''
+        html = MessageView.of(email).html
+        if html is None:
+            return None
 
-        for part in email.walk():
-            if part.get_content_type() == 'text/html':
-                msg = part
-                break
+        # the view has undone the transfer encoding, so only the text
+        # read out of the cells needs cleaning
+        tree = html_tree(html)
 
-        if not msg:
-            return False
+        notice = {'impact': None, 'cid': None, 'date': None, 'details': []}
 
-        soup = bs4.BeautifulSoup(self.clean_line(msg.get_payload()), features="lxml")
+        # each header's value is the cell after it
+        for column in tree.iter('th'):
+            heading = self.clean_line(column.text_content().lower())
+            cell = column.getnext()
+            if cell is None:
+                continue
 
+            if 'expected impact' in heading:
+                notice['impact'] = self.clean_line(cell.text_content())
 
+            elif 'service(s) impacted' in heading:
+                tmp = self.clean_line(cell.text_content())
+                if '<' in tmp and '>' in tmp:
+                    # the circuit is sometimes escaped html
+                    tmp = lxml.html.fragment_fromstring(tmp, create_parent='div').text_content()
+                notice['cid'] = tmp
 
-        if 'maintenance' in email['Subject'].lower():
-            maint_id = email['Subject'].split()[-1]
-            maintenance_exists = self.check_maintenance(maint_id)
+            elif 'maintenance window' in heading:
+                notice['date'] = self.clean_line(cell.text_content())
 
-            if not maintenance_exists:
-                self.add_new_maint(soup, email)
+        # grab maintenance details. This is not pretty
+        details = []
+        for i in tree.iter('tr'):
+            if 'maintenance details' in i.text_content().lower():
+                details = i.itersiblings('tr')
+                break
 
-                result = self.add_new_maint(soup, email)
+        for line in details:
+            if 'service(s) impacted' in line.text_content().lower():
+                break
+            notice['details'].append(self.clean_line(line.text_content()))
 
-            elif 'reminder' in email['Subject'].lower():
-                result = self.add_start_maint(soup, email)
+        return notice
 
-            elif 'completed successfully' in email['Subject'].lower():
-                result = self.add_end_maint(soup, email)
+    def apply(self, email, notice):
+        view = MessageView.of(email)
+        email = view.email
+        result = False
+
+        if not notice:
+            return False
 
-            elif ('did not proceed' in email['Subject'].lower() or 
-                  'reschedule' in email['Subject'].lower()):
-                result = self.add_cancelled_maint(soup, email)
+        rule = self.subject_rules.match(view.subject)
+        if not rule:
+            return False
+
+        maint_id = email['Subject'].split()[-1]
+        if not self.check_maintenance(maint_id):
+            result = self.add_new_maint(notice, email)
 
+        elif rule.action:
+            result = getattr(self, rule.action)(notice, email)
 
         return result
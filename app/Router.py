@@ -0,0 +1,189 @@
+'''
+routes messages to providers locally instead of running a server side
+SEARCH for every provider.
+'''
+from collections import namedtuple
+import re
+import threading
+from email.header import decode_header, make_header
+
+from prometheus_client import Counter as MetricCounter
+
+from app import registry
+
+
+RULE_MATCHES = MetricCounter('janitor_subject_rule_matches_total',
+                             'messages classified by each subject rule of a provider',
+                             labelnames=['provider', 'rule'],
+                             registry=registry
+                             )
+
+
+CRITERIA_TOKENS = re.compile(rb'"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+
+# search keys that match on a header and the header they match on
+HEADER_KEYS = {
+    'FROM': 'From',
+    'TO': 'To',
+    'CC': 'Cc',
+    'BCC': 'Bcc',
+    'SUBJECT': 'Subject',
+}
+
+# search keys that only select messages by state. the run's own
+# search decides which messages are looked at so these are ignored.
+STATE_KEYS = {'ALL', 'UNSEEN', 'NEW', 'RECENT'}
+
+
+def parse_criteria(criteria):
+    '''
+    turn a provider's imap search criteria, e.g. b'(FROM "MR Zayo" UNSEEN)',
+    into a list of (header, lowercased needle) pairs that all have to match.
+    '''
+    if isinstance(criteria, str):
+        criteria = criteria.encode()
+
+    tokens = []
+    for match in CRITERIA_TOKENS.finditer(criteria):
+        if match.group(1) is not None:
+            tokens.append(re.sub(rb'\\(.)', rb'\1', match.group(1)).decode())
+        else:
+            tokens.append(match.group(2).decode())
+
+    rules = []
+    tokens = iter(tokens)
+    for token in tokens:
+        key = token.upper()
+        if key in STATE_KEYS:
+            continue
+        if key in HEADER_KEYS:
+            rules.append((HEADER_KEYS[key], next(tokens).lower()))
+        elif key == 'HEADER':
+            header = next(tokens)
+            rules.append((header.title(), next(tokens).lower()))
+        else:
+            raise ValueError(f'unsupported search key {token} in {criteria}')
+
+    if not rules:
+        raise ValueError(f'{criteria} does not match on any header')
+
+    return rules
+
+
+def header_text(value):
+    '''
+    decode an rfc2047 encoded header the same way the server does
+    before matching SEARCH criteria against it
+    '''
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, UnicodeDecodeError, ValueError):
+        return str(value)
+
+
+class Router:
+    '''
+    compiles every provider's "identified_by" into one matcher so that
+    a message's headers only need to be fetched once to know which
+    provider should process it.
+    '''
+    def __init__(self, providers):
+        self.rules = []
+        fields = []
+        for provider in providers:
+            rules = parse_criteria(provider.identified_by)
+            self.rules.append((provider, rules))
+            for field, needle in rules:
+                if field not in fields:
+                    fields.append(field)
+
+        self.fields = fields
+
+    def route(self, headers):
+        '''
+        return the first provider whose criteria all match the headers
+        of the message, or None if no provider does.
+        '''
+        values = {}
+        for field in self.fields:
+            values[field] = ' '.join(
+                header_text(v) for v in headers.get_all(field, [])
+            ).lower()
+
+        for provider, rules in self.rules:
+            if all(needle in values[field] for field, needle in rules):
+                return provider
+
+        return None
+
+    def __repr__(self):
+        return f'<Router providers: {len(self.rules)}, fields: {self.fields}>'
+
+
+Rule = namedtuple('Rule', ['name', 'pattern', 'action'])
+
+
+class SubjectRules:
+    '''
+    a provider's table of subject rules, (name, pattern, action) tuples.
+    a rule matches when its pattern is found in the subject, as with
+    re.search on the subject as MessageView.subject gives it, decoded with
+    its whitespace collapsed, and the first rule in the table that matches
+    is the one used. patterns are case sensitive unless they say otherwise
+    with (?i:...), and one that starts with ^ is anchored as a whole, so it
+    can't be a top level alternation like ^a|b.
+
+    the table is compiled into one regular expression, so a subject is
+    classified in one pass. how often each rule matched is kept in stats,
+    and flush adds it to the janitor_subject_rule_matches_total metric.
+    '''
+    def __init__(self, provider, rules):
+        self.provider = provider
+        self.rules = [Rule(*rule) for rule in rules]
+        # re.match tries the alternatives in order at the start of the
+        # subject, the lazy .*? makes each one that isn't anchored a search
+        self.pattern = re.compile('|'.join(
+            f'(?P<r{i}>{"" if rule.pattern.startswith("^") else ".*?"}(?:{rule.pattern}))'
+            for i, rule in enumerate(self.rules)))
+        # the rule of each group, looked up by the name of the one that matched
+        self.groups = {f'r{i}': rule for i, rule in enumerate(self.rules)}
+        names = [rule.name for rule in self.rules] + [None]
+        # a plain dict counts faster than a Counter
+        self.stats = dict.fromkeys(names, 0)
+        # what flush has added to the metric so far
+        self.flushed = dict.fromkeys(names, 0)
+        # held to count a match and to flush the counts
+        self.lock = threading.Lock()
+        # the metric's children by rule name, labels() is slow to look up
+        self.counters = {
+            name: RULE_MATCHES.labels(provider=provider, rule=name or 'none')
+            for name in names
+        }
+
+    def match(self, subject):
+        '''
+        the first rule that matches subject, which is the MessageView.subject
+        of the message, or None
+        '''
+        found = self.pattern.match(subject)
+        rule = self.groups[found.lastgroup] if found else None
+        # the mail sources are processed in parallel threads
+        with self.lock:
+            self.stats[rule.name if rule else None] += 1
+        return rule
+
+    def flush(self):
+        '''
+        add the matches since the last flush to the metric. incrementing
+        it takes a lock, and in multiprocess mode a write to its file,
+        so it's done once a run rather than for every subject
+        '''
+        with self.lock:
+            stats = self.stats.copy()
+            for name, count in stats.items():
+                if count > self.flushed[name]:
+                    self.counters[name].inc(count - self.flushed[name])
+            self.flushed = stats
+
+    def __repr__(self):
+        return f'<SubjectRules {self.provider}: {[rule.name for rule in self.rules]}>'
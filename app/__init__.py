@@ -1,5 +1,6 @@
 import logging
 import os
+import click
 from logging.handlers import RotatingFileHandler
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -48,6 +49,15 @@ def start_maint():
 def end_maint():
     mark_ended()
 
+def keepalive_connections():
+    keepalive()
+
+def refresh_failed():
+    refresh_failed_messages()
+
+def idle_startup(app):
+    return start_idle_listener(app)
+
 
 def create_app(config_class=Config):
     app = Flask(__name__)
@@ -73,6 +83,20 @@ def create_app(config_class=Config):
              'trigger': 'interval',
              'replace_existing': True,
              'seconds': int(280)
+         },
+         {
+             'id': 'imap_keepalive',
+             'func': keepalive_connections,
+             'trigger': 'interval',
+             'replace_existing': True,
+             'seconds': int(app.config['IMAP_KEEPALIVE'])
+         },
+         {
+             'id': 'refresh_failed',
+             'func': refresh_failed,
+             'trigger': 'interval',
+             'replace_existing': True,
+             'seconds': int(app.config['FAILED_REFRESH_INTERVAL'])
          }
     ]
     app.config['JOBS'] = JOBS
@@ -118,6 +142,16 @@ def create_app(config_class=Config):
 
     connexion_register_blueprint(app, 'api/v1/swagger/main.yaml')
 
+    from app.cli import janitor
+    app.cli.add_command(janitor)
+
+    # the listeners belong to the app server's processes, not to a flask
+    # command like db upgrade that loads the app to run
+    app.extensions['idle_listeners'] = []
+    if app.config['MAIL_IDLE'] and not app.testing and \
+            not click.get_current_context(silent=True):
+        app.extensions['idle_listeners'] = idle_startup(app)
+
     if not app.debug and not app.testing:
 
         log_level = {
@@ -158,4 +192,4 @@ def connexion_register_blueprint(app, swagger_file, **kwargs):
 
 
 from app import models
-from app.jobs.main import process, mark_started, mark_ended
+from app.jobs.main import process, mark_started, mark_ended, keepalive, start_idle_listener, refresh_failed_messages
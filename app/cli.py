@@ -0,0 +1,77 @@
+'''
+the "flask janitor" commands
+'''
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import scheduler
+
+
+janitor = AppGroup('janitor', help='janitor maintenance commands')
+
+
+def stop_background():
+    '''
+    create_app started the scheduler in this process too. it is stopped
+    so that only the live app processes new mail while a command runs;
+    the jobs in the shared job store are left as they are. IDLE listeners
+    are never started by a flask command.
+    '''
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+
+@janitor.command('backfill')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='import messages received on or after this date')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='import messages received before this date')
+@click.option('--source', type=int, default=0, show_default=True,
+              help='the index of the mail source in MAIL_SOURCES')
+@click.option('--mailbox', help='the mailbox to import, the source\'s by default')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=500, show_default=True,
+              help='messages processed between checkpoints')
+@click.option('--restart', is_flag=True,
+              help='start over instead of resuming from the last checkpoint')
+def backfill_command(since, until, source, mailbox, chunk_size, restart):
+    '''
+    import the history of a mailbox in checkpointed chunks
+    '''
+    from app.jobs.backfill import backfill
+    from app.jobs.main import mail_sources, get_client
+
+    sources = mail_sources()
+    if not 0 <= source < len(sources):
+        raise click.BadParameter(f'there are {len(sources)} mail sources', param_hint='--source')
+    source = sources[source]
+    mailbox = mailbox or source['mailbox']
+    since = since.date() if since else None
+    until = until.date() if until else None
+
+    stop_background()
+    # a connection of its own, so the live app's connections aren't held
+    client = get_client(source)
+    try:
+        backfill(client, mailbox, since, until, chunk_size, restart, echo=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        client.close_session()
+
+
+@janitor.command('gmail-auth')
+@click.argument('client_secrets', type=click.Path(exists=True, dir_okay=False))
+def gmail_auth_command(client_secrets):
+    '''
+    authorize the GmailAPI mail client and save its token to GMAIL_TOKEN_FILE
+    '''
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from app.MailClient import GmailAPI
+
+    flow = InstalledAppFlow.from_client_secrets_file(client_secrets, GmailAPI.scopes)
+    credentials = flow.run_local_server(port=0)
+    token_file = current_app.config['GMAIL_TOKEN_FILE']
+    with open(token_file, 'w') as f:
+        f.write(credentials.to_json())
+    click.echo(f'saved the token to {token_file}')
@@ -0,0 +1,123 @@
+'''
+import the history of a mailbox, see "flask janitor backfill". the
+messages in a date range are processed in chunks of uids and the last uid
+of each chunk is committed to a BackfillState row, so an import that is
+stopped resumes after the last chunk that finished. failures are
+recorded at the mailbox's location like a uid sync's, so the sync and the
+next backfill of the mailbox retry them once they are due.
+'''
+from app import db
+from app.models import BackfillState
+from app.jobs.failures import mailbox_location, due_retries
+from app.jobs.main import PROVIDERS, process_messages
+
+from datetime import datetime
+import time
+
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def imap_date(day):
+    '''
+    the date format of imap search criteria. strftime's %b depends on
+    the locale, imap's month names don't.
+    '''
+    return f'{day.day}-{MONTHS[day.month - 1]}-{day.year}'
+
+
+def search_criteria(since=None, until=None):
+    '''
+    messages received on or after since and before until
+    '''
+    criteria = []
+    if since:
+        criteria.append(f'SINCE {imap_date(since)}')
+    if until:
+        criteria.append(f'BEFORE {imap_date(until)}')
+    return ' '.join(criteria) or 'ALL'
+
+
+def get_backfill_state(client, mailbox, since, until, uidvalidity, restart=False):
+    '''
+    the checkpoint of this backfill. it starts over when asked to or when
+    the mailbox's uidvalidity changed, since the stored uid is meaningless.
+    '''
+    state = BackfillState.query.filter_by(server=client.server,
+                                          username=client.email,
+                                          mailbox=mailbox,
+                                          since=since, until=until).first()
+    if not state:
+        return BackfillState(server=client.server, username=client.email,
+                             mailbox=mailbox, since=since, until=until,
+                             uidvalidity=uidvalidity, last_uid=0, processed=0)
+    if restart or state.uidvalidity != uidvalidity:
+        state.uidvalidity = uidvalidity
+        state.last_uid = 0
+        state.processed = 0
+        state.started = datetime.utcnow()
+    return state
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+
+def backfill(client, mailbox, since=None, until=None, chunk_size=500,
+             restart=False, echo=print):
+    '''
+    process every message of mailbox received between since and until,
+    chunk_size messages at a time, committing the checkpoint after each
+    chunk. progress, throughput and an estimate of the time left are
+    passed to echo. returns the number of messages processed.
+    '''
+    if client.sync_mode not in (None, 'uid'):
+        raise ValueError(f'{client.email} has no uids to resume a backfill from')
+
+    client.uid = True
+    uidvalidity = client.select(mailbox)
+    state = get_backfill_state(client, mailbox, since, until, uidvalidity, restart)
+
+    uids = sorted(int(uid) for uid in client.search(search_criteria(since, until)))
+    remaining = [uid for uid in uids if uid > state.last_uid]
+    if state.last_uid:
+        echo(f'resuming after uid {state.last_uid}, {len(uids) - len(remaining)} of {len(uids)} messages already done')
+
+    providers = [provider() for provider in PROVIDERS]
+    location = mailbox_location(client, mailbox, uidvalidity)
+    done_uids = set(uids) - set(remaining)
+    retries = [uid for uid in due_retries(location, providers) if int(uid) in done_uids]
+    if not (remaining or retries):
+        echo(f'nothing to backfill in {client.email}/{mailbox}')
+        return 0
+
+    count = 0
+    if retries:
+        count += process_messages(client, retries, providers, location)
+        echo(f'retried {len(retries)} messages that failed before')
+
+    start = time.monotonic()
+    done = 0
+    for i in range(0, len(remaining), chunk_size):
+        chunk = remaining[i:i + chunk_size]
+        count += process_messages(client, chunk, providers, location)
+
+        state.last_uid = chunk[-1]
+        state.processed = (state.processed or 0) + len(chunk)
+        state.updated = datetime.utcnow()
+        db.session.add(state)
+        db.session.commit()
+
+        done += len(chunk)
+        elapsed = time.monotonic() - start
+        rate = done / elapsed if elapsed else 0
+        eta = (len(remaining) - done) / rate if rate else 0
+        echo(f'{done}/{len(remaining)} messages, uid {state.last_uid}, '
+             f'{rate:.2f} msgs/sec, {format_duration(eta)} left')
+
+    echo(f'backfilled {done} messages of {client.email}/{mailbox} in '
+         f'{format_duration(time.monotonic() - start)}, {count} processed')
+    return count
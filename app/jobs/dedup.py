@@ -0,0 +1,126 @@
+'''
+an index of the messages that were processed successfully so that copies
+of a notice, delivered to several aliases, forwarded or resent by the
+provider, are acknowledged without being parsed or written again.
+'''
+from flask import current_app
+from app import db, registry
+from app.models import ProcessedMessage
+from app.MessageView import MessageView
+
+from datetime import datetime
+import hashlib
+import re
+import threading
+from prometheus_client import Counter
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+
+DUPLICATES = Counter('janitor_duplicate_messages_total',
+              'messages skipped because a copy of them was already processed',
+              labelnames=['provider',
+                          ],
+              registry=registry
+              )
+
+# the header block a mail client puts above a forwarded message
+FORWARD_HEADER = re.compile(
+    r'^-*\s*(forwarded|original) message\s*-*\s*$\n(^[\w-]+:.*$\n)*',
+    re.IGNORECASE | re.MULTILINE
+)
+
+QUOTING = re.compile(r'^[ \t]*(>[ \t]?)+', re.MULTILINE)
+
+WHITESPACE = re.compile(r'\s+')
+
+# mail sources are processed in parallel, each with an index loaded when
+# its run started. checking the db, applying and recording a message are
+# one step under this lock so a notice delivered to two sources is only
+# applied once. across processes the unique message_id is the backstop.
+APPLY_LOCK = threading.Lock()
+
+FORWARD_PREFIX = re.compile(r'^\s*((fwd?|fw|re)\s*:\s*)+', re.IGNORECASE)
+
+
+def normalize(text):
+    return WHITESPACE.sub(' ', text).strip().lower()
+
+
+def normalized_hash(email):
+    '''
+    a hash of the subject and text parts of a message that ignores what
+    forwarding changes: Fwd: prefixes, quoting, the forwarded message
+    header, line wrapping, whitespace and case. the subject is included
+    since providers send start and end notices with the same body.
+    email may be a MessageView, whose decoded parts are then reused.
+    '''
+    view = MessageView.of(email)
+    digest = hashlib.sha256()
+    digest.update(normalize(FORWARD_PREFIX.sub('', view.subject)).encode() + b'\0')
+    for _, text in view.texts:
+        text = QUOTING.sub('', text.replace('\r\n', '\n'))
+        # anything the forwarder wrote above the notice is ignored too
+        forward = FORWARD_HEADER.search(text)
+        if forward:
+            text = text[forward.end():]
+        digest.update(normalize(text).encode())
+    return digest.hexdigest()
+
+
+class ProcessedIndex:
+    '''
+    the processed messages of one run, looked up together by Message-ID
+    so that the check before fetching a message is a set lookup.
+    '''
+    def __init__(self, keys):
+        self.keys = set()
+        self.hashes = set()
+        keys = list(keys)
+        # stay well below the bound parameter limit of sqlite
+        for i in range(0, len(keys), 500):
+            rows = db.session.query(ProcessedMessage.message_id).filter(
+                ProcessedMessage.message_id.in_(keys[i:i + 500]))
+            self.keys.update(message_id for message_id, in rows)
+
+    def seen(self, key):
+        '''
+        True if a message with this Message-ID was processed before or
+        earlier in this run. a copy of a message that is still to be
+        applied isn't skipped, the copy is needed if that one fails, and
+        processed catches it when it is applied.
+        '''
+        return key in self.keys
+
+    def seen_body(self, digest):
+        '''
+        True if a message with the same body was processed before or
+        earlier in this run
+        '''
+        if digest in self.hashes:
+            return True
+        return ProcessedMessage.query.filter_by(body_hash=digest).first() is not None
+
+    def processed(self, key, digest):
+        '''
+        True if a message with this Message-ID or body has been recorded
+        in the db, by any source. call it under APPLY_LOCK.
+        '''
+        # end the transaction so that what other sources committed is seen
+        db.session.commit()
+        return db.session.query(ProcessedMessage.id).filter(or_(
+            ProcessedMessage.message_id == key,
+            ProcessedMessage.body_hash == digest)).first() is not None
+
+    def record(self, key, digest, provider):
+        self.keys.add(key)
+        self.hashes.add(digest)
+        db.session.add(ProcessedMessage(message_id=key, body_hash=digest,
+                                        provider=provider.name,
+                                        processed=datetime.utcnow()))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another process recorded it between our check and now
+            db.session.rollback()
+            current_app.logger.warning(f'{key} was processed by another process at the same time')
@@ -0,0 +1,173 @@
+'''
+a ledger of messages that providers failed to process so that known bad
+mail is not downloaded and parsed again on every run. failed messages
+are retried with an exponential backoff until FAILURE_MAX_ATTEMPTS is
+reached, and retried from scratch whenever the provider's parser changes.
+
+the uid and history sync modes only look at messages that arrived since
+the last run, so each entry also keeps where its message was found and
+due_retries hands those ids back to the next run of that mailbox.
+'''
+from flask import current_app
+from app import db
+from app.models import FailedMessage
+from app.MessageView import MessageView
+from app.Router import header_text
+
+from datetime import datetime, timedelta
+import hashlib
+import inspect
+import sys
+
+
+# never wait longer than this between retries
+MAX_BACKOFF = timedelta(days=1)
+
+_parser_versions = {}
+
+
+def parser_version(provider):
+    '''
+    a hash of the source of the module the provider is defined in,
+    so that any change to a parser makes its failures worth retrying
+    '''
+    module = type(provider).__module__
+    if module not in _parser_versions:
+        try:
+            source = inspect.getsource(sys.modules[module])
+        except (OSError, TypeError):
+            source = module
+        _parser_versions[module] = hashlib.sha1(source.encode()).hexdigest()
+    return _parser_versions[module]
+
+
+def message_key(headers):
+    '''
+    the Message-ID of a message, or a hash of its sender, subject
+    and date if it doesn't have one
+    '''
+    message_id = headers.get('Message-ID')
+    if message_id:
+        return message_id.strip()[:255]
+
+    fields = [header_text(headers.get(field, '')) for field in ('From', 'Subject', 'Date')]
+    return hashlib.sha256('|'.join(fields).encode()).hexdigest()
+
+
+def mailbox_location(client, mailbox, uidvalidity=None):
+    '''
+    where a message id of client is valid. a new uidvalidity makes a new
+    location so the uids of the old one are never fetched.
+    '''
+    location = f'{client.server}/{client.email}/{mailbox}'
+    if uidvalidity is not None:
+        location += f';{uidvalidity}'
+    return location[:255]
+
+
+def due_retries(location, providers, now=None):
+    '''
+    the message ids in location of failed messages that are due to be
+    retried: their backoff has passed or their provider's parser changed
+    '''
+    now = now or datetime.utcnow()
+    versions = {provider.name: parser_version(provider) for provider in providers}
+    max_attempts = int(current_app.config['FAILURE_MAX_ATTEMPTS'])
+
+    due = []
+    for failed in FailedMessage.query.filter_by(location=location):
+        if failed.provider not in versions or failed.uid is None:
+            continue
+        if failed.parser_version != versions[failed.provider] or (
+                failed.attempts < max_attempts and
+                not (failed.next_attempt and failed.next_attempt > now)):
+            due.append(failed.uid)
+    return due
+
+
+def body_hash(email):
+    '''
+    a hash of the decoded payloads of a message, or of a MessageView
+    '''
+    digest = hashlib.sha256()
+    for _, payload in MessageView.of(email).payloads:
+        digest.update(payload)
+    return digest.hexdigest()
+
+
+class FailureLedger:
+    '''
+    the ledger entries for the messages of one run, looked up together
+    so that checking a message that never failed costs nothing.
+    '''
+    def __init__(self, keys, now=None):
+        self.now = now or datetime.utcnow()
+        self.entries = {}
+        keys = list(keys)
+        # stay well below the bound parameter limit of sqlite
+        for i in range(0, len(keys), 500):
+            for failed in FailedMessage.query.filter(
+                    FailedMessage.message_id.in_(keys[i:i + 500])):
+                self.entries[failed.message_id] = failed
+
+    def skip(self, key, provider):
+        '''
+        True if the message failed before and isn't due to be retried
+        '''
+        failed = self.entries.get(key)
+        if not failed:
+            return False
+        if failed.parser_version != parser_version(provider):
+            # the parser changed since this failed, give it another go
+            return False
+        if failed.attempts >= int(current_app.config['FAILURE_MAX_ATTEMPTS']):
+            return True
+        return bool(failed.next_attempt and failed.next_attempt > self.now)
+
+    def record(self, key, email, provider, location=None, msg_id=None):
+        '''
+        add a failed message to the ledger, or push back its next attempt.
+        location and msg_id are where to find it again, see due_retries.
+        '''
+        version = parser_version(provider)
+        view = MessageView.of(email)
+        digest = body_hash(view)
+
+        failed = self.entries.get(key)
+        if not failed:
+            failed = FailedMessage(message_id=key, first_failed=self.now, attempts=0)
+            self.entries[key] = failed
+        elif failed.parser_version != version or failed.body_hash != digest:
+            # a new parser or a different message with the same id
+            failed.attempts = 0
+
+        failed.body_hash = digest
+        failed.provider = provider.name
+        failed.subject = view.subject
+        failed.parser_version = version
+        if location:
+            failed.location = location
+            failed.uid = msg_id.decode() if isinstance(msg_id, bytes) else str(msg_id)
+        failed.attempts += 1
+        failed.last_attempt = self.now
+
+        backoff = timedelta(seconds=int(current_app.config['FAILURE_BACKOFF']))
+        failed.next_attempt = self.now + min(backoff * 2 ** (failed.attempts - 1),
+                                             MAX_BACKOFF)
+
+        db.session.add(failed)
+        db.session.commit()
+
+        if failed.attempts >= int(current_app.config['FAILURE_MAX_ATTEMPTS']):
+            current_app.logger.warning(f'giving up on {key} after {failed.attempts} attempts')
+
+        return failed
+
+    def clear(self, key):
+        '''
+        remove a message from the ledger once it has been processed
+        '''
+        failed = self.entries.pop(key, None)
+        if failed:
+            db.session.delete(failed)
+            db.session.commit()
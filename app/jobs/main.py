@@ -5,9 +5,14 @@ maintenances are marked started and ended from this module
 
 from flask import current_app, jsonify
 
-from app import db, scheduler
-from app.models import Provider, Maintenance, MaintCircuit
-from app.MailClient import Gmail as mc
+from app import db, scheduler, registry
+from app.models import Provider, Maintenance, MaintCircuit, MailboxState, FailedMessageSummary
+from app.MailClient import Gmail as mc, AsyncGmail, GmailAPI, ConnectionManager, IdleListener, find_sections, local_client
+from app.Router import Router, header_text
+from app.MessageView import MessageView
+from app.jobs.failures import FailureLedger, message_key, mailbox_location, due_retries
+from app.jobs.pipeline import parse_pool, parsed_messages
+from app.jobs.dedup import ProcessedIndex, normalized_hash, DUPLICATES, APPLY_LOCK
 from app.Providers import Zayo, NTT, PacketFabric, EUNetworks, GTT, Hibernia, Telia, Telstra, IN_PROGRESS
 
 from api.v1.maintenances import starting_soon, ending_soon
@@ -15,11 +20,47 @@ from app.jobs.started import FUNCS as start_funcs
 from app.jobs.ended import FUNCS as end_funcs
 
 import email
+import email.utils
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
+import threading
+import time
+from prometheus_client import Counter, Gauge
+from sqlalchemy import func
 
 PROVIDERS = [Zayo, NTT, PacketFabric, EUNetworks, GTT, Hibernia, Telia, Telstra]
 
+# the scheduled run and the IDLE listener must not process the same
+# messages at the same time, in this process or in another worker of
+# the app server (see process_lock)
+PROCESS_LOCK = threading.Lock()
+
+# the IDLE listeners' lock file, held for the life of the process that
+# took it so that only one process listens
+IDLE_LOCK = None
+
+# logged in clients are kept open between runs
+CONNECTIONS = ConnectionManager()
+
+# headers fetched along with the routing headers to identify a message
+KEY_FIELDS = ['Message-ID', 'Date']
+
+MESSAGES_FETCHED = Counter('janitor_messages_fetched_total',
+              'total number of messages retrieved from the mail server',
+              registry=registry
+              )
+
+INGEST_RATE = Gauge('janitor_ingest_messages_per_second',
+                    'messages processed per second during the last run',
+              multiprocess_mode='liveall',
+              registry=registry
+                    )
+
 
 def mark_started():
     '''
@@ -100,75 +141,513 @@ def mark_ended():
                 scheduler.app.logger.info(f'calling function {func.__name__} for {m.provider_maintenance_id} due to job')
                 func(email=None, maintenance=m)
 
-def get_client():
-    server = current_app.config['MAIL_SERVER']
-    username = current_app.config['MAIL_USERNAME']
-    passwd = current_app.config['MAIL_PASSWORD']
-    client = mc(server, username, passwd)
+def mail_sources():
+    '''
+    every mailbox that should be processed. MAIL_SOURCES is a json list
+    of objects with server, username, password, mailbox and port keys;
+    any key left out is taken from the MAIL_* settings. without it the
+    single MAIL_SERVER/MAIL_USERNAME/MAILBOX account is used. a source
+    with a path key reads a local Maildir or mbox instead.
+    '''
+    config = current_app.config
+    default = {
+        'server': config['MAIL_SERVER'],
+        'username': config['MAIL_USERNAME'],
+        'password': config['MAIL_PASSWORD'],
+        'mailbox': config['MAILBOX'],
+        'port': 993,
+    }
+    sources = config.get('MAIL_SOURCES')
+    if not sources:
+        return [default]
+    if isinstance(sources, str):
+        sources = json.loads(sources)
+
+    return [{**default, **source} for source in sources]
+
+
+def uses_api(source):
+    '''
+    True if the source is read with the gmail api, which has no imap
+    connection to share or uids to keep
+    '''
+    return not source.get('path') and \
+        (current_app.config.get('MAIL_CLIENT') or 'Gmail').lower() == 'gmailapi'
+
+
+def get_client(source=None):
+    source = source or mail_sources()[0]
+    config = current_app.config
+    if source.get('path'):
+        client = local_client(source['path'])
+    elif uses_api(source):
+        client = GmailAPI(source['username'],
+                          source.get('token_file') or config['GMAIL_TOKEN_FILE'],
+                          config['GMAIL_API_ROOT'])
+    elif (config.get('MAIL_CLIENT') or 'Gmail').lower() == 'asyncgmail':
+        client = AsyncGmail(source['server'], source['username'], source['password'],
+                            int(source['port']),
+                            connections=int(config['FETCH_CONNECTIONS']),
+                            pipeline=int(config['FETCH_PIPELINE']))
+    else:
+        client = mc(source['server'], source['username'], source['password'],
+                    int(source['port']))
+    # from the environment it's a string, and '0' keeps every attachment
+    client.max_part_size = int(config['MAX_PART_SIZE'] or 0) or None
+    if hasattr(client, 'tuner'):
+        client.tuner.max_chunk_size = int(config['FETCH_CHUNK_MAX'])
     return client
 
 
+def connection(source=None):
+    '''
+    the shared, already logged in client for a mail source (the first
+    one if not given). use it as a context manager; the client is
+    reserved until the block exits and stays connected afterwards.
+    '''
+    source = source or mail_sources()[0]
+    if source.get('path') or uses_api(source):
+        # there's no connection to keep open for mail on disk or over http
+        return get_client(source)
+    CONNECTIONS.keepalive = int(current_app.config['IMAP_KEEPALIVE'])
+    key = (source['server'], source['username'], source['mailbox'])
+    return CONNECTIONS.connection(key, lambda: get_client(source))
+
 
-def process_provider(client, mail, provider):
+def keepalive():
     '''
-    retreive messages from the provider's "identified_by"
-    and process each one. 
+    a job to keep the shared connections from timing out between runs
     '''
-    typ, messages = mail.search(None, provider.identified_by)
-    length = len(messages[0].split())
-    if typ != 'OK':
-        raise Exception(f'error retrieving messages for {provider.name}')
+    with scheduler.app.app_context():
+        CONNECTIONS.keepalive_all()
 
-    msg_ids = messages[0].split()
 
-    for msg_id in msg_ids:
-        typ, data = mail.fetch(msg_id, "(RFC822)")
-        em = email.message_from_bytes(data[0][1])
 
-        subject = em['Subject']
-        result = provider.process(em)
+def unique_messages(client, messages, routed, index, digests):
+    '''
+    pass on a MessageView of the fetched messages whose body hasn't been
+    processed before, keeping their normalized hash in digests. the view
+    goes on to the parser, so the parts hashed here are decoded once.
+    copies are marked processed without being parsed.
+    '''
+    for msg_id, em in messages:
+        view = MessageView(em)
+        digest = normalized_hash(view)
+        if index.seen_body(digest):
+            current_app.logger.info(f'{view.subject} was already processed, skipping')
+            client.mark_processed(msg_id)
+            DUPLICATES.labels(provider=routed[msg_id].name).inc()
+            continue
+        digests[msg_id] = digest
+        yield msg_id, view
 
-        if result:
+
+def process_messages(client, msg_ids, providers, location=None):
+    '''
+    fetch the headers of msg_ids once, route each message to the provider
+    whose "identified_by" it matches and process it. messages are fetched
+    FETCH_CHUNK_SIZE at a time, so the number of commands sent doesn't
+    grow with the number of providers, and only the parts of a message
+    the provider's content_types name are downloaded. messages that
+    failed recently are skipped, see app.jobs.failures, and so are
+    copies of messages that were already processed, see app.jobs.dedup.
+    messages are parsed in a process pool when PARSE_WORKERS is set,
+    see app.jobs.pipeline. location is where msg_ids are valid, failures
+    are recorded with it so the sync modes can retry them by id.
+    returns the number of messages processed.
+    '''
+    router = Router(providers)
+    chunk_size = int(current_app.config['FETCH_CHUNK_SIZE'])
+    fields = router.fields + [f for f in KEY_FIELDS if f not in router.fields]
+
+    routed = {}
+    structures = {}
+    keys = {}
+    for msg_id, headers, structure in client.fetch_headers(msg_ids, fields, chunk_size):
+        provider = router.route(headers)
+        if provider:
+            routed[msg_id] = provider
+            structures[msg_id] = structure
+            keys[msg_id] = message_key(headers)
+
+    # copies of processed messages and known bad messages are skipped
+    # before their bodies are downloaded
+    index = ProcessedIndex(keys.values())
+    ledger = FailureLedger(keys.values())
+    parts = {}
+    duplicates = 0
+    for msg_id, provider in routed.items():
+        if index.seen(keys[msg_id]):
             client.mark_processed(msg_id)
-        else:
-            subject = em['Subject']
-            failed = True
-            client.mark_failed(msg_id)
+            DUPLICATES.labels(provider=provider.name).inc()
+            duplicates += 1
+            continue
+        if ledger.skip(keys[msg_id], provider):
+            continue
+        parts[msg_id] = find_sections(structures[msg_id], provider.content_types)
+
+    current_app.logger.info(f'{len(routed)} of {len(msg_ids)} messages routed to a provider, {duplicates} already processed, {len(routed) - len(parts) - duplicates} skipped after failing before')
+
+    pool = parse_pool(int(current_app.config['PARSE_WORKERS']))
+    digests = {}
+    messages = unique_messages(client, client.fetch_parts(parts, chunk_size),
+                               routed, index, digests)
+
+    count = 0
+    try:
+        for msg_id, view, provider, parsed in parsed_messages(messages, routed, pool):
+            MESSAGES_FETCHED.inc()
+            duplicate = False
+            try:
+                data = parsed()
+                # another source may have processed a copy since this run began
+                with APPLY_LOCK:
+                    duplicate = index.processed(keys[msg_id], digests[msg_id])
+                    if not duplicate:
+                        result = provider.apply(view, data)
+                        if result:
+                            index.record(keys[msg_id], digests[msg_id], provider)
+            except Exception:
+                current_app.logger.exception(f'{provider.name} failed to process {view.subject}')
+                db.session.rollback()
+                result = False
+
+            if duplicate:
+                current_app.logger.info(f'{view.subject} was processed from another source, skipping')
+                client.mark_processed(msg_id)
+                DUPLICATES.labels(provider=provider.name).inc()
+                continue
+
+            count += 1
+            if result:
+                client.mark_processed(msg_id)
+                ledger.clear(keys[msg_id])
+            else:
+                client.mark_failed(msg_id)
+                ledger.record(keys[msg_id], view, provider, location, msg_id)
+    finally:
+        # keep the results of everything processed before an error
+        client.flush()
+        for provider in set(routed.values()):
+            if getattr(provider, 'subject_rules', None):
+                provider.subject_rules.flush()
+
+    return count
+
+
+def failed_messages(page=1):
+    '''
+    a page of the failed messages to be displayed by the front end,
+    from the snapshot kept up to date by refresh_failed_messages
+    so that the page doesn't wait on the mail server
+    '''
+    messages = FailedMessageSummary.query.order_by(
+        FailedMessageSummary.date.desc(), FailedMessageSummary.id.desc()
+    ).paginate(page, int(current_app.config['POSTS_PER_PAGE']), False)
+
+    # the oldest refresh of any account is how stale the list can be
+    refreshed = db.session.query(func.min(MailboxState.updated)).filter(
+        MailboxState.mailbox == 'failures').scalar()
+
+    return jsonify({
+        'refreshed': refreshed.isoformat() if refreshed else None,
+        'page': messages.page,
+        'pages': messages.pages,
+        'total': messages.total,
+        'messages': [{
+            'uid': message.uid,
+            'subject': message.subject,
+            'from': message.sender,
+            'date': message.date.isoformat() if message.date else None,
+        } for message in messages.items],
+    })
+
+
+def parse_date(value):
+    '''
+    a Date header as a naive utc datetime, or None if it can't be parsed
+    '''
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo:
+        date = date.astimezone(pytz.utc).replace(tzinfo=None)
+    return date
 
 
-def failed_messages():
+def refresh_failures(client, account):
     '''
-    get all of the failed messages subjects to be displayed
-    by the front end
+    bring the header snapshot of one account's "failures" mailbox up to
+    date. only the uids that aren't in the snapshot yet are fetched,
+    and only their From, Subject and Date headers.
+    returns the number of messages fetched.
     '''
-    client = get_client()
-    mail = client.open_session()
     client.verify_mailboxes()
-    mail.select('failures')
-    typ, messages = mail.search(None, '(ALL)')
-    msg_ids = messages[0].split()
-    subjects = []
-    for msg_id in msg_ids:
-        typ, data = mail.fetch(msg_id, "(RFC822)")
-        em = email.message_from_bytes(data[0][1])
+    client.uid = True
+    uidvalidity = client.select('failures')
+
+    state = get_mailbox_state(client, 'failures', uidvalidity)
+    rows = FailedMessageSummary.query.filter_by(account=account)
+    if state.last_uid == 0:
+        # an empty, new or resynced mailbox. the stored uids mean nothing
+        rows.delete(synchronize_session=False)
+        known = set()
+    else:
+        known = {row.uid for row in rows.with_entities(FailedMessageSummary.uid)}
+
+    uids = [int(uid) for uid in client.search('ALL')]
+    gone = known - set(uids)
+    for i in range(0, len(gone), 500):
+        FailedMessageSummary.query.filter(
+            FailedMessageSummary.account == account,
+            FailedMessageSummary.uid.in_(list(gone)[i:i + 500])
+        ).delete(synchronize_session=False)
+
+    new = [uid for uid in uids if uid not in known]
+    chunk_size = int(current_app.config['FETCH_CHUNK_SIZE'])
+    for uid, headers, _ in client.fetch_headers(new, ['From', 'Subject', 'Date'],
+                                                chunk_size, structure=False):
+        db.session.add(FailedMessageSummary(
+            account=account,
+            uid=int(uid),
+            subject=header_text(headers['Subject'] or ''),
+            sender=header_text(headers['From'] or '')[:255],
+            date=parse_date(headers['Date']),
+        ))
+
+    state.last_uid = max(uids, default=0)
+    state.updated = datetime.utcnow()
+    db.session.add(state)
+    db.session.commit()
+
+    return len(new)
+
+
+def refresh_failed_messages():
+    '''
+    a job to refresh the failed messages snapshot of every mail account
+    every FAILED_REFRESH_INTERVAL seconds
+    '''
+    with scheduler.app.app_context():
+        accounts = set()
+        for source in mail_sources():
+            if source.get('path') or uses_api(source):
+                continue
+            account = f'{source["username"]}@{source["server"]}'
+            # mail sources on the same account share a failures mailbox
+            if account in accounts:
+                continue
+            accounts.add(account)
+            try:
+                with connection(source) as client:
+                    count = refresh_failures(client, account)
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception(f'refreshing the failed messages of {account} failed')
+                continue
+            current_app.logger.info(f'refreshed the failed messages of {account}, {count} new')
+
 
-        subjects.append(em['Subject'])
-    return jsonify(subjects)
+def get_mailbox_state(client, mailbox, uidvalidity):
+    '''
+    get the sync position for the mailbox. if the mailbox's uidvalidity
+    has changed the stored uids are meaningless and we start over.
+    '''
+    state = MailboxState.query.filter_by(server=client.server,
+                                         username=client.email,
+                                         mailbox=mailbox).first()
+    if not state:
+        state = MailboxState(server=client.server, username=client.email,
+                             mailbox=mailbox, uidvalidity=uidvalidity,
+                             last_uid=0)
+    elif state.uidvalidity != uidvalidity:
+        current_app.logger.info(f'uidvalidity for {mailbox} changed from {state.uidvalidity} to {uidvalidity}, resyncing')
+        state.uidvalidity = uidvalidity
+        state.last_uid = 0
+
+    return state
+
+
+def sync_mailbox(client, mailbox, providers):
+    '''
+    uid sync mode: look only at messages that arrived since the last
+    processed uid, regardless of whether they have been read.
+    returns the number of messages processed.
+    '''
+    client.uid = True
+    uidvalidity = client.select(mailbox)
+    state = get_mailbox_state(client, mailbox, uidvalidity)
+
+    first = state.last_uid + 1
+    # n:* always matches the newest message, even if it is below n
+    new_uids = [uid for uid in client.search(f'UID {first}:*')
+                if int(uid) >= first]
+
+    # failures below the high-water mark are never searched again,
+    # the ledger knows which of them are due to be retried
+    location = mailbox_location(client, mailbox, uidvalidity)
+    retries = [uid for uid in due_retries(location, providers) if int(uid) < first]
+
+    current_app.logger.info(f'{len(new_uids)} new messages in {mailbox} since uid {state.last_uid}, {len(retries)} failures to retry')
+
+    if not (new_uids or retries):
+        return 0
+
+    count = process_messages(client, retries + new_uids, providers, location)
+
+    state.last_uid = max([int(uid) for uid in new_uids] + [state.last_uid])
+    state.updated = datetime.utcnow()
+    db.session.add(state)
+    db.session.commit()
+
+    return count
+
+
+def sync_history(client, mailbox, providers):
+    '''
+    history sync mode: ask the server which messages were added to the
+    mailbox since the history id of the last run. the first run, and a
+    run whose history id is too old for the server, process the unread
+    messages instead. returns the number of messages processed.
+    '''
+    client.select(mailbox)
+    state = get_mailbox_state(client, mailbox, None)
+
+    msg_ids = None
+    if state.last_uid:
+        msg_ids, history_id = client.history(state.last_uid)
+    if msg_ids is None:
+        # taken before searching so nothing arriving in between is missed
+        history_id = client.history_id()
+        msg_ids = client.search('UNSEEN')
+
+    location = mailbox_location(client, mailbox)
+    retries = [msg_id for msg_id in due_retries(location, providers) if msg_id not in msg_ids]
+
+    current_app.logger.info(f'{len(msg_ids)} new messages in {mailbox} since history id {state.last_uid}, {len(retries)} failures to retry')
+
+    msg_ids = retries + list(msg_ids)
+    count = process_messages(client, msg_ids, providers, location) if msg_ids else 0
+
+    state.last_uid = history_id
+    state.updated = datetime.utcnow()
+    db.session.add(state)
+    db.session.commit()
+
+    return count
+
+
+def process_source(app, source, providers):
+    '''
+    process new messages in one mail source with its own connection.
+    this runs in a worker thread when there are several sources.
+    returns the number of messages processed.
+    '''
+    with app.app_context(), connection(source) as client:
+        mailbox = source['mailbox']
+        start = time.monotonic()
+        fetched = client.bytes_fetched
+        mode = client.sync_mode or current_app.config['MAIL_SYNC_MODE']
+        if mode.lower() == 'uid':
+            count = sync_mailbox(client, mailbox, providers)
+        elif mode.lower() == 'history':
+            count = sync_history(client, mailbox, providers)
+        else:
+            client.uid = False
+            client.select(mailbox)
+            msg_ids = client.search('UNSEEN')
+            count = process_messages(client, msg_ids, providers)
+
+        elapsed = time.monotonic() - start
+        current_app.logger.info(f'{client.email}/{mailbox}: {count} messages in {elapsed:.2f}s ({client.bytes_fetched - fetched} bytes)')
+
+    return count
 
 
 def process():
     '''
-    called on startup and run every CHECK_INTERVAL seconds
+    called on startup and run every CHECK_INTERVAL seconds. every mail
+    source is processed in parallel, up to MAIL_WORKERS at a time.
     '''
-    with scheduler.app.app_context():
-        client = get_client()
-        mail = client.open_session()
-        mail.select(current_app.config['MAILBOX'])
-        for provider in PROVIDERS:
-            p = provider()
-            process_provider(client, mail, p)
+    with scheduler.app.app_context(), PROCESS_LOCK, process_lock('process'):
+        app = scheduler.app
+        # provider rows are created here, before any worker needs them
+        providers = [provider() for provider in PROVIDERS]
+        sources = mail_sources()
+        start = time.monotonic()
+
+        if len(sources) == 1:
+            count = process_source(app, sources[0], providers)
+        else:
+            count = 0
+            workers = min(int(current_app.config['MAIL_WORKERS']), len(sources))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(process_source, app, source, providers): source
+                           for source in sources}
+                for future, source in futures.items():
+                    try:
+                        count += future.result()
+                    except Exception:
+                        current_app.logger.exception(f'processing {source["username"]}/{source["mailbox"]} failed')
+
+        elapsed = time.monotonic() - start
+        rate = count / elapsed if elapsed else 0
+        INGEST_RATE.set(rate)
+        current_app.logger.info(f'processed {count} messages from {len(sources)} mailboxes in {elapsed:.2f}s ({rate:.2f} msgs/sec)')
+
+
+def lock_file(name):
+    '''
+    the open file behind the lock called name in LOCK_DIR
+    '''
+    lock_dir = current_app.config['LOCK_DIR']
+    os.makedirs(lock_dir, exist_ok=True)
+    return open(os.path.join(lock_dir, f'{name}.lock'), 'w')
 
 
-        client.close_session()
+@contextmanager
+def process_lock(name):
+    '''
+    hold the lock called name until the with block exits. the lock is
+    shared by every process of the app on this host, e.g. every uwsgi
+    worker, which a threading.Lock isn't.
+    '''
+    with lock_file(name) as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
+def start_idle_listener(app):
+    '''
+    start listening for new mail with IMAP IDLE on every mail source so
+    that messages are processed as soon as they arrive instead of on the
+    next CHECK_INTERVAL. the interval job keeps running as a safety net.
+    only the first process of the app to get here listens, the others
+    start no listeners.
+    '''
+    global IDLE_LOCK
+
+    listeners = []
+    with app.app_context():
+        f = lock_file('idle')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            app.logger.info('another process is listening for new mail with IDLE')
+            return listeners
+        IDLE_LOCK = f
+
+        for source in mail_sources():
+            if source.get('path') or uses_api(source):
+                continue
+            listener = IdleListener(app, get_client(source), source['mailbox'],
+                                    process, timeout=int(app.config['IDLE_TIMEOUT']))
+            listener.start()
+            app.logger.info(f'listening for new mail on {source["username"]}/{source["mailbox"]} with IDLE')
+            listeners.append(listener)
+    return listeners
@@ -0,0 +1,75 @@
+'''
+the parse stage of processing. providers turn an email into plain data
+with parse and write it to the db with apply. when PARSE_WORKERS is set,
+parse runs in a pool of processes so a backlog is parsed on every core,
+and only apply runs in the process that owns the db session.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+
+from app.MessageView import MessageView
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def parse(provider_class, message):
+    '''
+    run in a worker: parse a message with a provider whose __init__,
+    which needs the db, never ran
+    '''
+    provider = provider_class.__new__(provider_class)
+    return provider.parse(message)
+
+
+def parse_pool(workers):
+    '''
+    the shared process pool, started the first time it's needed and
+    kept for the life of the process. forkserver is used so workers
+    don't inherit the scheduler's threads and locks.
+    '''
+    global _pool, _pool_workers
+    if not workers:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            context = multiprocessing.get_context('forkserver')
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_workers = workers
+        return _pool
+
+
+def parsed_messages(messages, routed, pool=None, window=None):
+    '''
+    yield (msg_id, email, provider, parsed) for each (msg_id, email) in
+    messages, where parsed() returns what the provider's parse made of
+    the email or raises what it raised. the provider parses a MessageView
+    of the email, so its parts are decoded once; an email that already is
+    one is parsed and yielded as it is. with a pool, up to
+    window emails are being parsed at once and they are still yielded in
+    order.
+    '''
+    if pool is None:
+        for msg_id, em in messages:
+            provider = routed[msg_id]
+            message = MessageView.of(em)
+            yield msg_id, em, provider, (lambda provider=provider, message=message: provider.parse(message))
+        return
+
+    window = window or pool._max_workers * 4
+    pending = []
+    for msg_id, em in messages:
+        provider = routed[msg_id]
+        pending.append((msg_id, em, provider,
+                        pool.submit(parse, type(provider), MessageView.of(em)).result))
+        if len(pending) >= window:
+            yield pending.pop(0)
+
+    while pending:
+        yield pending.pop(0)
@@ -258,4 +258,5 @@ def failed():
 
 @bp.route('/failedmessages')
 def failedmessages():
-    return failed_messages()
+    page = request.args.get('page', 1, type=int)
+    return failed_messages(page)
@@ -0,0 +1,205 @@
+'''
+reads the VEVENTs of MAINTNOTE calendars, see
+https://github.com/jda/maintnote-std/blob/master/standard.md
+
+the notices only need a few properties of each event, so instead of
+building icalendar's component tree the calendar's lines are unfolded
+and read in one pass, keeping just those. anything the fast path isn't
+sure of is left to icalendar, and either way the properties come back
+as the same plain values. that includes what icalendar 4, the version
+the image runs, reads differently from later versions.
+'''
+import datetime
+import re
+
+import icalendar
+import pytz
+from prometheus_client import Counter
+
+from app import registry
+
+
+FALLBACKS = Counter('janitor_maintnote_fallbacks_total',
+                    'calendars that were left to icalendar by the MAINTNOTE parser',
+                    registry=registry
+                    )
+
+# the properties kept besides the X-MAINTNOTE ones
+PROPERTIES = {'DTSTART', 'DTEND', 'SEQUENCE', 'DESCRIPTION', 'SUMMARY', 'UID'}
+TEXT = {'DESCRIPTION', 'SUMMARY', 'UID'}
+DATES = {'DTSTART', 'DTEND'}
+
+# icalendar's unfolding and line splitting
+UNFOLD = re.compile(r'(\r?\n)+[ \t]')
+NEWLINE = re.compile(r'\r?\n')
+TEXT_ESCAPE = re.compile(r'\\([\\,;:nN])')
+# icalendar 4 turns an escaped backslash followed by n into a newline
+ESCAPED_BACKSLASH = '\\\\'
+DATETIME = re.compile(r'(\d{4})(\d\d)(\d\d)T(\d\d)(\d\d)(\d\d)(Z?)')
+UTC = pytz.utc
+# icalendar 4 raises on a value it can't read, newer ones keep it as vBroken
+BROKEN = getattr(icalendar, 'vBroken', ())
+
+
+class UnusualCalendar(Exception):
+    '''
+    the calendar uses something the fast path doesn't read
+    '''
+
+
+def unescape(value):
+    '''
+    TEXT unescaping, in one pass like icalendar's
+    '''
+    if '\\' not in value:
+        return value
+    return TEXT_ESCAPE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def read_datetime(params, value):
+    '''
+    a UTC, floating or TZID date-time. other zones and plain dates are
+    left to icalendar.
+    '''
+    match = DATETIME.fullmatch(value)
+    if not match:
+        raise UnusualCalendar(f'date-time {value}')
+    *fields, utc = match.groups()
+    try:
+        dt = datetime.datetime(*map(int, fields))
+    except ValueError:
+        raise UnusualCalendar(f'date-time {value}')
+
+    if not params:
+        return dt.replace(tzinfo=UTC) if utc else dt
+    if utc or len(params) != 1 or not params[0].upper().startswith('TZID='):
+        raise UnusualCalendar(f'date-time parameters {params}')
+    try:
+        zone = pytz.timezone(params[0][5:])
+    except pytz.UnknownTimeZoneError:
+        # a zone only its VTIMEZONE defines
+        raise UnusualCalendar(f'time zone {params[0]}')
+    try:
+        return zone.localize(dt, is_dst=None)
+    except (pytz.AmbiguousTimeError, pytz.NonExistentTimeError):
+        # icalendar 4 reads a time that happens twice as the second one
+        # and later versions as the first
+        raise UnusualCalendar(f'date-time {value} in {params[0]}')
+
+
+def read_value(name, params, value):
+    if name in DATES:
+        return read_datetime(params, value)
+    if name == 'SEQUENCE':
+        if params or not (value.isascii() and value.isdigit()):
+            raise UnusualCalendar(f'sequence {value}')
+        return int(value)
+    if name in TEXT:
+        if ESCAPED_BACKSLASH in value:
+            raise UnusualCalendar(f'escaped backslash in {name}')
+        return unescape(value)
+    if '\\' in value:
+        # icalendar 4 unescapes unknown properties, later versions don't
+        raise UnusualCalendar(f'escape in {name}')
+    # icalendar leaves unknown properties as they are
+    return value
+
+
+def fast_events(data):
+    '''
+    the properties of the calendar's VEVENTs, read line by line. raises
+    UnusualCalendar when icalendar is needed.
+    '''
+    if isinstance(data, bytes):
+        try:
+            data = data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise UnusualCalendar('not utf-8')
+
+    events = []
+    # the components the current line is in
+    stack = []
+    event = None
+    for line in NEWLINE.split(UNFOLD.sub('', data)):
+        if not line:
+            continue
+        name, sep, rest = line.partition(':')
+        name = name.split(';', 1)[0].upper()
+
+        if name in ('BEGIN', 'END'):
+            component = rest.strip().upper()
+            if name == 'BEGIN':
+                if not stack and component != 'VCALENDAR':
+                    raise UnusualCalendar(f'starts with {component}')
+                stack.append(component)
+                if stack == ['VCALENDAR', 'VEVENT']:
+                    event = {}
+            else:
+                if not stack or stack.pop() != component:
+                    raise UnusualCalendar(f'unbalanced END:{component}')
+                if component == 'VEVENT' and stack == ['VCALENDAR']:
+                    events.append(event)
+                    event = None
+                if not stack:
+                    return events
+            continue
+
+        if event is None or len(stack) != 2:
+            continue
+        if name not in PROPERTIES and not name.startswith('X-MAINTNOTE-'):
+            continue
+
+        head, sep, value = line.partition(':')
+        if not sep or '"' in head:
+            # a quoted parameter can hold a colon, icalendar splits those
+            raise UnusualCalendar(f'property line {line}')
+        params = head.split(';')[1:]
+        if name in DATES and params and not head.split(';', 1)[0].isupper():
+            # icalendar 4 ignores the TZID of a lower case name
+            raise UnusualCalendar(f'property line {line}')
+        value = read_value(name, params, value)
+
+        if name not in event:
+            event[name] = value
+        elif isinstance(event[name], list):
+            event[name].append(value)
+        else:
+            event[name] = [event[name], value]
+
+    raise UnusualCalendar('no END:VCALENDAR')
+
+
+def plain(value):
+    if isinstance(value, BROKEN):
+        # a value icalendar couldn't read, as it was written
+        return str(value)
+    if hasattr(value, 'dt'):
+        return value.dt
+    if isinstance(value, int):
+        return int(value)
+    return str(value)
+
+
+def event_values(event):
+    '''
+    the properties fast_events keeps, from an icalendar VEVENT
+    '''
+    return {name: [plain(v) for v in value] if isinstance(value, list) else plain(value)
+            for name, value in event.items()
+            if name in PROPERTIES or name.startswith('X-MAINTNOTE-')}
+
+
+def events(data):
+    '''
+    the properties of each VEVENT of a calendar as plain values: strings
+    or lists of them for repeated properties, datetimes and an int
+    SEQUENCE. raises ValueError when data isn't a calendar.
+    '''
+    try:
+        return fast_events(data)
+    except UnusualCalendar:
+        FALLBACKS.inc()
+
+    calendar = icalendar.Calendar.from_ical(data)
+    return [event_values(component) for component in calendar.subcomponents
+            if component.name == 'VEVENT']
@@ -90,6 +90,104 @@ class MaintUpdate(db.Model):
     updated = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class MailboxState(db.Model):
+    '''
+    the sync position for a mailbox: the last uid that was processed
+    and the uidvalidity it belongs to.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    server = db.Column(db.VARCHAR(128))
+    username = db.Column(db.VARCHAR(128))
+    mailbox = db.Column(db.VARCHAR(128))
+    uidvalidity = db.Column(db.BigInteger, nullable=True)
+    last_uid = db.Column(db.BigInteger, default=0)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('server', 'username', 'mailbox'),)
+
+    def __repr__(self):
+        return f'<MailboxState {self.username}/{self.mailbox} uid: {self.last_uid}>'
+
+
+class BackfillState(db.Model):
+    '''
+    the checkpoint of a backfill of a mailbox over a date range: the
+    last uid of the last chunk that was committed.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    server = db.Column(db.VARCHAR(128))
+    username = db.Column(db.VARCHAR(128))
+    mailbox = db.Column(db.VARCHAR(128))
+    since = db.Column(db.Date)
+    until = db.Column(db.Date)
+    uidvalidity = db.Column(db.BigInteger, nullable=True)
+    last_uid = db.Column(db.BigInteger, default=0)
+    processed = db.Column(db.INT, default=0)
+    started = db.Column(db.DateTime, default=datetime.utcnow)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('server', 'username', 'mailbox', 'since', 'until'),)
+
+    def __repr__(self):
+        return f'<BackfillState {self.username}/{self.mailbox} {self.since} - {self.until} uid: {self.last_uid}>'
+
+
+class FailedMessage(db.Model):
+    '''
+    a message a provider was unable to process. used to back off from
+    retrying it until the parser has changed.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.VARCHAR(255), index=True, unique=True)
+    body_hash = db.Column(db.VARCHAR(64))
+    provider = db.Column(db.VARCHAR(128))
+    # the mailbox and id it was found at by the uid or history sync mode
+    location = db.Column(db.VARCHAR(255), index=True, nullable=True)
+    uid = db.Column(db.VARCHAR(64), nullable=True)
+    subject = db.Column(db.TEXT(), nullable=True)
+    parser_version = db.Column(db.VARCHAR(64))
+    attempts = db.Column(db.INT, default=0)
+    first_failed = db.Column(db.DateTime, default=datetime.utcnow)
+    last_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<FailedMessage {self.message_id} attempts: {self.attempts}>'
+
+
+class ProcessedMessage(db.Model):
+    '''
+    a message that was processed successfully. copies of it, sent to
+    another alias, forwarded or resent, are recognised by their
+    Message-ID or their normalized body hash and never parsed again.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.VARCHAR(255), index=True, unique=True)
+    body_hash = db.Column(db.VARCHAR(64), index=True)
+    provider = db.Column(db.VARCHAR(128))
+    processed = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ProcessedMessage {self.message_id}>'
+
+
+class FailedMessageSummary(db.Model):
+    '''
+    the headers of a message in an account's "failures" mailbox, refreshed
+    in the background for the failed messages page. when the account was
+    last refreshed is kept in its MailboxState.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.VARCHAR(255), index=True)
+    uid = db.Column(db.BigInteger)
+    subject = db.Column(db.TEXT(), nullable=True)
+    sender = db.Column(db.VARCHAR(255), nullable=True)
+    date = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<FailedMessageSummary {self.account} uid: {self.uid}>'
+
+
 class ApschedulerJobs(db.Model):
     id = db.Column(db.VARCHAR(191), primary_key=True)
     next_run_time = db.Column(db.FLOAT)
@@ -0,0 +1,310 @@
+'''
+microbenchmarks of the provider parsers on the sample notices in
+tests/notices.py, against the extraction they replaced, and the cost
+of importing the providers in a new worker. run from the project root
+with:
+
+    python -m benchmarks.providers
+'''
+import io
+import re
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from email import message_from_string
+
+import bs4
+import icalendar
+from lxml import etree
+
+from app import maintnote
+from app.MessageView import MessageView
+from app.Providers import GTT, NTT, Telia, Telstra, Zayo, html_tree
+from tests.notices import gtt_notice, maintnote_notice, telia_notice, telstra_notice, zayo_notice
+
+
+def legacy_gtt_fields(text):
+    '''
+    GTT.add_new_maint's extraction before the fields were precompiled
+    '''
+    start_re = re.search(r'Start: (.*)(\r|\n)', text)
+    end_re = re.search(r'End: (.*)(\r|\n)', text)
+    location_re = re.search(r'Location: (.*)(\r|\n)', text)
+    reason_re = re.search(r'Reason: (.*)(\r|\n)', text)
+    impact_re = re.search(r'Impact: (.*)(\r|\n)', text)
+
+    cids = set()
+    a_side = set()
+    for line in text.splitlines():
+        if 'gtt service' in line.lower():
+            cid = re.search(r'GTT Service = (.+);', line)
+            if cid:
+                cids.add(cid.groups()[0])
+        elif line.lower().startswith('site address'):
+            loc = re.search(r'= (.*)', line)
+            if loc:
+                a_side.add(loc.groups()[0])
+        elif line.lower().startswith('location ='):
+            loc = re.search(r'= (.*)', line)
+            if loc:
+                a_side.add(loc.groups()[0])
+
+    return {
+        'start': start_re.groups()[0],
+        'end': end_re.groups()[0],
+        'location': location_re.groups()[0],
+        'reason': reason_re.groups()[0],
+        'impact': impact_re.groups()[0],
+        'cids': cids,
+        'a_sides': a_side,
+    }
+
+
+def legacy_telia_fields(msg):
+    '''
+    Telia.add_new_maint's extraction before the fields were precompiled
+    '''
+    provider_id = re.search(r'(?<=pw reference number: )\S+', msg.lower())
+    start_time = re.search('(?<=start date and time: ).+', msg.lower())
+    end_time = re.search('(?<=end date and time: ).+', msg.lower())
+    reason = re.search('(?<=action and reason: ).+', msg.lower())
+    location = re.search('(?<=location of work: ).+', msg.lower())
+    cids = re.findall('service id: (.*)\r', msg.lower())
+    impact = re.findall('impact: (.*)\r', msg.lower())
+    return {
+        'maint_id': provider_id.group(),
+        'start': start_time.group(),
+        'end': end_time.group(),
+        'reason': reason.group(),
+        'location': location.group(),
+        'cids': cids,
+        'impacts': impact,
+    }
+
+
+def legacy_zayo_circuits(table):
+    '''
+    Zayo.format_circuit_table before the table was read directly, with
+    pandas' NaN for empty cells turned into None to compare
+    '''
+    import pandas as pd
+    ptable = pd.read_html(io.StringIO(table))
+    assert len(ptable) == 1
+    return [tuple(None if value != value else value for value in row)
+            for row in ptable[0].values.tolist()]
+
+
+def html_part(email):
+    return next(part for part in email.walk() if part.get_content_type() == 'text/html')
+
+
+def legacy_gtt_parse(email):
+    '''
+    GTT.parse before the body was read with lxml
+    '''
+    return bs4.BeautifulSoup(html_part(email).get_payload(decode=True).decode(),
+                             features='lxml').text
+
+
+def legacy_zayo_parse(email):
+    '''
+    Zayo.parse before the body was read with lxml
+    '''
+    soup = bs4.BeautifulSoup(html_part(email).get_payload(), features='lxml')
+    fields = []
+    for line in soup.find_all('b'):
+        sibling = line.next_sibling
+        fields.append((line.text, str(sibling) if sibling is not None else None))
+    table = soup.find('table')
+    return {'fields': fields, 'has_table': bool(table),
+            'circuits': legacy_zayo_circuits(str(table)), 'text': soup.text}
+
+
+def legacy_telstra_parse(email):
+    '''
+    Telstra.parse before the body was read with lxml
+    '''
+    clean_line = Telstra.__new__(Telstra).clean_line
+    soup = bs4.BeautifulSoup(clean_line(html_part(email).get_payload()), features='lxml')
+    notice = {'impact': None, 'cid': None, 'date': None, 'details': []}
+    for column in soup.find_all('th'):
+        try:
+            if 'expected impact' in clean_line(column.text.lower()):
+                notice['impact'] = clean_line(column.next_sibling.next_sibling.text)
+            elif 'service(s) impacted' in clean_line(column.text.lower()):
+                try:
+                    tmp = clean_line(column.next_sibling.next_sibling.text)
+                except AttributeError:
+                    tmp = clean_line(column.next_sibling.text)
+                if '<' in tmp and '>' in tmp:
+                    notice['cid'] = bs4.BeautifulSoup(tmp, features='lxml').text
+                else:
+                    notice['cid'] = tmp
+            elif 'maintenance window' in clean_line(column.text.lower()):
+                notice['date'] = clean_line(column.next_sibling.next_sibling.text)
+        except AttributeError:
+            continue
+    details = []
+    for i in soup.find_all('tr'):
+        if 'maintenance details' in i.text.lower():
+            details = i.find_next_siblings('tr')
+            break
+    for line in details:
+        if 'service(s) impacted' in line.text.lower():
+            break
+        notice['details'].append(clean_line(line.text))
+    return notice
+
+
+def legacy_maintnote_parse(email):
+    '''
+    StandardProvider.parse before the MAINTNOTE parser, which built the
+    whole calendar with icalendar
+    '''
+    for part in email.walk():
+        if part.get_content_type() == 'text/calendar':
+            calendar = icalendar.Calendar.from_ical(part.get_payload())
+            return [e for e in calendar.subcomponents if e.name == 'VEVENT'][-1]
+
+
+def legacy_zayo_action(subject):
+    '''
+    Zayo.apply's if/elif chain before the subject rule tables
+    '''
+    if subject.startswith('***') and 'maintenance notification' in subject.lower():
+        return 'add_new_maint'
+    elif subject.lower().startswith('reschedule notification'):
+        return 'add_reschedule_maint'
+    elif subject.lower().startswith('start maintenance notification'):
+        return 'add_start_maint'
+    elif subject.lower().startswith('completed maintenance notification') or \
+    subject.lower().startswith('end of window'):
+        return 'add_end_maint'
+    elif subject.lower().startswith('cancelled notification'):
+        return 'add_cancelled_maint'
+    elif 'TTN-' in subject and 'exten' in subject.lower():
+        return 'update'
+    elif 'TTN-' in subject and 'maintenance notification' in subject.lower():
+        return 'update'
+    return None
+
+
+ZAYO_SUBJECTS = [
+    '***Some Customer***ZAYO TTN-0001234567 MAINTENANCE NOTIFICATION***',
+    'RESCHEDULE NOTIFICATION***Some Customer***ZAYO TTN-0001234567***',
+    'START MAINTENANCE NOTIFICATION***Some Customer***ZAYO TTN-0001234567***',
+    'COMPLETED MAINTENANCE NOTIFICATION***Some Customer***ZAYO TTN-0001234567***',
+    'END OF WINDOW NOTIFICATION***Some Customer***ZAYO TTN-0001234567***',
+    'CANCELLED NOTIFICATION***Some Customer***ZAYO TTN-0001234567***',
+    'Re: ZAYO TTN-0001234567 Maintenance Window Extension',
+    'Re: ZAYO TTN-0001234567 Maintenance Notification',
+    'Zayo quarterly newsletter',
+]
+
+
+def bench(name, legacy, current, arg, number=2000):
+    old = min(timeit.repeat(lambda: legacy(arg), number=number, repeat=5)) / number
+    new = min(timeit.repeat(lambda: current(arg), number=number, repeat=5)) / number
+    print(f'{name:<12} {old * 1e6:10.1f}us {new * 1e6:10.1f}us {old / new:6.1f}x')
+
+
+def peak_memory(func, arg):
+    '''
+    the peak python heap while func(arg) runs, in KiB. lxml's own tree
+    is allocated by libxml2 and isn't counted.
+    '''
+    func(arg)
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def startup(imports):
+    '''
+    seconds and peak rss in MiB of a new interpreter importing imports.
+    the peak is read from /proc, linux keeps ru_maxrss across exec so
+    it would be this process's.
+    '''
+    code = (
+        'import re, time\n'
+        'start = time.perf_counter()\n'
+        f'import {imports}\n'
+        'seconds = time.perf_counter() - start\n'
+        'hwm = re.search(r"VmHWM:\\s+(\\d+)", open("/proc/self/status").read())\n'
+        'print(seconds, int(hwm.group(1)) / 1024)\n'
+    )
+    runs = [subprocess.run([sys.executable, '-c', code], capture_output=True,
+                           text=True, check=True).stdout.split() for _ in range(3)]
+    return min(float(seconds) for seconds, _ in runs), min(float(rss) for _, rss in runs)
+
+
+def main():
+    gtt = GTT.__new__(GTT)
+    telia = Telia.__new__(Telia)
+    gtt_email = gtt_notice()
+    gtt_text = gtt.parse(gtt_email)
+    assert legacy_gtt_parse(gtt_email) == gtt_text
+    telia_text = telia.parse(telia_notice())
+
+    # the same fields either way, apart from GTT's values losing a stray \r
+    # and the circuits keeping their order
+    legacy, current = legacy_gtt_fields(gtt_text), gtt.get_fields(gtt_text)
+    assert {k: v.rstrip('\r') for k, v in legacy.items() if isinstance(v, str)} == \
+        {k: v for k, v in current.items() if isinstance(v, str)}
+    assert legacy['cids'] == set(current['cids'])
+    assert legacy['a_sides'] == set(current['a_sides'])
+    assert legacy_telia_fields(telia_text) == telia.get_fields(telia_text)
+
+    zayo = Zayo.__new__(Zayo)
+    telstra = Telstra.__new__(Telstra)
+    zayo_email, telstra_email = zayo_notice(), telstra_notice()
+    assert legacy_zayo_parse(zayo_email) == zayo.parse(zayo_email)
+    assert legacy_telstra_parse(telstra_email) == telstra.parse(telstra_email)
+
+    ntt = NTT.__new__(NTT)
+    ntt_email = maintnote_notice()
+    assert maintnote.event_values(legacy_maintnote_parse(ntt_email)) == ntt.parse(ntt_email)[-1]
+
+    rules = zayo.subject_rules
+    # the rules match the subject the message's view has already decoded
+    # for the duplicate check, as apply does
+    subjects = [MessageView(message_from_string(f'Subject: {s}\r\n\r\n')).subject
+                for s in ZAYO_SUBJECTS]
+    assert [legacy_zayo_action(s) for s in ZAYO_SUBJECTS] == \
+        [rule.action if rule else None for rule in map(rules.match, subjects)]
+
+    def legacy_table(table):
+        return legacy_zayo_circuits(etree.tostring(table, encoding='unicode'))
+
+    table = next(html_tree(html_part(zayo_email).get_payload()).iter('table'))
+
+    print(f'{"parser":<12} {"before":>12} {"after":>12} {"speedup":>7}')
+    bench('gtt parse', legacy_gtt_parse, gtt.parse, gtt_email, number=500)
+    bench('gtt', legacy_gtt_fields, gtt.get_fields, gtt_text)
+    bench('telia', legacy_telia_fields, telia.get_fields, telia_text)
+    bench('zayo table', legacy_table, zayo.format_circuit_table, table, number=200)
+    bench('zayo', legacy_zayo_parse, zayo.parse, zayo_email, number=100)
+    bench('telstra', legacy_telstra_parse, telstra.parse, telstra_email, number=200)
+    bench('maintnote', legacy_maintnote_parse, ntt.parse, ntt_email, number=500)
+    bench('zayo subject', lambda subjects: [legacy_zayo_action(s) for s in subjects],
+          lambda _: [rules.match(s) for s in subjects], ZAYO_SUBJECTS)
+
+    print()
+    print(f'{"peak heap":<12} {"before":>10} {"after":>10}')
+    for name, legacy, current, email in (('zayo', legacy_zayo_parse, zayo.parse, zayo_email),
+                                         ('telstra', legacy_telstra_parse, telstra.parse, telstra_email)):
+        print(f'{name:<12} {peak_memory(legacy, email):7.0f}KiB {peak_memory(current, email):7.0f}KiB')
+
+    print()
+    print(f'{"worker import":<24} {"seconds":>8} {"rss MiB":>8}')
+    for name, imports in (('before (with pandas)', 'app.Providers, pandas'),
+                          ('after', 'app.Providers')):
+        seconds, rss = startup(imports)
+        print(f'{name:<24} {seconds:8.3f} {rss:8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -26,11 +26,29 @@ class Config(object):
     TZ_PREFIX = os.environ.get('TZ_PREFIX')
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAILBOX = os.environ.get('MAILBOX') or 'INBOX'
+    MAIL_SYNC_MODE = os.environ.get('MAIL_SYNC_MODE') or 'unseen'
+    MAIL_SOURCES = os.environ.get('MAIL_SOURCES')
+    MAIL_WORKERS = os.environ.get('MAIL_WORKERS') or 4
+    MAIL_IDLE = (os.environ.get('MAIL_IDLE') or '').lower() in ('1', 'true', 'yes')
+    IDLE_TIMEOUT = os.environ.get('IDLE_TIMEOUT') or 29 * 60
+    LOCK_DIR = os.environ.get('LOCK_DIR') or '/tmp/janitor_locks'
+    IMAP_KEEPALIVE = os.environ.get('IMAP_KEEPALIVE') or 300
     SLACK_WEBHOOK_URL = os.environ.get('SLACK_WEBHOOK_URL')
     SLACK_CHANNEL = os.environ.get('SLACK_CHANNEL')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_CLIENT = os.environ.get('MAIL_CLIENT')
+    GMAIL_TOKEN_FILE = os.environ.get('GMAIL_TOKEN_FILE') or os.path.join(basedir, 'gmail_token.json')
+    GMAIL_API_ROOT = os.environ.get('GMAIL_API_ROOT') or 'https://gmail.googleapis.com/'
+    FETCH_CHUNK_SIZE = os.environ.get('FETCH_CHUNK_SIZE') or 50
+    FETCH_CHUNK_MAX = os.environ.get('FETCH_CHUNK_MAX') or 500
+    FETCH_CONNECTIONS = os.environ.get('FETCH_CONNECTIONS') or 2
+    FETCH_PIPELINE = os.environ.get('FETCH_PIPELINE') or 4
+    PARSE_WORKERS = os.environ.get('PARSE_WORKERS') or 0
+    MAX_PART_SIZE = os.environ.get('MAX_PART_SIZE') or 1024 * 1024
+    FAILURE_BACKOFF = os.environ.get('FAILURE_BACKOFF') or 600
+    FAILURE_MAX_ATTEMPTS = os.environ.get('FAILURE_MAX_ATTEMPTS') or 10
+    FAILED_REFRESH_INTERVAL = os.environ.get('FAILED_REFRESH_INTERVAL') or 600
     PROMETHEUS_DIR = os.environ.get('prometheus_multiproc_dir') or os.environ.get('PROMETHEUS_DIR')
     # Uploads
     UPLOADS_DEFAULT_DEST = os.environ.get('UPLOADS_DEFAULT_DEST') or PROJECT_ROOT + '/app/static/circuits/'
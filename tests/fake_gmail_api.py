@@ -0,0 +1,156 @@
+'''
+a tiny stand in for the gmail rest api, with batch requests, for
+exercising the GmailAPI mail client without google.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import base64
+import email
+import json
+import threading
+
+
+PREFIX = '/gmail/v1/users/me/'
+
+
+class FakeGmailAPIHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.startswith('/batch/'):
+            return self.batch(body)
+        status, response = self.server.route(method, self.path, body)
+        self._respond(status, 'application/json', json.dumps(response).encode())
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def batch(self, body):
+        self.server.batches += 1
+        boundary = 'batch_response'
+        envelope = email.message_from_bytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        parts = []
+        for part in envelope.get_payload():
+            request = part.get_payload().replace('\r\n', '\n')
+            request_line, _, rest = request.partition('\n')
+            method, path, _ = request_line.split(' ', 2)
+            inner_body = rest.split('\n\n', 1)[1] if '\n\n' in rest else ''
+            if self.server.throttle:
+                self.server.throttle -= 1
+                status, response = 429, {'error': {'code': 429, 'message': 'rate limit exceeded'}}
+            else:
+                status, response = self.server.route(method, path, inner_body.encode())
+            content_id = part['Content-ID'].strip()
+            parts.append(
+                f'--{boundary}\r\n'
+                'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id[1:]}\r\n\r\n'
+                f'HTTP/1.1 {status} status\r\n'
+                'Content-Type: application/json\r\n\r\n'
+                f'{json.dumps(response)}\r\n'
+            )
+        self._respond(200, f'multipart/mixed; boundary={boundary}',
+                      (''.join(parts) + f'--{boundary}--\r\n').encode())
+
+
+class FakeGmailAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeGmailAPIHandler)
+        self.lock = threading.Lock()
+        self.labels = {'INBOX': 'INBOX', 'UNREAD': 'UNREAD'}
+        # id: (raw message, set of label ids), in the order they arrived
+        self.messages = {}
+        self.history = []
+        self.history_id = 100
+        # history ids before this one are gone
+        self.oldest_history = 0
+        # the number of batched calls to answer with 429
+        self.throttle = 0
+        self.batches = 0
+
+    @property
+    def root(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def add(self, raw, labels=('INBOX', 'UNREAD')):
+        with self.lock:
+            msg_id = f'{len(self.messages) + 1:x}'.zfill(16)
+            self.messages[msg_id] = (raw, set(labels))
+            self.history_id += 1
+            self.history.append((self.history_id, msg_id))
+            return msg_id
+
+    def route(self, method, path, body):
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        path = url.path[len(PREFIX):] if url.path.startswith(PREFIX) else url.path
+        with self.lock:
+            if path == 'labels' and method == 'GET':
+                return 200, {'labels': [{'id': i, 'name': n} for n, i in self.labels.items()]}
+            if path == 'labels' and method == 'POST':
+                name = json.loads(body)['name']
+                self.labels[name] = f'Label_{len(self.labels)}'
+                return 200, {'id': self.labels[name], 'name': name}
+            if path == 'profile':
+                return 200, {'emailAddress': 'janitor@example.com', 'historyId': str(self.history_id)}
+            if path == 'history':
+                start = int(query['startHistoryId'][0])
+                if start < self.oldest_history:
+                    return 404, {'error': {'code': 404, 'message': 'history id too old'}}
+                label = query.get('labelId', [None])[0]
+                records = [{'id': str(h), 'messagesAdded': [{'message': {'id': m}}]}
+                           for h, m in self.history
+                           if h > start and (not label or label in self.messages[m][1])]
+                return 200, {'history': records, 'historyId': str(self.history_id)}
+            if path == 'messages' and method == 'GET':
+                label = query.get('labelIds', [None])[0]
+                unread = 'is:unread' in query.get('q', [''])[0]
+                ids = [m for m, (_, labels) in self.messages.items()
+                       if (not label or label in labels) and (not unread or 'UNREAD' in labels)]
+                return 200, {'messages': [{'id': m} for m in reversed(ids)]}
+            if path == 'messages/batchModify':
+                change = json.loads(body)
+                for msg_id in change['ids']:
+                    labels = self.messages[msg_id][1]
+                    labels.update(change.get('addLabelIds', []))
+                    labels.difference_update(change.get('removeLabelIds', []))
+                return 200, {}
+            if path.startswith('messages/'):
+                msg_id = path.split('/')[1]
+                if msg_id not in self.messages:
+                    return 404, {'error': {'code': 404, 'message': 'not found'}}
+                raw, labels = self.messages[msg_id]
+                if query.get('format') == ['metadata']:
+                    wanted = {h.lower() for h in query.get('metadataHeaders', [])}
+                    headers = [{'name': k, 'value': v}
+                               for k, v in email.message_from_bytes(raw).items()
+                               if k.lower() in wanted]
+                    return 200, {'id': msg_id, 'labelIds': sorted(labels),
+                                 'payload': {'headers': headers}}
+                return 200, {'id': msg_id, 'labelIds': sorted(labels),
+                             'raw': base64.urlsafe_b64encode(raw).decode()}
+        return 404, {'error': {'code': 404, 'message': f'no route for {method} {path}'}}
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
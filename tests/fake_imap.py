@@ -0,0 +1,156 @@
+'''
+a tiny plaintext imap server for exercising the mail clients
+without a real mail server.
+'''
+import queue
+import socket
+import socketserver
+import threading
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        server.sockets.append(self.request)
+        self.send('* OK fake imap ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, args = (line.decode().strip().split(' ', 2) + [''])[:3]
+            command = command.upper()
+            server.commands.append(command)
+            server.lines.append(f'{command} {args}'.strip())
+
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1 IDLE')
+                self.send(f'{tag} OK CAPABILITY completed')
+            elif command == 'LOGIN':
+                self.send(f'{tag} OK LOGIN completed')
+            elif command in ('SELECT', 'EXAMINE') and server.refuse_select:
+                server.refuse_select -= 1
+                self.send(f'{tag} NO [UNAVAILABLE] try again later')
+            elif command in ('SELECT', 'EXAMINE'):
+                self.send(f'* {len(server.messages)} EXISTS')
+                self.send(f'* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid')
+                self.send(f'{tag} OK [READ-WRITE] SELECT completed')
+            elif command == 'SEARCH':
+                self.send('* SEARCH')
+                self.send(f'{tag} OK SEARCH completed')
+            elif command in ('FETCH', 'UID'):
+                self.fetch(tag, command, args)
+            elif command in ('NOOP', 'STORE'):
+                self.send(f'{tag} OK {command} completed')
+            elif command == 'IDLE':
+                if server.drop_idle:
+                    server.drop_idle -= 1
+                    return
+                self.send('+ idling')
+                self.idle(tag)
+            elif command in ('CLOSE', 'LOGOUT'):
+                if command == 'LOGOUT':
+                    self.send('* BYE logging out')
+                self.send(f'{tag} OK {command} completed')
+                if command == 'LOGOUT':
+                    return
+            else:
+                self.send(f'{tag} BAD unknown command {command}')
+
+    def fetch(self, tag, command, args):
+        # every message is returned whole, its uid is its sequence number
+        if command == 'UID':
+            args = args.split(' ', 1)[1]
+        if self.server.throttle:
+            self.server.throttle -= 1
+            self.send(f'{tag} NO [THROTTLED] too many requests')
+            return
+        msg_ids = set()
+        for part in args.split(' ', 1)[0].split(','):
+            start, _, end = part.partition(':')
+            msg_ids.update(range(int(start), int(end or start) + 1))
+        for msg_id in sorted(msg_ids):
+            if 1 <= msg_id <= len(self.server.messages):
+                body = self.server.messages[msg_id - 1]
+                self.wfile.write(f'* {msg_id} FETCH (UID {msg_id} BODY[] {{{len(body)}}}\r\n'.encode()
+                                 + body + b')\r\n')
+        if self.server.throttle_ok:
+            # gmail's slow down: the data, then a throttled OK
+            self.server.throttle_ok -= 1
+            self.send(f'{tag} OK [THROTTLED] FETCH completed')
+        else:
+            self.send(f'{tag} OK FETCH completed')
+
+    def idle(self, tag):
+        # push any queued untagged responses until the client sends DONE
+        done = threading.Event()
+
+        def wait_for_done():
+            self.rfile.readline()
+            done.set()
+
+        threading.Thread(target=wait_for_done, daemon=True).start()
+        while not done.is_set():
+            try:
+                line = self.server.pushes.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            self.send(line)
+        self.send(f'{tag} OK IDLE terminated')
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.messages = []
+        self.uidvalidity = 1
+        self.commands = []
+        self.lines = []
+        self.connections = 0
+        self.sockets = []
+        # the number of IDLE commands to answer by dropping the connection
+        self.drop_idle = 0
+        # the number of SELECT commands to refuse
+        self.refuse_select = 0
+        # the number of FETCH commands to refuse as throttled
+        self.throttle = 0
+        # the number of FETCH commands to answer with OK [THROTTLED]
+        self.throttle_ok = 0
+        self.pushes = queue.Queue()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def push(self, line):
+        '''
+        send an untagged response to the client while it IDLEs
+        '''
+        self.pushes.put(line)
+
+    def hangup(self):
+        '''
+        drop every open connection, like a server timing out idle clients
+        '''
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sockets = []
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
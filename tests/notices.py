@@ -0,0 +1,219 @@
+'''
+sample provider notices, shaped like the real ones, for the parser tests
+and the benchmarks
+'''
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+RECEIVED = 'from mail.example.com by mx.example.com;\n Tue, 1 Jun 2021 10:00:00 +0000'
+
+GTT_FILLER = (
+    '<p>Dear Customer, GTT would like to inform you of planned work on our '
+    'network. Please find the details below.</p>\r\n'
+)
+
+GTT_HTML = (
+    '<html><head><title>GTT</title></head><body>\r\n' + GTT_FILLER * 8 +
+    '<p>Start: 2021-06-01 01:00 UTC\r\n</p>'
+    '<p>End: 2021-06-01 05:00 UTC\r\n</p>'
+    '<p>Location: Frankfurt, DE\r\n</p>'
+    '<p>Reason: Fiber relocation\r\n</p>'
+    '<p>Impact: Up to 30 minutes of outage\r\n</p>\r\n' +
+    ''.join(f'<p>GTT Service = GTT-{i:05d}; Customer = Example\r\n</p>'
+            f'<p>Site Address = {i} Main St, Frankfurt\r\n</p>' for i in range(6)) +
+    GTT_FILLER * 8 + '</body></html>'
+)
+
+TELIA_FILLER = (
+    'Dear Telia Carrier customer, please be informed of the planned work '
+    'below. We apologise for any inconvenience this may cause.\r\n'
+)
+
+TELIA_TEXT = (
+    TELIA_FILLER * 6 +
+    'PW Reference number: PWIC123456\r\n'
+    'Start Date and Time: 2021-Jun-01 01:00 UTC\r\n'
+    'End Date and Time: 2021-Jun-01 05:00 UTC\r\n'
+    'Action and Reason: Fiber splicing\r\n'
+    'Location of work: Frankfurt, DE\r\n' +
+    ''.join(f'Service ID: IC-{i:06d}\r\nImpact: 30 min outage\r\n' for i in range(6)) +
+    TELIA_FILLER * 6
+)
+
+
+def gtt_notice(subject='GTT Work Announcement #(1234)', html=GTT_HTML):
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['Received'] = RECEIVED
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+
+def telia_notice(subject='Planned work PWIC123456', text=TELIA_TEXT):
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['Received'] = RECEIVED
+    part = MIMEText('', 'plain')
+    # the notices are sent with crlf line endings, which the parser relies on
+    part.set_payload(text)
+    msg.attach(part)
+    return msg
+
+ZAYO_FILLER = (
+    '<p>Zayo will be performing maintenance activities within our network. '
+    'Please review the details and the circuits affected below.</p>\r\n'
+)
+
+ZAYO_HTML = (
+    '<html><body>\r\n' + ZAYO_FILLER * 6 +
+    '<b>Maintenance Ticket #:</b> TTN-0001234567<br>\r\n'
+    '<b>Urgency:</b> Planned<br>\r\n'
+    '<b>Location of Maintenance:</b> Frankfurt, DE<br>\r\n'
+    '<b>Reason for Maintenance:</b> Fiber relocation<br>\r\n'
+    '<b>1st Activity Date:</b> 01-Jun-2021<br>\r\n'
+    '<b>Maintenance Window:</b> 00:01 - 05:00 Eastern<br>\r\n'
+    '<table border="1"><tr><th>Circuit Id</th><th>Expected Impact</th>'
+    '<th>A Location CLLI</th><th>Z Location CLLI</th><th>Legacy Circuit Id</th></tr>\r\n' +
+    ''.join(f'<tr><td>ZYO/IPYX/{i:06d}</td><td>Hard Down - up to 4 hours</td>'
+            f'<td>FRNKGEAA</td><td>{"" if i % 2 else "AMSTNLAA"}</td><td>LEG-{i}</td></tr>\r\n'
+            for i in range(12)) +
+    '</table>\r\n' + ZAYO_FILLER * 6 + '</body></html>'
+)
+
+
+def zayo_notice(subject='***Some Customer***ZAYO TTN-0001234567 MAINTENANCE NOTIFICATION***',
+                html=ZAYO_HTML):
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['Received'] = RECEIVED
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+TELSTRA_FILLER = (
+    '<p>Telstra will be carrying out maintenance on its network, the details '
+    'and the services impacted are below.</p>\r\n'
+)
+
+TELSTRA_HTML = (
+    '<html><body>\r\n' + TELSTRA_FILLER * 6 +
+    '<table>\r\n'
+    '<tr>\r\n  <th>Expected Impact</th>\r\n  <td>Service outage of up to 2 hours</td>\r\n</tr>\r\n'
+    '<tr>\r\n  <th>Maintenance Window</th>\r\n'
+    '  <td>1-Jun-2021 00:00:00(UTC) to 1-Jun-2021 04:00:00(UTC)</td>\r\n</tr>\r\n'
+    '<tr>\r\n  <th>Maintenance Details</th>\r\n</tr>\r\n'
+    '<tr>\r\n  <td>Fibre repairs between Sydney and Hong Kong.</td>\r\n</tr>\r\n'
+    '<tr>\r\n  <td>Traffic will be rerouted where possible.</td>\r\n</tr>\r\n'
+    '<tr>\r\n  <th>Service(s) Impacted</th>\r\n  <td>&lt;b&gt;TLS-0001234&lt;/b&gt;</td>\r\n</tr>\r\n'
+    '</table>\r\n' + TELSTRA_FILLER * 6 + '</body></html>'
+)
+
+
+def telstra_notice(subject='Telstra Planned Maintenance PR123456', html=TELSTRA_HTML):
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['Received'] = RECEIVED
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+
+def calendar(*events, extra=''):
+    return ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n'
+            'PRODID:-//Maint Note//https://github.com/maint-notification//\r\n' +
+            extra + ''.join(f'BEGIN:VEVENT\r\n{event}END:VEVENT\r\n' for event in events) +
+            'END:VCALENDAR\r\n')
+
+
+MAINTNOTE_EVENT = (
+    'SUMMARY:Maint Note Example\r\n'
+    'DTSTART:20210601T040000Z\r\n'
+    'DTEND:20210601T080000Z\r\n'
+    'DTSTAMP:20210520T001000Z\r\n'
+    'UID:42\r\n'
+    'SEQUENCE:1\r\n'
+    'X-MAINTNOTE-PROVIDER:example.com\r\n'
+    'X-MAINTNOTE-ACCOUNT:137.035999173\r\n'
+    'X-MAINTNOTE-MAINTENANCE-ID:WorkOrder-31415\r\n'
+    'X-MAINTNOTE-OBJECT-ID;X-MAINTNOTE-OBJECT-IMPACT=NO-IMPACT:acme-widgets-as-a-service\r\n'
+    'X-MAINTNOTE-OBJECT-ID;X-MAINTNOTE-OBJECT-IMPACT=OUTAGE:acme-widgets-as-a-ser\r\n'
+    ' vice-2\r\n'
+    'X-MAINTNOTE-IMPACT:NO-IMPACT\r\n'
+    'X-MAINTNOTE-STATUS:TENTATIVE\r\n'
+    'DESCRIPTION:Replacing a line card\\, then a reboot\\n\r\n'
+    '\tof the router\r\n'
+    'ORGANIZER;CN="Example NOC: east":mailto:noone@example.com\r\n'
+    'BEGIN:VALARM\r\n'
+    'ACTION:DISPLAY\r\n'
+    'DESCRIPTION:not the event\r\n'
+    'TRIGGER:-PT15M\r\n'
+    'END:VALARM\r\n'
+)
+
+# calendars the fast path reads itself
+MAINTNOTE_CALENDARS = [
+    calendar(MAINTNOTE_EVENT),
+    # bare newlines, lower case names and a zone from the tz database
+    calendar(
+        'DTSTART;TZID=Europe/Amsterdam:20211031T013000\r\n'
+        'DTEND;TZID=Europe/Amsterdam:20211031T033000\r\n'
+        'x-maintnote-maintenance-id:NTT-1\r\n'
+        'x-maintnote-object-id:CID-1\r\n'
+        'x-maintnote-impact:OUTAGE\r\n'
+        'x-maintnote-status:CANCELLED\r\n'
+        'sequence:2\r\n'
+    ).replace('\r\n', '\n'),
+    # floating times, escapes in text and unknown properties
+    calendar(
+        'DTSTART:20210601T040000\r\n'
+        'DTEND:20210601T080000\r\n'
+        'X-MAINTNOTE-MAINTENANCE-ID:PF-7\r\n'
+        'X-MAINTNOTE-OBJECT-ID:a,b\r\n'
+        'X-MAINTNOTE-IMPACT:DEGRADED\r\n'
+        'X-MAINTNOTE-STATUS:COMPLETED\r\n'
+        'SUMMARY;LANGUAGE=en:comma\\, semi\\; colon\\:\\Nnew \\nline\r\n'
+        'UID:uid-é\r\n'
+    ),
+    # two events and another component
+    calendar(MAINTNOTE_EVENT, MAINTNOTE_EVENT.replace('WorkOrder-31415', 'WorkOrder-27182'))
+    .replace('BEGIN:VEVENT', 'BEGIN:VTODO\r\nSUMMARY:todo\r\nEND:VTODO\r\nBEGIN:VEVENT', 1),
+    calendar(extra='X-WR-CALNAME:no events\r\n'),
+]
+
+# calendars left to icalendar
+UNUSUAL_CALENDARS = [
+    calendar(MAINTNOTE_EVENT.replace('DTSTART:20210601T040000Z', 'DTSTART;VALUE=DATE:20210601')),
+    calendar(MAINTNOTE_EVENT.replace('DTSTART:20210601T040000Z', 'DTSTART;VALUE=DATE-TIME:20210601T040000Z')),
+    calendar(
+        MAINTNOTE_EVENT.replace('DTSTART:20210601T040000Z', 'DTSTART;TZID=Fake Standard Time:20210601T040000'),
+        extra='BEGIN:VTIMEZONE\r\nTZID:Fake Standard Time\r\nBEGIN:STANDARD\r\n'
+              'DTSTART:19700101T000000\r\nTZOFFSETFROM:+0300\r\nTZOFFSETTO:+0300\r\n'
+              'TZNAME:FST\r\nEND:STANDARD\r\nEND:VTIMEZONE\r\n'),
+    calendar(MAINTNOTE_EVENT.replace('DESCRIPTION:', 'DESCRIPTION;ALTREP="cid:part1":')),
+    calendar(MAINTNOTE_EVENT.replace('SEQUENCE:1', 'SEQUENCE:one')),
+    # a time skipped by the change to dst, and one that happens twice
+    calendar(MAINTNOTE_EVENT.replace('DTSTART:20210601T040000Z',
+                                     'DTSTART;TZID=Europe/Amsterdam:20210328T023000')),
+    calendar(MAINTNOTE_EVENT.replace('DTSTART:20210601T040000Z',
+                                     'DTSTART;TZID=Europe/Amsterdam:20211031T023000')),
+    calendar(MAINTNOTE_EVENT.replace('DTEND:20210601T080000Z', 'DTEND:20210631T080000Z')),
+    # what icalendar 4 reads differently from later versions: the zone of
+    # a lower case name, an escaped backslash before an n and escapes in
+    # unknown properties
+    calendar(MAINTNOTE_EVENT.replace('DTSTART:20210601T040000Z',
+                                     'dtstart;TZID=Europe/Amsterdam:20211031T013000')),
+    calendar(MAINTNOTE_EVENT.replace('SUMMARY:Maint Note Example', 'SUMMARY:back\\\\slash \\\\n')),
+    calendar(MAINTNOTE_EVENT.replace('X-MAINTNOTE-IMPACT:NO-IMPACT', 'X-MAINTNOTE-IMPACT:NO\\,IMPACT')),
+]
+
+
+def maintnote_notice(ics=calendar(MAINTNOTE_EVENT), subject='NTT Maintenance WorkOrder-31415',
+                     encode=False):
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['Received'] = RECEIVED
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText('see the attached calendar', 'plain'))
+    # utf-8 parts are sent base64 encoded
+    alternative.attach(MIMEText(ics, 'calendar', 'utf-8' if encode else 'us-ascii'))
+    msg.attach(alternative)
+    return msg
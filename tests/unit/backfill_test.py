@@ -0,0 +1,114 @@
+import pytest
+from datetime import date
+from app.MessageView import MessageView
+from app.jobs import backfill, main
+from app.models import BackfillState, FailedMessage
+
+
+MESSAGE = b'From x Tue Jun  1 10:00:00 2021\nSubject: notice\n\nbody\n\n'
+
+
+def test_search_criteria():
+    """
+    GIVEN a date range
+    WHEN it is turned into imap search criteria
+    THEN check that the dates don't depend on the locale
+    """
+    assert backfill.search_criteria(date(2020, 3, 1), date(2021, 1, 15)) == \
+        'SINCE 1-Mar-2020 BEFORE 15-Jan-2021'
+    assert backfill.search_criteria() == 'ALL'
+
+
+def test_backfill_resumes(client, tmp_path, monkeypatch):
+    """
+    GIVEN an mbox mail source
+    WHEN a backfill is stopped part of the way through and run again
+    THEN check that it resumes after the last committed chunk
+    """
+    path = tmp_path / 'archive.mbox'
+    path.write_bytes(MESSAGE * 5)
+    app = client.application
+    app.config['MAIL_SOURCES'] = [{'path': str(path), 'mailbox': 'archive'}]
+    runner = app.test_cli_runner()
+
+    chunks = []
+    process_messages = backfill.process_messages
+
+    def interrupted(client, msg_ids, providers, location=None):
+        if len(chunks) == 1:
+            raise KeyboardInterrupt
+        chunks.append(msg_ids)
+        return process_messages(client, msg_ids, providers, location)
+
+    monkeypatch.setattr(backfill, 'process_messages', interrupted)
+    result = runner.invoke(args=['janitor', 'backfill', '--chunk-size', '2'])
+    assert result.exit_code != 0
+
+    with app.app_context():
+        state = BackfillState.query.filter_by(mailbox='archive').first()
+        assert state.last_uid == len(MESSAGE) + 1
+        assert state.processed == 2
+
+    chunks.clear()
+    monkeypatch.setattr(backfill, 'process_messages', lambda c, msg_ids, p, location: chunks.append(msg_ids) or 0)
+    result = runner.invoke(args=['janitor', 'backfill', '--chunk-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'resuming after uid' in result.output
+    assert 'msgs/sec' in result.output
+    assert chunks == [[len(MESSAGE) * 2 + 1, len(MESSAGE) * 3 + 1], [len(MESSAGE) * 4 + 1]]
+
+    with app.app_context():
+        state = BackfillState.query.filter_by(mailbox='archive').first()
+        assert state.last_uid == len(MESSAGE) * 4 + 1
+        assert state.processed == 5
+
+    result = runner.invoke(args=['janitor', 'backfill'])
+    assert 'nothing to backfill' in result.output
+    app.config['MAIL_SOURCES'] = None
+
+
+class FlakyProvider:
+    '''
+    a provider for "notice" subjects that fails until it is fixed
+    '''
+    name = 'flaky'
+    identified_by = b'(SUBJECT notice UNSEEN)'
+    content_types = None
+    fixed = False
+    applied = []
+
+    def parse(self, email):
+        return None
+
+    def apply(self, email, parsed):
+        self.applied.append(MessageView.of(email).email['Message-ID'])
+        return self.fixed
+
+
+def test_backfill_retries_failures(client, tmp_path, monkeypatch):
+    """
+    GIVEN a message that failed during a backfill
+    WHEN the backfill is run again once it is due
+    THEN check that it was recorded where it can be fetched and is retried
+    """
+    path = tmp_path / 'failed.mbox'
+    path.write_bytes(b'From x Tue Jun  1 10:00:00 2021\n'
+                     b'Message-ID: <backfill@example.com>\nSubject: notice\n\nbody\n\n')
+    monkeypatch.setattr(backfill, 'PROVIDERS', [FlakyProvider])
+    monkeypatch.setattr(FlakyProvider, 'applied', [])
+    monkeypatch.setitem(client.application.config, 'FAILURE_BACKOFF', 0)
+    source = {'path': str(path), 'mailbox': 'failed'}
+
+    with client.application.app_context():
+        mc = main.get_client(source)
+        assert backfill.backfill(mc, 'failed', echo=lambda line: None) == 1
+        failed = FailedMessage.query.filter_by(message_id='<backfill@example.com>').first()
+        assert failed.location == main.mailbox_location(mc, 'failed', mc.select('failed'))
+        assert failed.uid == '1'
+
+        monkeypatch.setattr(FlakyProvider, 'fixed', True)
+        output = []
+        assert backfill.backfill(main.get_client(source), 'failed', echo=output.append) == 1
+        assert 'retried 1 messages that failed before' in output
+        assert FlakyProvider.applied == ['<backfill@example.com>'] * 2
+        assert FailedMessage.query.filter_by(message_id='<backfill@example.com>').count() == 0
@@ -0,0 +1,171 @@
+import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+from app import db, create_app
+from app.MessageView import MessageView
+from app.jobs import main
+from app.jobs.dedup import ProcessedIndex, normalized_hash
+from app.models import ProcessedMessage
+from tests.conftest import TestConfig
+
+
+class Provider:
+    name = 'zayo'
+
+
+NOTICE = 'Maintenance Ticket #: TTN-0001\nWindow: 00:01 - 05:00 Eastern\n'
+
+
+def test_normalized_hash():
+    """
+    GIVEN a notice and a forwarded copy of it
+    WHEN their bodies are hashed
+    THEN check that they match and a different notice doesn't
+    """
+    original = MIMEText(NOTICE)
+    original['Subject'] = 'Zayo Maintenance Notification'
+
+    quoted = '\n'.join('> ' + line for line in NOTICE.splitlines())
+    forward = MIMEText('FYI\n\n---------- Forwarded message ---------\n'
+                       'From: MR Zayo <mr@zayo.com>\nDate: Tue, 1 Jun 2021\n'
+                       'Subject: Zayo Maintenance Notification\n' + quoted)
+    forward['Subject'] = 'Fwd: Zayo Maintenance  Notification'
+    assert normalized_hash(forward) == normalized_hash(original)
+
+    ended = MIMEText(NOTICE)
+    ended['Subject'] = 'Completed Maintenance Notification'
+    assert normalized_hash(ended) != normalized_hash(original)
+
+
+def test_processed_index(client):
+    """
+    GIVEN a processed message
+    WHEN the next run's index is built
+    THEN check that its Message-ID and body are recognised
+    """
+    with client.application.app_context():
+        index = ProcessedIndex(['<1@zayo.com>'])
+        assert not index.seen('<1@zayo.com>')
+        assert not index.seen_body('abc')
+        # a copy isn't skipped until the message has been applied
+        assert not index.seen('<1@zayo.com>')
+        assert not index.seen_body('abc')
+        index.record('<1@zayo.com>', 'abc', Provider())
+        assert index.seen('<1@zayo.com>')
+        assert index.seen_body('abc')
+
+        index = ProcessedIndex(['<1@zayo.com>', '<2@zayo.com>'])
+        assert index.seen('<1@zayo.com>')
+        assert not index.seen('<2@zayo.com>')
+        assert index.seen_body('abc')
+        assert not index.seen_body('def')
+        assert ProcessedMessage.query.count() == 1
+
+
+class SlowProvider:
+    '''
+    a provider for "notice" subjects that takes a while to apply
+    '''
+    name = 'slow'
+    identified_by = b'(SUBJECT notice UNSEEN)'
+    content_types = None
+
+    def __init__(self):
+        self.applied = []
+        # both sources have loaded their index before either applies
+        self.barrier = threading.Barrier(2, timeout=10)
+
+    def parse(self, email):
+        self.barrier.wait()
+        return None
+
+    def apply(self, email, parsed):
+        self.applied.append(MessageView.of(email).email['Message-ID'])
+        time.sleep(0.1)
+        return True
+
+
+@pytest.fixture
+def file_app(tmp_path):
+    '''
+    an app on an sqlite file. threads share the connection of the
+    in-memory db, so one would commit the other's transaction.
+    '''
+    class FileConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path / "janitor.db"}'
+
+    app = create_app(FileConfig)
+    app.apscheduler.scheduler.shutdown()
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+
+
+def test_concurrent_sources(file_app, tmp_path):
+    """
+    GIVEN one notice delivered to two mail sources
+    WHEN both sources are processed at the same time
+    THEN check that it is applied once
+    """
+    notice = (b'From x Tue Jun  1 10:00:00 2021\n'
+              b'Message-ID: <alias@example.com>\nSubject: notice\n\nalias body\n\n')
+    sources = []
+    for name in ('noc', 'ops'):
+        path = tmp_path / f'{name}.mbox'
+        path.write_bytes(notice)
+        sources.append({'path': str(path), 'mailbox': name})
+
+    provider = SlowProvider()
+    app = file_app
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        counts = list(pool.map(lambda source: main.process_source(app, source, [provider]),
+                               sources))
+
+    assert provider.applied == ['<alias@example.com>']
+    assert sorted(counts) == [0, 1]
+    with app.app_context():
+        assert ProcessedMessage.query.filter_by(message_id='<alias@example.com>').count() == 1
+
+
+class FirstFailsProvider:
+    '''
+    a provider for "notice" subjects that fails to apply the first time
+    '''
+    name = 'first_fails'
+    identified_by = b'(SUBJECT notice UNSEEN)'
+    content_types = None
+
+    def __init__(self):
+        self.calls = 0
+
+    def parse(self, email):
+        return None
+
+    def apply(self, email, parsed):
+        self.calls += 1
+        return self.calls > 1
+
+
+def test_copy_after_failure(client, tmp_path):
+    """
+    GIVEN two copies of a notice in one mailbox
+    WHEN the first copy fails to apply
+    THEN check that the second copy is still applied
+    """
+    notice = (b'From x Tue Jun  1 10:00:00 2021\n'
+              b'Message-ID: <copy@example.com>\nSubject: notice\n\ncopy body\n\n')
+    path = tmp_path / 'noc.mbox'
+    path.write_bytes(notice * 2)
+
+    provider = FirstFailsProvider()
+    app = client.application
+    count = main.process_source(app, {'path': str(path), 'mailbox': 'noc'}, [provider])
+
+    assert provider.calls == 2
+    assert count == 2
+    with app.app_context():
+        assert ProcessedMessage.query.filter_by(message_id='<copy@example.com>').count() == 1
@@ -0,0 +1,68 @@
+import pytest
+import email
+from datetime import datetime, timedelta
+from app.jobs import failures
+from app.models import FailedMessage
+
+
+class FakeProvider:
+    name = 'fake'
+
+
+def message(body='hi'):
+    return email.message_from_string(f'Message-ID: <1@example.com>\r\nSubject: maint\r\n\r\n{body}')
+
+
+def test_message_key():
+    """
+    GIVEN message headers
+    WHEN a ledger key is made for them
+    THEN check that the Message-ID is used, or a hash without one
+    """
+    assert failures.message_key(message()) == '<1@example.com>'
+
+    no_id = email.message_from_string('Subject: maint\r\nFrom: a@b.com\r\n\r\n')
+    key = failures.message_key(no_id)
+    assert len(key) == 64
+    assert key == failures.message_key(no_id)
+
+
+def test_failure_ledger(client, monkeypatch):
+    """
+    GIVEN a message that a provider failed to process
+    WHEN later runs look at it
+    THEN check that it is skipped until its backoff passes or the parser changes
+    """
+    provider = FakeProvider()
+    key = '<1@example.com>'
+    now = datetime(2020, 1, 1)
+    with client.application.app_context():
+        monkeypatch.setitem(client.application.config, 'FAILURE_BACKOFF', 60)
+        monkeypatch.setitem(client.application.config, 'FAILURE_MAX_ATTEMPTS', 3)
+
+        ledger = failures.FailureLedger([key], now=now)
+        assert not ledger.skip(key, provider)
+        failed = ledger.record(key, message(), provider)
+        assert failed.attempts == 1
+        assert failed.next_attempt == now + timedelta(seconds=60)
+
+        assert failures.FailureLedger([key], now=now).skip(key, provider)
+
+        later = now + timedelta(seconds=61)
+        ledger = failures.FailureLedger([key], now=later)
+        assert not ledger.skip(key, provider)
+        failed = ledger.record(key, message(), provider)
+        assert failed.next_attempt == later + timedelta(seconds=120)
+
+        ledger.record(key, message(), provider)
+        much_later = now + timedelta(days=30)
+        assert failures.FailureLedger([key], now=much_later).skip(key, provider)
+
+        # a new parser gets another chance
+        monkeypatch.setitem(failures._parser_versions, __name__, 'upgraded')
+        ledger = failures.FailureLedger([key], now=much_later)
+        assert not ledger.skip(key, provider)
+        assert ledger.record(key, message(), provider).attempts == 1
+
+        ledger.clear(key)
+        assert not FailedMessage.query.filter_by(message_id=key).first()
@@ -0,0 +1,329 @@
+import pytest
+import email
+import fcntl
+import imaplib
+from app.jobs import main, failures
+from app.MessageView import MessageView
+from app.models import MailboxState
+from tests.fake_imap import FakeIMAPServer
+
+
+class FakeClient:
+    '''
+    stands in for a MailClient that has a fixed set of uids
+    '''
+    server = 'imap.example.com'
+    email = 'janitor@example.com'
+
+    def __init__(self, uids, uidvalidity=1):
+        self.uids = uids
+        self.uidvalidity = uidvalidity
+        self.searches = []
+        self.uid = False
+
+    def select(self, mailbox):
+        return self.uidvalidity
+
+    def search(self, criteria):
+        self.searches.append(criteria)
+        if isinstance(criteria, str) and criteria.startswith('UID'):
+            # n:* always returns at least the newest message
+            first = int(criteria.split()[1].split(':')[0])
+            return [str(u).encode() for u in self.uids if u >= first] or \
+                [str(self.uids[-1]).encode()]
+        return []
+
+    def fetch_headers(self, msg_ids, fields, chunk_size):
+        return []
+
+    def fetch_parts(self, parts, chunk_size):
+        return []
+
+    def flush(self):
+        pass
+
+
+def test_sync_mailbox(client):
+    """
+    GIVEN a mailbox with messages
+    WHEN it is synced by uid twice
+    THEN check that only new uids are searched and the state is kept
+    """
+    with client.application.app_context():
+        fake = FakeClient([3, 4, 7])
+        main.sync_mailbox(fake, 'INBOX', [])
+
+        state = MailboxState.query.filter_by(mailbox='INBOX').first()
+        assert state.last_uid == 7
+        assert state.uidvalidity == 1
+        assert fake.uid
+
+        fake.searches = []
+        assert main.sync_mailbox(fake, 'INBOX', []) == 0
+        assert fake.searches == ['UID 8:*']
+
+        # a new uidvalidity invalidates the stored position
+        fake = FakeClient([1, 2], uidvalidity=2)
+        main.sync_mailbox(fake, 'INBOX', [])
+        assert fake.searches == ['UID 1:*']
+        assert MailboxState.query.filter_by(mailbox='INBOX').first().last_uid == 2
+
+
+@pytest.mark.parametrize('setting, size', [('0', None), (0, None), ('2048', 2048), (4096, 4096)])
+def test_max_part_size(client, tmp_path, monkeypatch, setting, size):
+    """
+    GIVEN MAX_PART_SIZE from the environment or the config
+    WHEN a client is made
+    THEN check that 0 keeps every attachment
+    """
+    monkeypatch.setitem(client.application.config, 'MAX_PART_SIZE', setting)
+    path = tmp_path / 'empty.mbox'
+    path.write_bytes(b'')
+    with client.application.app_context():
+        assert main.get_client({'path': str(path)}).max_part_size == size
+
+
+def test_process_sources(client, monkeypatch):
+    """
+    GIVEN two mail sources on different servers
+    WHEN messages are processed
+    THEN check that each source is selected on its own connection
+    """
+    monkeypatch.setattr(main.mc, 'imap_class', imaplib.IMAP4)
+    config = client.application.config
+    with FakeIMAPServer() as first, FakeIMAPServer() as second:
+        monkeypatch.setitem(config, 'MAIL_USERNAME', 'janitor@example.com')
+        monkeypatch.setitem(config, 'MAIL_PASSWORD', 'pw')
+        monkeypatch.setitem(config, 'MAIL_SOURCES', [
+            {'server': '127.0.0.1', 'port': first.port, 'mailbox': 'INBOX'},
+            {'server': '127.0.0.1', 'port': second.port, 'mailbox': 'noc'},
+        ])
+        main.process()
+
+        for server, mailbox in ((first, 'INBOX'), (second, 'noc')):
+            assert server.connections == 1
+            assert f'SELECT {mailbox}' in server.lines
+            assert 'SEARCH UNSEEN' in server.lines
+
+        with client.application.app_context():
+            main.CONNECTIONS.close_all()
+
+
+def test_process_lock(client, tmp_path, monkeypatch):
+    """
+    GIVEN a run holding the process lock
+    WHEN another worker of the app tries to take it
+    THEN check that it can't until the run is done
+    """
+    monkeypatch.setitem(client.application.config, 'LOCK_DIR', str(tmp_path))
+    with client.application.app_context():
+        with main.process_lock('process'):
+            # another worker opens the file on its own, as this does
+            with open(tmp_path / 'process.lock') as other:
+                with pytest.raises(OSError):
+                    fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with open(tmp_path / 'process.lock') as other:
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_idle_listener_one_process(client, tmp_path, monkeypatch):
+    """
+    GIVEN MAIL_IDLE in an app server with several workers
+    WHEN each worker starts its IDLE listeners
+    THEN check that only the first one listens
+    """
+    started = []
+
+    class FakeListener:
+        def __init__(self, app, client, mailbox, callback, timeout):
+            self.mailbox = mailbox
+
+        def start(self):
+            started.append(self.mailbox)
+
+    app = client.application
+    monkeypatch.setattr(main, 'IdleListener', FakeListener)
+    monkeypatch.setattr(main, 'get_client', lambda source: None)
+    monkeypatch.setattr(main, 'IDLE_LOCK', None)
+    monkeypatch.setitem(app.config, 'LOCK_DIR', str(tmp_path))
+
+    first = main.start_idle_listener(app)
+    # the lock file is opened again, as it is by another worker
+    second = main.start_idle_listener(app)
+    main.IDLE_LOCK.close()
+
+    assert len(first) == 1
+    assert second == []
+    assert started == ['INBOX']
+
+
+class FakeFailures(FakeClient):
+    '''
+    a "failures" mailbox whose messages have a subject, sender and date
+    '''
+    def __init__(self, uids, uidvalidity=1):
+        super().__init__(uids, uidvalidity)
+        self.fetched = []
+
+    def verify_mailboxes(self):
+        pass
+
+    def search(self, criteria):
+        return [str(u).encode() for u in self.uids]
+
+    def fetch_headers(self, msg_ids, fields, chunk_size, structure=True):
+        self.fetched.extend(msg_ids)
+        for uid in msg_ids:
+            headers = email.message_from_string(
+                f'From: Zayo <mr@zayo.com>\r\n'
+                f'Subject: maintenance {uid}\r\n'
+                f'Date: Tue, 0{uid} Jun 2021 10:00:00 +0200\r\n\r\n'
+            )
+            yield uid, headers, None
+
+
+def test_refresh_failed_messages(client):
+    """
+    GIVEN an account with failed messages
+    WHEN the failed messages are refreshed twice and the page is requested
+    THEN check that only new uids are fetched and the snapshot is served
+    """
+    with client.application.app_context():
+        fake = FakeFailures([1, 2])
+        assert main.refresh_failures(fake, 'janitor@example.com') == 2
+        assert fake.fetched == [1, 2]
+
+        fake = FakeFailures([2, 3])
+        assert main.refresh_failures(fake, 'janitor@example.com') == 1
+        assert fake.fetched == [3]
+
+    data = client.get('/failedmessages').get_json()
+    assert data['refreshed']
+    assert data['total'] == 2
+    assert [m['uid'] for m in data['messages']] == [3, 2]
+    assert data['messages'][0]['subject'] == 'maintenance 3'
+    assert data['messages'][0]['from'] == 'Zayo <mr@zayo.com>'
+    assert data['messages'][0]['date'] == '2021-06-03T08:00:00'
+
+    with client.application.app_context():
+        # a new uidvalidity throws the snapshot away
+        fake = FakeFailures([1], uidvalidity=2)
+        assert main.refresh_failures(fake, 'janitor@example.com') == 1
+
+    assert client.get('/failedmessages').get_json()['total'] == 1
+
+
+def test_sync_mbox(client, tmp_path):
+    """
+    GIVEN an mbox mail source
+    WHEN it is processed twice with mail appended in between
+    THEN check that the second run resumes at the stored offset
+    """
+    path = tmp_path / 'archive.mbox'
+    message = b'From x Tue Jun  1 10:00:00 2021\nSubject: notice\n\nbody\n\n'
+    path.write_bytes(message * 3)
+    source = {'path': str(path), 'mailbox': 'archive'}
+
+    with client.application.app_context():
+        with main.connection(source) as mc:
+            main.sync_mailbox(mc, 'archive', [])
+        state = MailboxState.query.filter_by(mailbox='archive').first()
+        assert state.last_uid == len(message) * 2 + 1
+
+        with open(path, 'ab') as f:
+            f.write(message)
+
+        with main.connection(source) as mc:
+            mc.select('archive')
+            assert mc.search(f'UID {state.last_uid + 1}:*') == [len(message) * 3 + 1]
+            main.sync_mailbox(mc, 'archive', [])
+        assert state.last_uid == len(message) * 3 + 1
+
+
+def test_sync_history(client, tmp_path):
+    """
+    GIVEN a gmail api mailbox
+    WHEN it is synced twice with mail arriving in between
+    THEN check that the second run only looks at the history since the first
+    """
+    from tests.fake_gmail_api import FakeGmailAPIServer
+    from tests.unit.mail_client_test import fake_gmail_api
+
+    with FakeGmailAPIServer() as server, client.application.app_context():
+        server.add(b'Subject: old\r\n\r\nbody\r\n')
+        mc = fake_gmail_api(server, tmp_path)
+        with mc:
+            main.sync_history(mc, 'INBOX', [])
+            state = MailboxState.query.filter_by(server='gmail-api', mailbox='INBOX').first()
+            assert state.last_uid == server.history_id
+
+            new = server.add(b'Subject: new\r\n\r\nbody\r\n')
+            fetched = []
+            mc.fetch_headers = lambda msg_ids, *args, **kwargs: fetched.extend(msg_ids) or []
+            main.sync_history(mc, 'INBOX', [])
+            assert fetched == [new]
+            assert state.last_uid == server.history_id
+
+
+class FlakyProvider:
+    '''
+    a provider for "notice" subjects that fails until it is fixed
+    '''
+    name = 'flaky'
+    identified_by = b'(SUBJECT notice UNSEEN)'
+    content_types = None
+
+    def __init__(self):
+        self.fixed = False
+        self.applied = []
+
+    def parse(self, email):
+        return None
+
+    def apply(self, email, parsed):
+        self.applied.append(MessageView.of(email).email['Message-ID'])
+        return self.fixed
+
+
+def test_sync_retries_failures(client, tmp_path, monkeypatch):
+    """
+    GIVEN messages that failed in an mbox synced by uid
+    WHEN later runs have no new mail
+    THEN check that the failures are retried once due or the parser changed
+    """
+    path = tmp_path / 'flaky.mbox'
+    path.write_bytes(b''.join(
+        b'From x Tue Jun  1 10:00:00 2021\n'
+        b'Message-ID: <retry-%d@example.com>\nSubject: notice\n\nbody %d\n\n' % (i, i)
+        for i in range(2)))
+    source = {'path': str(path), 'mailbox': 'flaky'}
+    config = client.application.config
+    monkeypatch.setitem(config, 'FAILURE_BACKOFF', 3600)
+    provider = FlakyProvider()
+
+    with client.application.app_context():
+        with main.connection(source) as mc:
+            main.sync_mailbox(mc, 'flaky', [provider])
+        assert len(provider.applied) == 2
+        state = MailboxState.query.filter_by(mailbox='flaky').first()
+        last_uid = state.last_uid
+
+        # the backoff hasn't passed
+        provider.applied = []
+        with main.connection(source) as mc:
+            assert main.sync_mailbox(mc, 'flaky', [provider]) == 0
+        assert provider.applied == []
+
+        # a new parser retries them below the high-water mark
+        monkeypatch.setitem(failures._parser_versions, type(provider).__module__, 'upgraded')
+        provider.fixed = True
+        with main.connection(source) as mc:
+            assert main.sync_mailbox(mc, 'flaky', [provider]) == 2
+        assert provider.applied == ['<retry-0@example.com>', '<retry-1@example.com>']
+        assert state.last_uid == last_uid
+
+        provider.applied = []
+        with main.connection(source) as mc:
+            assert main.sync_mailbox(mc, 'flaky', [provider]) == 0
+        assert provider.applied == []
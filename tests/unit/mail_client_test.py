@@ -1,6 +1,16 @@
 import pytest
 import imaplib
+import json
+import threading
 from app import MailClient
+from tests.fake_imap import FakeIMAPServer
+from tests.fake_gmail_api import FakeGmailAPIServer
+
+
+def fake_gmail(server):
+    mc = MailClient.Gmail('127.0.0.1', 'janitor@example.com', 'pw', server.port)
+    mc.imap_class = imaplib.IMAP4
+    return mc
 
 
 def test_gmail(client):
@@ -23,3 +33,507 @@ def test_gmail(client):
         pass
 
         mc.verify_mailboxes()
+
+
+def test_sequence_set():
+    """
+    GIVEN a list of message ids
+    WHEN a sequence set is built from them
+    THEN check that consecutive ids are collapsed into ranges
+    """
+    ids = [b'9', b'1', b'10', b'5', b'11', b'20']
+    assert MailClient.sequence_set(ids) == b'1,5,9:11,20'
+    assert MailClient.sequence_set([3]) == b'3'
+
+
+def test_parse_fetch_response():
+    """
+    GIVEN the raw data imaplib returns for a multi-message FETCH
+    WHEN it is parsed
+    THEN check that each message's data items are returned with its id
+    """
+    data = [
+        (b'1 (UID 5 RFC822 {5}', b'hello'),
+        b')',
+        b'3 (FLAGS (\\Seen) UID 9)',
+        (b'2 (UID 6 BODY[HEADER.FIELDS (SUBJECT)] {3}', b'abc'),
+        b' INTERNALDATE NIL)',
+    ]
+    messages = list(MailClient.parse_fetch_response(data))
+
+    assert messages[0] == (b'1', {'UID': b'5', 'RFC822': b'hello'})
+    assert messages[1] == (b'3', {'FLAGS': [b'\\Seen'], 'UID': b'9'})
+    assert messages[2] == (
+        b'2',
+        {'UID': b'6', 'BODY[HEADER.FIELDS (SUBJECT)]': b'abc', 'INTERNALDATE': None},
+    )
+
+
+def test_partial_fetch():
+    """
+    GIVEN the BODYSTRUCTURE of a message with a calendar and a pdf
+    WHEN the calendar part is fetched on its own
+    THEN check that only its section is requested and the message is rebuilt
+    """
+    data = [
+        b'1 (UID 3 BODYSTRUCTURE (('
+        b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 2 1 NIL NIL NIL)'
+        b'("TEXT" "CALENDAR" ("CHARSET" "utf-8") NIL NIL "7BIT" 9 1 NIL NIL NIL)'
+        b' "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL)'
+        b'("APPLICATION" "PDF" ("NAME" "x.pdf") NIL NIL "BASE64" 999999 NIL NIL NIL)'
+        b' "MIXED" ("BOUNDARY" "b1") NIL NIL))'
+    ]
+    (msg_id, items), = MailClient.parse_fetch_response(data)
+    structure = items['BODYSTRUCTURE']
+
+    assert list(MailClient.body_sections(structure)) == [
+        ('1.1', 'text/plain'),
+        ('1.2', 'text/calendar'),
+        ('2', 'application/pdf'),
+    ]
+    assert MailClient.find_sections(structure, ('text/calendar',)) == ['1.2']
+    assert MailClient.find_sections(structure, None) is None
+    assert MailClient.find_sections([b'TEXT', b'HTML', None], ('text/html',)) is None
+
+    items = {
+        'BODY[HEADER]': b'Subject: hi\r\nContent-Type: multipart/mixed; boundary=b1\r\n\r\n',
+        'BODY[1.2.MIME]': b'Content-Type: text/calendar\r\n\r\n',
+        'BODY[1.2]': b'BEGIN:VCALENDAR',
+    }
+    msg = MailClient.build_message(items, ['1.2'])
+    assert msg['Subject'] == 'hi'
+    parts = [part.get_content_type() for part in msg.walk()]
+    assert parts == ['multipart/mixed', 'text/calendar']
+    assert msg.get_payload()[0].get_payload() == 'BEGIN:VCALENDAR'
+
+
+def test_idle(client):
+    """
+    GIVEN a session with a mailbox selected
+    WHEN it IDLEs and the server reports new mail
+    THEN check that idle returns True, and False when nothing arrives
+    """
+    with client.application.app_context(), FakeIMAPServer() as server:
+        mc = fake_gmail(server)
+        mc.open_session()
+        assert mc.select('INBOX') == 1
+
+        server.push('* 2 EXISTS')
+        assert mc.idle(timeout=5)
+        assert not mc.idle(timeout=0.2)
+
+        # the session is still usable after IDLE is done
+        assert mc.session.noop()[0] == 'OK'
+        mc.close_session()
+
+
+def test_idle_listener(client):
+    """
+    GIVEN an IDLE listener whose first connection is dropped
+    WHEN new mail arrives
+    THEN check that it reconnects and calls back
+    """
+    called = threading.Event()
+    with FakeIMAPServer() as server:
+        server.drop_idle = 1
+        listener = MailClient.IdleListener(
+            client.application, fake_gmail(server), 'INBOX', called.set, timeout=5
+        )
+        listener.start()
+        server.push('* 3 EXISTS')
+
+        assert called.wait(10)
+        assert listener.reconnects == 1
+        assert server.connections == 2
+        listener.stop()
+
+
+def test_idle_listener_select_refused(client):
+    """
+    GIVEN an IDLE listener whose first SELECT is refused
+    WHEN new mail arrives
+    THEN check that it backs off, reconnects and calls back
+    """
+    called = threading.Event()
+    with FakeIMAPServer() as server:
+        server.refuse_select = 1
+        listener = MailClient.IdleListener(
+            client.application, fake_gmail(server), 'INBOX', called.set, timeout=5
+        )
+        listener.start()
+        server.push('* 3 EXISTS')
+
+        assert called.wait(10)
+        assert listener.is_alive()
+        assert listener.reconnects == 1
+        assert server.commands.count('SELECT') == 2
+        listener.stop()
+
+
+def test_flush(client):
+    """
+    GIVEN messages that were marked processed and failed
+    WHEN the changes are flushed
+    THEN check that one STORE is sent per change for all of the messages
+    """
+    with client.application.app_context(), FakeIMAPServer() as server:
+        mc = fake_gmail(server)
+        mc.open_session()
+        mc.select('INBOX')
+        for msg_id in (b'1', b'2', b'3', b'7'):
+            mc.mark_processed(msg_id)
+        mc.mark_failed(b'5')
+        assert 'STORE' not in server.commands
+
+        mc.flush()
+        assert [line for line in server.lines if line.startswith('STORE')] == [
+            'STORE 1:3,7 +X-GM-LABELS (processed)',
+            'STORE 1:3,7 +FLAGS.SILENT (\\Seen)',
+            'STORE 1:3,7 -X-GM-LABELS (failures)',
+            'STORE 5 +X-GM-LABELS (failures)',
+        ]
+
+        # nothing left to send
+        mc.flush()
+        assert server.commands.count('STORE') == 4
+        mc.close_session()
+
+
+def test_connection_manager(client):
+    """
+    GIVEN a connection manager
+    WHEN a connection is used for several runs and dies in between
+    THEN check that it is reused and transparently replaced when dead
+    """
+    with client.application.app_context(), FakeIMAPServer() as server:
+        manager = MailClient.ConnectionManager(keepalive=0)
+        key = ('127.0.0.1', 'janitor@example.com')
+
+        with manager.connection(key, lambda: fake_gmail(server)) as first:
+            first.select('INBOX')
+        with manager.connection(key, lambda: fake_gmail(server)) as second:
+            assert second is first
+        assert server.connections == 1
+        assert server.commands.count('LOGIN') == 1
+
+        manager.keepalive_all()
+        assert server.commands.count('NOOP') == 2
+
+        server.hangup()
+        with manager.connection(key, lambda: fake_gmail(server)) as third:
+            assert third.session.noop()[0] == 'OK'
+        assert server.connections == 2
+        assert manager.reconnects[key] == 1
+        assert manager.age(key) >= 0
+
+        manager.close_all()
+        assert manager.clients[key].session is None
+
+
+def mbox_message(number):
+    return (
+        f'From mr@zayo.com Tue Jun  1 10:00:00 2021\n'
+        f'From: Zayo <mr@zayo.com>\n'
+        f'Subject: maintenance {number}\n'
+        f'\n'
+        f'body {number}\n'
+        f'\n'
+    ).encode()
+
+
+def test_mbox(tmp_path):
+    """
+    GIVEN an mbox file
+    WHEN it is searched and fetched, then more mail is appended
+    THEN check that uids are offsets and searches resume from them
+    """
+    path = tmp_path / 'notices.mbox'
+    path.write_bytes(mbox_message(1) + mbox_message(2))
+
+    mc = MailClient.local_client(str(path))
+    assert isinstance(mc, MailClient.Mbox)
+    with mc:
+        mc.select('INBOX')
+        uids = mc.search('ALL')
+        assert uids[0] == 1
+        assert len(uids) == 2
+
+        headers = [h for _, h, _ in mc.fetch_headers(uids, ['Subject'])]
+        assert [h['Subject'] for h in headers] == ['maintenance 1', 'maintenance 2']
+
+        messages = dict(mc.fetch_parts({uid: None for uid in uids}))
+        assert messages[uids[1]].get_payload() == 'body 2\n\n'
+        assert mc.bytes_fetched
+
+        with open(path, 'ab') as f:
+            f.write(mbox_message(3))
+
+        mc.select('INBOX')
+        new = mc.search(f'UID {uids[-1] + 1}:*')
+        assert len(new) == 1
+        assert next(mc.fetch(new))[1]['Subject'] == 'maintenance 3'
+
+
+def test_mbox_dates(tmp_path):
+    """
+    GIVEN an mbox of messages delivered on different days
+    WHEN it is searched by date
+    THEN check that only those delivered in the range are found
+    """
+    path = tmp_path / 'notices.mbox'
+    path.write_bytes(
+        mbox_message(1).replace(b'Jun  1', b'May 31') + mbox_message(2) +
+        mbox_message(3).replace(b'Jun  1', b'Jun 15') +
+        # no date on its From line, its Date header is used
+        b'From MAILER-DAEMON\nDate: Wed, 30 Jun 2021 23:00:00 -0200\nSubject: maintenance 4\n\nbody\n\n')
+
+    mc = MailClient.local_client(str(path))
+    with mc:
+        mc.select('INBOX')
+        subjects = lambda uids: [h['Subject'][-1] for _, h, _ in mc.fetch_headers(uids, ['Subject'])]
+        assert subjects(mc.search('SINCE 1-Jun-2021')) == ['2', '3', '4']
+        assert subjects(mc.search('SINCE 1-Jun-2021 BEFORE 15-Jun-2021')) == ['2']
+        # like imap, the day is the one in the message's own time zone
+        assert subjects(mc.search('BEFORE 30-Jun-2021')) == ['1', '2', '3']
+        assert subjects(mc.search('SINCE 30-Jun-2021 BEFORE 1-Jul-2021')) == ['4']
+        uids = mc.search('ALL')
+        assert mc.search(f'UID {uids[1]}:* BEFORE 2-Jun-2021') == [uids[1]]
+
+
+def test_maildir(tmp_path):
+    """
+    GIVEN a maildir with a new and a read message
+    WHEN unseen messages are processed and failed
+    THEN check that the flags are stored in the file names
+    """
+    for subdir in ('new', 'cur', 'tmp'):
+        (tmp_path / subdir).mkdir()
+    (tmp_path / 'new' / '1600000001.M1.host').write_bytes(mbox_message(1).split(b'\n', 1)[1])
+    (tmp_path / 'new' / '1600000002.M2.host').write_bytes(mbox_message(2).split(b'\n', 1)[1])
+    (tmp_path / 'cur' / '1600000000.M0.host:2,S').write_bytes(mbox_message(0).split(b'\n', 1)[1])
+
+    mc = MailClient.local_client(str(tmp_path))
+    assert isinstance(mc, MailClient.Maildir)
+    with mc:
+        mc.select('INBOX')
+        assert mc.search('ALL') == [1, 2, 3]
+        unseen = mc.search('UNSEEN')
+        assert unseen == [2, 3]
+
+        headers = {msg_id: h for msg_id, h, _ in mc.fetch_headers(unseen, ['Subject'])}
+        assert headers[2]['Subject'] == 'maintenance 1'
+
+        mc.mark_processed(2)
+        mc.mark_failed(3)
+
+    assert sorted(p.name for p in (tmp_path / 'cur').iterdir()) == [
+        '1600000000.M0.host:2,S', '1600000001.M1.host:2,S', '1600000002.M2.host:2,F'
+    ]
+    with mc:
+        mc.select('INBOX')
+        assert mc.search('UNSEEN') == [3]
+
+
+def test_async_gmail(client):
+    """
+    GIVEN a mail server with messages
+    WHEN they are fetched with the asyncio client
+    THEN check that every chunk is fetched over the pipelined connections
+    """
+    with FakeIMAPServer() as server, client.application.app_context():
+        server.messages = [f'Subject: message {i}\r\n\r\nbody {i}\r\n'.encode()
+                           for i in range(1, 8)]
+        mc = MailClient.AsyncGmail('127.0.0.1', 'janitor@example.com', 'pw',
+                                   server.port, connections=2, pipeline=2)
+        mc.imap_class = imaplib.IMAP4
+        with mc:
+            mc.select('INBOX')
+            messages = list(mc.fetch(range(1, 8), chunk_size=2))
+            assert [em['Subject'] for _, em in messages] == \
+                [f'message {i}' for i in range(1, 8)]
+            assert mc.bytes_fetched
+
+            mc.uid = True
+            assert [msg_id for msg_id, _ in mc.fetch([6, 7])] == [b'6', b'7']
+
+        # the imaplib session plus two fetch connections
+        assert server.connections == 3
+        assert server.commands.count('EXAMINE') == 2
+        assert server.commands.count('FETCH') == 4
+        assert 'LOGOUT' in server.commands
+
+
+def test_fetch_tuner():
+    """
+    GIVEN a fetch tuner
+    WHEN fetches are fast, slow or refused
+    THEN check that the chunk size and window follow the server
+    """
+    tuner = MailClient.FetchTuner(max_chunk_size=100, max_window=4)
+    assert tuner.chunk_size('q', 30) == 30
+    tuner.succeeded('q', 30, 1000, 0.1)
+    assert tuner.sizes['q'] == 60
+    tuner.succeeded('q', 60, 1000, 0.1)
+    assert tuner.sizes['q'] == 100
+    # a short last chunk doesn't grow it
+    tuner.sizes['q'] = 40
+    tuner.succeeded('q', 10, 1000, 0.1)
+    assert tuner.sizes['q'] == 40
+    tuner.succeeded('q', 40, 1000, tuner.target * 2)
+    assert tuner.sizes['q'] == 20
+
+    assert tuner.refused('q')
+    assert (tuner.sizes['q'], tuner.window, tuner.backoff) == (10, 2, 1)
+    assert tuner.refused('q')
+    assert (tuner.sizes['q'], tuner.window, tuner.backoff) == (5, 1, 2)
+    tuner.succeeded('q', 5, 1000, 0.1)
+    assert (tuner.window, tuner.backoff) == (2, 0)
+
+    tuner.retries = 1
+    assert tuner.refused('q')
+    assert not tuner.refused('q')
+
+
+def test_fetch_throttled(client):
+    """
+    GIVEN a mail server that throttles FETCH commands
+    WHEN messages are fetched
+    THEN check that the fetch backs off with smaller chunks and recovers
+    """
+    with FakeIMAPServer() as server, client.application.app_context():
+        server.messages = [f'Subject: message {i}\r\n\r\nbody {i}\r\n'.encode()
+                           for i in range(1, 9)]
+        server.throttle = 2
+        mc = fake_gmail(server)
+        mc.tuner.max_backoff = 0
+        with mc:
+            mc.select('INBOX')
+            messages = list(mc.fetch(range(1, 9), chunk_size=8))
+            assert [em['Subject'] for _, em in messages] == \
+                [f'message {i}' for i in range(1, 9)]
+
+            fetches = [line for line in server.lines if line.startswith('FETCH')]
+            assert [line.split()[1] for line in fetches] == ['1:8', '1:4', '1:2', '3:6', '7:8']
+
+            server.throttle = 10
+            with pytest.raises(Exception):
+                list(mc.fetch([1]))
+
+
+@pytest.mark.parametrize('client_class', [MailClient.Gmail, MailClient.AsyncGmail])
+def test_fetch_throttled_ok(client, client_class):
+    """
+    GIVEN a mail server that answers FETCH with OK [THROTTLED]
+    WHEN messages are fetched
+    THEN check that the data is kept and the fetch still backs off
+    """
+    with FakeIMAPServer() as server, client.application.app_context():
+        server.messages = [f'Subject: message {i}\r\n\r\nbody {i}\r\n'.encode()
+                           for i in range(1, 9)]
+        server.throttle_ok = 1
+        mc = client_class('127.0.0.1', 'janitor@example.com', 'pw', server.port)
+        mc.imap_class = imaplib.IMAP4
+        mc.tuner.max_backoff = 0
+        throttled = MailClient.THROTTLED.labels(account='janitor@example.com')._value.get()
+        with mc:
+            mc.select('INBOX')
+            messages = list(mc.fetch(range(1, 9), chunk_size=8))
+            assert [em['Subject'] for _, em in messages] == \
+                [f'message {i}' for i in range(1, 9)]
+            assert mc.tuner.sizes['(BODY.PEEK[])'] == 4
+            assert MailClient.THROTTLED.labels(account='janitor@example.com')._value.get() == throttled + 1
+
+            fetches = [line for line in server.lines if line.startswith('FETCH')]
+            assert [line.split()[1] for line in fetches] == ['1:8']
+
+
+def test_parse_message():
+    """
+    GIVEN a notice with a large and a small attachment
+    WHEN it is parsed in chunks with an attachment size cap
+    THEN check that only the large attachment is dropped
+    """
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart()
+    msg['Subject'] = 'maintenance'
+    msg.attach(MIMEText('the maintenance details', 'plain'))
+    msg.attach(MIMEApplication(b'%PDF' * 50000, 'pdf'))
+    msg.attach(MIMEApplication(b'small', 'octet-stream'))
+    msg.attach(MIMEText('<p>html</p>', 'html'))
+    raw = msg.as_bytes()
+
+    whole = MailClient.parse_message(raw)
+    assert [p.get_content_type() for p in whole.walk()] == \
+        [p.get_content_type() for p in msg.walk()]
+    assert whole.get_payload()[1].get_payload(decode=True) == b'%PDF' * 50000
+
+    stream = MailClient.MessageStream(max_part_size=10000)
+    for i in range(0, len(raw), 1000):
+        stream.feed(raw[i:i + 1000])
+    parsed = stream.close()
+    assert stream.dropped == 1
+
+    text, pdf, small, html = parsed.get_payload()
+    assert parsed['Subject'] == 'maintenance'
+    assert text.get_payload() == 'the maintenance details'
+    assert pdf.get_content_type() == 'application/pdf'
+    assert int(pdf['X-Janitor-Dropped']) > 10000
+    assert not pdf.get_payload()
+    assert small.get_payload(decode=True) == b'small'
+    assert html.get_payload() == '<p>html</p>'
+
+
+def fake_gmail_api(server, tmp_path):
+    token_file = tmp_path / 'token.json'
+    token_file.write_text(json.dumps({'token': 'token', 'refresh_token': 'refresh',
+                                      'client_id': 'id', 'client_secret': 'secret',
+                                      'expiry': '2099-01-01T00:00:00Z'}))
+    return MailClient.GmailAPI('janitor@example.com', str(token_file), server.root)
+
+
+def test_gmail_api(client, tmp_path):
+    """
+    GIVEN a gmail api with unread messages
+    WHEN they are searched for, fetched in batches and marked processed
+    THEN check that every message is returned and labeled
+    """
+    with FakeGmailAPIServer() as server, client.application.app_context():
+        ids = [server.add(f'Subject: message {i}\r\nMessage-ID: <{i}@example.com>\r\n\r\nbody {i}\r\n'.encode())
+               for i in range(1, 6)]
+        server.add(b'Subject: read\r\n\r\nbody\r\n', labels=['INBOX'])
+        mc = fake_gmail_api(server, tmp_path)
+        mc.tuner.max_backoff = 0
+        with mc:
+            mc.select('INBOX')
+            assert mc.search('UNSEEN') == ids
+
+            headers = list(mc.fetch_headers(ids, ['Subject', 'Message-ID'], chunk_size=2))
+            assert [h['Subject'] for _, h, _ in headers] == [f'message {i}' for i in range(1, 6)]
+            # the first batch came back fast so the second one is twice the size
+            assert server.batches == 2
+
+            server.throttle = 2
+            messages = list(mc.fetch(ids + ['missing'], chunk_size=10))
+            assert [msg_id for msg_id, _ in messages] == ids
+            assert messages[0][1].get_payload().strip() == 'body 1'
+            # refused, retried with half as many, then the rest
+            assert server.batches == 5
+
+            for msg_id in ids[:3]:
+                mc.mark_processed(msg_id)
+            mc.mark_failed(ids[3])
+        processed = server.labels['processed']
+        assert all(server.messages[i][1] == {'INBOX', processed} for i in ids[:3])
+        assert server.messages[ids[3]][1] == {'INBOX', 'UNREAD', server.labels['failures']}
+
+        with mc:
+            mc.select('INBOX')
+            start = mc.history_id()
+            new = server.add(b'Subject: new\r\n\r\nbody\r\n')
+            assert mc.history(start) == ([new], start + 1)
+
+            server.oldest_history = start + 1
+            assert mc.history(start) == (None, None)
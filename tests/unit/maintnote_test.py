@@ -0,0 +1,164 @@
+import datetime
+import icalendar
+import pytest
+import sqlalchemy
+from app import Providers, db, maintnote, registry
+from app.models import Maintenance, Circuit
+from app.Providers import NTT
+from tests.notices import MAINTNOTE_CALENDARS, MAINTNOTE_EVENT, UNUSUAL_CALENDARS, \
+    calendar, maintnote_notice
+
+
+def reference(ics):
+    '''
+    the events as icalendar reads them
+    '''
+    cal = icalendar.Calendar.from_ical(ics)
+    return [maintnote.event_values(c) for c in cal.subcomponents if c.name == 'VEVENT']
+
+
+def comparable(events):
+    '''
+    datetimes in a zone as their utc time and zone name. icalendar's zones
+    are zoneinfo's and an ambiguous time never equals one in another kind
+    of zone, see PEP 495. equal ones in different zones would pass too.
+    '''
+    return [{name: (value.astimezone(datetime.timezone.utc), value.tzname())
+             if isinstance(value, datetime.datetime) and value.tzinfo else value
+             for name, value in event.items()} for event in events]
+
+
+@pytest.mark.parametrize('ics', MAINTNOTE_CALENDARS)
+def test_fast_events(ics):
+    """
+    GIVEN MAINTNOTE calendars
+    WHEN their events are read by the fast path
+    THEN check that they are what icalendar reads
+    """
+    for data in (ics, ics.encode()):
+        events = maintnote.fast_events(data)
+        assert comparable(events) == comparable(reference(data))
+
+
+@pytest.mark.parametrize('ics', UNUSUAL_CALENDARS)
+def test_unusual_events(ics):
+    """
+    GIVEN calendars the fast path doesn't read
+    WHEN their events are read
+    THEN check that they are left to icalendar
+    """
+    with pytest.raises(maintnote.UnusualCalendar):
+        maintnote.fast_events(ics)
+    events = maintnote.events(ics)
+    assert comparable(events) == comparable(reference(ics))
+
+
+def test_events_values():
+    """
+    GIVEN a MAINTNOTE calendar
+    WHEN its events are read
+    THEN check the values the providers use
+    """
+    event, = maintnote.events(MAINTNOTE_CALENDARS[0])
+    assert event['X-MAINTNOTE-OBJECT-ID'] == ['acme-widgets-as-a-service', 'acme-widgets-as-a-service-2']
+    assert event['DTSTART'] == datetime.datetime(2021, 6, 1, 4, tzinfo=datetime.timezone.utc)
+    assert event['DTSTART'].tzname() == 'UTC'
+    assert event['DESCRIPTION'] == 'Replacing a line card, then a reboot\nof the router'
+    assert event['SEQUENCE'] == 1
+
+    with pytest.raises(ValueError):
+        maintnote.events('not a calendar')
+
+
+@pytest.mark.parametrize('encode', [False, True])
+def test_standard_provider(client, encode):
+    """
+    GIVEN a MAINTNOTE notice, plain and base64 encoded
+    WHEN NTT processes it
+    THEN check that the maintenance and its circuits are added
+    """
+    with client.application.app_context():
+        assert NTT().process(maintnote_notice(encode=encode))
+        maint = Maintenance.query.filter_by(provider_maintenance_id='WorkOrder-31415').first()
+        assert (maint.start, maint.end, maint.timezone) == \
+            (datetime.time(4), datetime.time(8), 'UTC')
+        assert Circuit.query.filter_by(provider_cid='acme-widgets-as-a-service-2').first()
+
+
+def test_standard_provider_events(client):
+    """
+    GIVEN a calendar with two windows of one maintenance and another maintenance
+    WHEN NTT processes it
+    THEN check that every event is added in one commit
+    """
+    event = MAINTNOTE_EVENT.replace('WorkOrder-31415', 'WorkOrder-1')
+    windows = calendar(event, event.replace('20210601T', '20210602T'),
+                       event.replace('WorkOrder-1', 'WorkOrder-2'))
+    with client.application.app_context():
+        ntt = NTT()
+        commits = []
+
+        def committed(session):
+            commits.append(session)
+
+        sqlalchemy.event.listen(db.session, 'after_commit', committed)
+        try:
+            assert ntt.process(maintnote_notice(windows))
+        finally:
+            sqlalchemy.event.remove(db.session, 'after_commit', committed)
+        assert len(commits) == 1
+
+        maint, = Maintenance.query.filter_by(provider_maintenance_id='WorkOrder-1').all()
+        assert sorted({mc.date for mc in maint.circuits}) == \
+            [datetime.date(2021, 6, 1), datetime.date(2021, 6, 2)]
+        assert len(maint.circuits) == 4
+        assert Maintenance.query.filter_by(provider_maintenance_id='WorkOrder-2').count() == 1
+
+        # an event that can't be applied leaves the whole calendar out
+        broken = calendar(event.replace('WorkOrder-1', 'WorkOrder-3'),
+                          event.replace('DTEND:20210601T080000Z\r\n', ''))
+        with pytest.raises(KeyError):
+            ntt.process(maintnote_notice(broken))
+        db.session.rollback()
+        assert not Maintenance.query.filter_by(provider_maintenance_id='WorkOrder-3').count()
+
+
+def test_standard_provider_ended_windows(client, monkeypatch):
+    """
+    GIVEN a calendar that completes two windows of one maintenance
+    WHEN NTT processes it
+    THEN check that the ended functions and the gauge are run once
+    """
+    event = MAINTNOTE_EVENT.replace('WorkOrder-31415', 'WorkOrder-6')
+    completed = event.replace('X-MAINTNOTE-STATUS:TENTATIVE', 'X-MAINTNOTE-STATUS:COMPLETED')
+    ended = []
+    monkeypatch.setattr(Providers, 'ended_funcs', [lambda email, maintenance: ended.append(maintenance.id)])
+    with client.application.app_context():
+        ntt = NTT()
+        assert ntt.process(maintnote_notice(calendar(event)))
+
+        def in_progress():
+            return registry.get_sample_value('janitor_maintenances_inprogress', {'provider': 'ntt'}) or 0
+
+        before = in_progress()
+        assert ntt.process(maintnote_notice(calendar(completed, completed.replace('20210601T', '20210602T'))))
+        maint = Maintenance.query.filter_by(provider_maintenance_id='WorkOrder-6').first()
+        assert ended == [maint.id]
+        assert in_progress() == before - 1
+
+
+def test_standard_provider_partial(client):
+    """
+    GIVEN a calendar with a new maintenance and a start of an unknown one
+    WHEN NTT processes it twice
+    THEN check that it fails and nothing of it is committed either time
+    """
+    new = MAINTNOTE_EVENT.replace('WorkOrder-31415', 'WorkOrder-4')
+    unknown = MAINTNOTE_EVENT.replace('WorkOrder-31415', 'WorkOrder-5') \
+        .replace('X-MAINTNOTE-STATUS:TENTATIVE', 'X-MAINTNOTE-STATUS:IN-PROCESS')
+    assert unknown != MAINTNOTE_EVENT.replace('WorkOrder-31415', 'WorkOrder-5')
+    with client.application.app_context():
+        ntt = NTT()
+        for _ in range(2):
+            assert not ntt.process(maintnote_notice(calendar(new, unknown)))
+            assert not Maintenance.query.filter_by(provider_maintenance_id='WorkOrder-4').count()
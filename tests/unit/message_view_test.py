@@ -0,0 +1,72 @@
+import email
+import email.message
+from email import charset
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from app.MessageView import MessageView
+from app.Providers import GTT
+from app.jobs.dedup import normalized_hash
+from app.jobs.failures import body_hash
+from tests.notices import gtt_notice, GTT_HTML
+
+
+def test_message_view():
+    """
+    GIVEN an email with quoted-printable and base64 parts in other charsets
+    WHEN its view is read
+    THEN check that the parts are decoded once by their encoding and charset
+    """
+    msg = MIMEMultipart()
+    msg['Subject'] = '=?utf-8?q?Planned_work?=\r\n =?iso-8859-1?q?_K=F6ln?='
+    latin = charset.Charset('iso-8859-1')
+    latin.body_encoding = charset.BASE64
+    msg.attach(MIMEText('Köln 1 = 2\r\n', 'plain', latin))
+    msg.attach(MIMEText('<p>' + 'ä' * 100 + ' a=b</p>', 'html', 'utf-8'))
+    view = MessageView(email.message_from_bytes(msg.as_bytes()))
+
+    assert view.subject == 'Planned work Köln'
+    assert view.text == 'Köln 1 = 2\r\n'
+    assert view.html == '<p>' + 'ä' * 100 + ' a=b</p>'
+    assert view.calendar is None
+    assert view.html is view.html
+    assert MessageView.of(view) is view
+
+
+def test_gtt_quoted_printable():
+    """
+    GIVEN a GTT notice sent quoted-printable
+    WHEN it is parsed
+    THEN check that it reads the same as a plain one
+    """
+    utf8 = charset.Charset('utf-8')
+    utf8.body_encoding = charset.QP
+    msg = MIMEMultipart()
+    msg['Subject'] = 'GTT Work Announcement #(1234)'
+    msg.attach(MIMEText(GTT_HTML, 'html', utf8))
+    assert msg.get_payload(0)['Content-Transfer-Encoding'] == 'quoted-printable'
+
+    gtt = GTT.__new__(GTT)
+    assert gtt.parse(email.message_from_bytes(msg.as_bytes())) == gtt.parse(gtt_notice())
+
+
+def test_decoded_once(monkeypatch):
+    """
+    GIVEN a notice's view
+    WHEN it is hashed for the duplicate check and the ledger and parsed
+    THEN check that each of its parts is decoded once
+    """
+    view = MessageView(email.message_from_bytes(gtt_notice().as_bytes()))
+    expected = normalized_hash(gtt_notice())
+    decodes = []
+    get_payload = email.message.Message.get_payload
+
+    def counted(part, *args, **kwargs):
+        if kwargs.get('decode'):
+            decodes.append(part.get_content_type())
+        return get_payload(part, *args, **kwargs)
+
+    monkeypatch.setattr(email.message.Message, 'get_payload', counted)
+    assert normalized_hash(view) == expected
+    assert body_hash(view)
+    assert GTT.__new__(GTT).parse(view)
+    assert decodes == ['text/html']
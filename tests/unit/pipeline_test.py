@@ -0,0 +1,55 @@
+import pytest
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from app.Providers import GTT, ParsingError
+from app.jobs import pipeline
+
+
+def gtt_notice(number):
+    msg = MIMEMultipart()
+    msg['Subject'] = f'GTT Work Announcement #({number})'
+    msg.attach(MIMEText(
+        f'<html><body><p>GTT maintenance {number}</p>'
+        f'<p>Start: 2021-06-0{number} 01:00 UTC\r\n</p></body></html>', 'html'))
+    return msg
+
+
+def test_parsed_messages():
+    """
+    GIVEN routed GTT notices
+    WHEN they are parsed inline and in a process pool
+    THEN check that both give the same plain text, in order
+    """
+    messages = [(i, gtt_notice(i)) for i in range(1, 6)]
+    routed = {i: GTT.__new__(GTT) for i in range(1, 6)}
+
+    inline = [(msg_id, parsed()) for msg_id, em, provider, parsed
+              in pipeline.parsed_messages(messages, routed)]
+    assert inline[0][1].startswith('GTT maintenance 1')
+
+    pool = pipeline.parse_pool(2)
+    assert pipeline.parse_pool(2) is pool
+    pooled = [(msg_id, parsed()) for msg_id, em, provider, parsed
+              in pipeline.parsed_messages(messages, routed, pool, window=2)]
+    assert pooled == inline
+
+
+class BrokenGTT(GTT):
+    '''
+    a GTT whose parser can't read anything
+    '''
+    def parse(self, email):
+        raise ParsingError(f'unreadable: {email.subject}')
+
+
+def test_parse_error():
+    """
+    GIVEN a message a provider can't parse
+    WHEN it is parsed in a process pool
+    THEN check that the error is raised when the result is read
+    """
+    pool = pipeline.parse_pool(2)
+    [(msg_id, em, provider, parsed)] = pipeline.parsed_messages(
+        [(1, gtt_notice(1))], {1: BrokenGTT.__new__(BrokenGTT)}, pool)
+    with pytest.raises(ParsingError, match='unreadable: GTT Work Announcement'):
+        parsed()
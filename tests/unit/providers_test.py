@@ -1,5 +1,8 @@
 import pytest
 import json
+from app.Providers import GTT, Telia, Telstra, Zayo, html_tree, table_rows
+from app.models import Maintenance, Circuit, MaintCircuit
+from tests.notices import gtt_notice, telia_notice, telstra_notice, zayo_notice, GTT_HTML, TELIA_TEXT
 
 headers = {'content-type': 'application/json'}
 
@@ -40,3 +43,127 @@ def test_providers_bad_read_one(client, api):
     resp = client.get(f'{api}/providers/99999')
 
     assert resp.status_code == 404
+
+
+def test_gtt_fields():
+    """
+    GIVEN a GTT work announcement
+    WHEN its fields are extracted
+    THEN check that each field and every circuit is found, in order
+    """
+    gtt = GTT.__new__(GTT)
+    fields = gtt.get_fields(gtt.parse(gtt_notice()))
+    assert fields['start'] == '2021-06-01 01:00 UTC'
+    assert fields['location'] == 'Frankfurt, DE'
+    assert fields['impact'] == 'Up to 30 minutes of outage'
+    assert fields['cids'] == [f'GTT-{i:05d}' for i in range(6)]
+    assert fields['a_sides'] == [f'{i} Main St, Frankfurt' for i in range(6)]
+
+    # a location line is an a side too, a field line isn't
+    fields = gtt.get_fields('location = 9 Side St\nGTT Service = GTT-9;\nLocation: x\n')
+    assert fields['a_sides'] == ['9 Side St']
+    assert fields['location'] == 'x'
+    assert fields['start'] is None
+
+
+def test_gtt_new_maint(client):
+    """
+    GIVEN a GTT work announcement
+    WHEN it is applied
+    THEN check that the maintenance and its circuits are added
+    """
+    with client.application.app_context():
+        gtt = GTT()
+        email = gtt_notice(subject='GTT Work Announcement #(4321)')
+        assert gtt.process(email)
+        maint = Maintenance.query.filter_by(provider_maintenance_id='4321').first()
+        assert maint.reason == 'Fiber relocation'
+        assert Circuit.query.filter_by(provider_cid='GTT-00003').first().a_side == \
+            '3 Main St, Frankfurt'
+
+        broken = gtt_notice(subject='GTT Work Announcement #(4322)',
+                            html=GTT_HTML.replace('Impact:', 'Effect:'))
+        with pytest.raises(Exception):
+            gtt.process(broken)
+
+
+def test_telia_new_maint(client):
+    """
+    GIVEN a Telia planned work notice
+    WHEN it is applied
+    THEN check that the maintenance and its circuits are added
+    """
+    with client.application.app_context():
+        telia = Telia()
+        fields = telia.get_fields(TELIA_TEXT)
+        assert fields['maint_id'] == 'pwic123456'
+        assert fields['cids'] == [f'ic-{i:06d}' for i in range(6)]
+
+        assert telia.process(telia_notice())
+        maint = Maintenance.query.filter_by(provider_maintenance_id='pwic123456').first()
+        assert maint.location == 'frankfurt, de'
+        assert len(maint.circuits) == 6
+
+
+def test_table_rows():
+    """
+    GIVEN html tables with header rows and empty cells
+    WHEN their rows are read
+    THEN check that they match what pandas.read_html would give
+    """
+    tree = html_tree(
+        '<table><thead><tr><td>id</td><td>impact</td></tr></thead>'
+        '<tr><td> a\r\n 1 </td><td></td></tr><tr><td>b</td></tr></table>'
+        '<table><tr><th>id</th><th>impact</th></tr><tr><td>c</td><th>x</th></tr></table>')
+    first, second = tree.iter('table')
+    assert table_rows(first) == [('a 1', None), ('b', None)]
+    assert table_rows(second) == [('c', 'x')]
+
+    # merged cells are left to pandas
+    merged = html_tree(
+        '<table><tr><th>id</th><th>impact</th></tr>'
+        '<tr><td colspan="2">d</td></tr></table>')
+    assert Zayo.__new__(Zayo).format_circuit_table(next(merged.iter('table'))) == [('d', 'd')]
+
+    # an empty body is an empty tree
+    assert html_tree('  ').text_content() == ''
+
+
+def test_zayo_new_maint(client):
+    """
+    GIVEN a Zayo maintenance notification
+    WHEN it is applied
+    THEN check that the maintenance and its circuit are added
+    """
+    with client.application.app_context():
+        zayo = Zayo()
+        assert zayo.process(zayo_notice())
+        maint = Maintenance.query.filter_by(provider_maintenance_id='TTN-0001234567').first()
+        assert maint.location == 'Frankfurt, DE'
+        circuit = Circuit.query.filter_by(provider_cid='ZYO/IPYX/000000').first()
+        assert (circuit.a_side, circuit.z_side) == ('FRNKGEAA', 'AMSTNLAA')
+
+
+def test_telstra_new_maint(client):
+    """
+    GIVEN a Telstra maintenance notification
+    WHEN it is applied
+    THEN check that the maintenance and its circuit are added
+    """
+    with client.application.app_context():
+        telstra = Telstra()
+        notice = telstra.parse(telstra_notice())
+        assert notice == {
+            'impact': 'Service outage of up to 2 hours',
+            'cid': 'TLS-0001234',
+            'date': '1-Jun-2021 00:00:00(UTC) to 1-Jun-2021 04:00:00(UTC)',
+            'details': ['Fibre repairs between Sydney and Hong Kong.',
+                        'Traffic will be rerouted where possible.'],
+        }
+        assert telstra.process(telstra_notice())
+        maint = Maintenance.query.filter_by(provider_maintenance_id='PR123456').first()
+        assert maint.timezone == 'UTC'
+        assert maint.reason.startswith('Fibre repairs')
+        circuit = Circuit.query.filter_by(provider_cid='TLS-0001234').first()
+        assert MaintCircuit.query.filter_by(circuit_id=circuit.id).first().impact == \
+            'Service outage of up to 2 hours'
@@ -0,0 +1,151 @@
+import pytest
+import email
+import threading
+from app import registry
+from app.MessageView import MessageView
+from app.Router import Router, SubjectRules, parse_criteria
+from app.Providers import GTT, Telia, Telstra, Zayo
+
+
+class FakeProvider:
+    def __init__(self, name, identified_by):
+        self.name = name
+        self.identified_by = identified_by
+
+
+def headers(**fields):
+    raw = ''.join(f'{k.strip("_").title()}: {v}\r\n' for k, v in fields.items())
+    return email.message_from_string(raw)
+
+
+def subject(value):
+    '''
+    the subject a message's MessageView gives the subject rules
+    '''
+    return MessageView(headers(subject=value) if value else headers()).subject
+
+
+def test_parse_criteria():
+    """
+    GIVEN a provider's imap search criteria
+    WHEN they are parsed
+    THEN check that the header rules are returned and state keys ignored
+    """
+    assert parse_criteria(b'(FROM "MR Zayo" UNSEEN)') == [('From', 'mr zayo')]
+    assert parse_criteria(b'(SUBJECT NTT UNSEEN)') == [('Subject', 'ntt')]
+    assert parse_criteria('FROM a@b.com SUBJECT "x y"') == [
+        ('From', 'a@b.com'),
+        ('Subject', 'x y'),
+    ]
+
+    with pytest.raises(ValueError):
+        parse_criteria(b'(OR FROM a FROM b)')
+
+
+def test_router():
+    """
+    GIVEN a set of providers
+    WHEN messages are routed by their headers
+    THEN check that each message goes to the first matching provider
+    """
+    zayo = FakeProvider('zayo', b'(FROM "MR Zayo" UNSEEN)')
+    ntt = FakeProvider('ntt', b'(SUBJECT NTT UNSEEN)')
+    router = Router([zayo, ntt])
+
+    assert router.fields == ['From', 'Subject']
+    assert router.route(headers(from_='"MR Zayo" <mr@zayo.com>')) is zayo
+    assert router.route(headers(subject='=?utf-8?q?NTT_maintenance?=')) is ntt
+    assert router.route(headers(subject='lunch?')) is None
+
+
+def test_subject_rules():
+    """
+    GIVEN a table of subject rules
+    WHEN subjects are matched against it
+    THEN check that the first matching rule is used and counted
+    """
+    rules = SubjectRules('test', [
+        ('start', '^(?i:start)', 'add_start_maint'),
+        ('ticket', r'(?i:ticket) (\d+)', 'update'),
+        ('done', 'DONE', 'add_end_maint'),
+        ('any', '(?i:ticket|done)', None),
+    ])
+
+    assert rules.match('START: ticket 1 DONE').name == 'start'
+    assert rules.match('re: start ticket 1 DONE').name == 'ticket'
+    assert rules.match('re: TICKET 22').action == 'update'
+    assert rules.match('it is DONE').name == 'done'
+    # the case insensitivity is only where a pattern asks for it
+    assert rules.match('it is done').name == 'any'
+    assert rules.match('re: restart') is None
+    assert rules.match(subject(None)) is None
+    # encoded and folded subjects are matched as the view reads them
+    assert rules.match(subject('=?utf-8?q?Start_of_work?=')).name == 'start'
+    assert rules.match(subject('re: ticket\r\n   42')).name == 'ticket'
+
+    assert rules.stats == {'start': 2, 'ticket': 3, 'done': 1, 'any': 1, None: 2}
+
+    # the metric only counts what has been flushed, and each match once
+    def matches(rule):
+        return registry.get_sample_value('janitor_subject_rule_matches_total',
+                                         {'provider': 'test', 'rule': rule})
+
+    assert matches('ticket') == 0
+    rules.flush()
+    rules.match('re: ticket 7')
+    rules.flush()
+    assert (matches('ticket'), matches('none'), matches('start')) == (4, 2, 2)
+
+
+
+def test_subject_rules_threads():
+    """
+    GIVEN a table of subject rules matched from several threads at once
+    WHEN the matches are flushed
+    THEN check that no match is lost from the counts
+    """
+    rules = SubjectRules('threads', [('ticket', 'ticket', 'update')])
+
+    def match_many():
+        for _ in range(20000):
+            rules.match('ticket')
+            rules.match('other')
+
+    threads = [threading.Thread(target=match_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rules.flush()
+
+    assert rules.stats == {'ticket': 80000, None: 80000}
+    assert registry.get_sample_value('janitor_subject_rule_matches_total',
+                                     {'provider': 'threads', 'rule': 'ticket'}) == 80000
+
+
+@pytest.mark.parametrize('provider, subject, action', [
+    (Zayo, '***Customer***ZAYO TTN-0001 MAINTENANCE NOTIFICATION***', 'add_new_maint'),
+    (Zayo, 'RESCHEDULE NOTIFICATION***Customer***ZAYO TTN-0001***', 'add_reschedule_maint'),
+    (Zayo, 'START MAINTENANCE NOTIFICATION***Customer***ZAYO TTN-0001***', 'add_start_maint'),
+    (Zayo, 'End of Window Notification***Customer***ZAYO TTN-0001***', 'add_end_maint'),
+    (Zayo, 'Re: ZAYO TTN-0001 Maintenance Window Extension', 'update'),
+    (Zayo, 'Re: Maintenance Notification', None),
+    (GTT, 'GTT Work Announcement #(1234)', 'add_new_maint'),
+    (GTT, 'Re: GTT TT#5678', 'update'),
+    (Telia, 'Planned work 12345 on your circuits', 'add_new_maint'),
+    (Telia, 'Reminder for planned work 12345', None),
+    (Telia, 'Planned work 12345 has been completed', 'add_new_maint'),
+    (Telia, 'Work 12345 has been completed', 'add_end_maint'),
+    (Telia, 'Work 12345 HAS BEEN COMPLETED', None),
+    (Telstra, 'Maintenance reminder - PN123', 'add_start_maint'),
+    (Telstra, 'Maintenance did not proceed - PN123', 'add_cancelled_maint'),
+    (Telstra, 'Reminder - PN123', None),
+])
+def test_provider_subject_rules(provider, subject, action):
+    """
+    GIVEN a provider's subject rules
+    WHEN a notice's subject is matched against them
+    THEN check that it goes to the action the old if/elif chains chose
+    """
+    rule = provider.subject_rules.match(subject)
+    assert (rule.action if rule else None) == action